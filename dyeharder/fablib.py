@@ -1,13 +1,20 @@
 import os
 from os import path
+from contextlib import contextmanager
 from datetime import datetime
 import getpass
 import re
+import shutil
+import socket
+import subprocess
+import sys
+import zlib
 
 from fabric.context_managers import cd, hide, settings
 from fabric.operations import require, prompt, get, run, sudo, local, put
-from fabric.state import env
-from fabric.contrib import files
+from fabric.state import env, connections
+from fabric.decorators import parallel, runs_once
+from fabric.tasks import execute
 from fabric import utils
 from inspect import ismodule
 
@@ -33,8 +40,67 @@ def _setup_paths(project_settings):
     env.setdefault('vcs_root_dir', env.current_link)
     env.setdefault('next_dir', _create_timestamp_dirname(env.timestamp))
     env.setdefault('dump_dir', path.join(env.server_project_home, 'dbdumps'))
-    env.setdefault('deploy_dir', path.join(env.vcs_root_dir, 'deploy'))
+    # where get_remote_dump(incremental=True) keeps its dump on the server
+    env.setdefault('incremental_dump_dir', path.join(env.dump_dir, 'incremental'))
+    # the path from the VCS root to the deploy dir (with tasks.py in)
+    env.setdefault('relative_deploy_dir', 'deploy')
+    env.setdefault('deploy_dir',
+                   path.join(env.vcs_root_dir, env.relative_deploy_dir))
     env.setdefault('settings', '%(project_name)s.settings' % env)
+    # the maximum number of hosts parallel_deploy works on at once - None
+    # means all of them
+    env.setdefault('deploy_pool_size', None)
+    # how create_copy_for_next() copies the current version - 'copy',
+    # 'reflink' or 'hardlink'
+    env.setdefault('release_copy_mode', 'copy')
+    # with hardlink, files that are written in place and so need their own
+    # copy - including the files pip and setuptools rewrite in the virtualenv
+    env.setdefault('release_copy_unshare',
+                   ['*.db', '*.sqlite', '*.sqlite3', '*.log', 'timestamp',
+                    '*.pth', '*.egg-link'])
+    # if set, the virtualenv is installed from wheels kept in this directory
+    # on the server, rather than each server downloading and building them
+    env.setdefault('wheelhouse_dir', None)
+    # where to build the wheels - 'first_host' or 'local'
+    env.setdefault('wheelhouse_build', 'first_host')
+    # dump the database while the new version is being built, rather than
+    # while the site is offline
+    env.setdefault('background_db_dump', False)
+    # how the database dump is compressed - gzip, pigz, zstd or lz4
+    env.setdefault('db_dump_compressor', 'gzip')
+    # how many connections the daily database dumps use to dump tables in
+    # parallel - 0 uses a single mysqldump
+    env.setdefault('db_dump_parallel', 0)
+    # how many connections load tables at the same time when restoring a dump
+    # - 0 loads a single file dump as it is (dumps made with db_dump_parallel
+    # are always loaded in parallel)
+    env.setdefault('db_restore_parallel', 0)
+    # restore dumps with the foreign key and unique checks turned off, then
+    # check the row counts match the dump - projects have to opt in to this
+    env.setdefault('db_restore_fast', False)
+    # dump a snapshot of the database at a low CPU and I/O priority, so the
+    # deploy and daily dumps don't slow the site down
+    env.setdefault('db_dump_low_impact', False)
+    # the most MB/s a low impact dump writes - None for no limit
+    env.setdefault('db_dump_bandwidth_limit', None)
+    # keep the daily and deploy dumps in a store that only keeps one copy of
+    # the parts that are the same in each dump (see tasklib/dumpstore.py)
+    env.setdefault('db_dump_store', False)
+    env.setdefault('db_dump_store_dir', path.join(env.dump_dir, 'store'))
+    # the daily dumps delete the dumps in the store older than this many
+    # days, apart from the newest db_dump_store_keep_count
+    env.setdefault('db_dump_store_keep_days', 31)
+    env.setdefault('db_dump_store_keep_count', 10)
+    # where setup_binlog_backups keeps the weekly base backups and the
+    # binary logs, for restoring the database to any point in time
+    env.setdefault('db_binlog_backup_dir', path.join(env.dump_dir, 'binlog_backups'))
+    # rollback(restore_db=True) restores the dump into another database while
+    # the site is still up, and then swaps the tables over
+    env.setdefault('db_restore_shadow', False)
+    # only dump the database during the deploy if the new version has
+    # migrations (or new tables) to apply - otherwise just record a restore
+    # point.  Dumps started by background_db_dump are always taken.
+    env.setdefault('db_dump_only_for_migrations', True)
 
     if env.project_type == "django":
         env.setdefault('relative_django_dir', env.project_name)
@@ -59,6 +125,14 @@ def _setup_paths(project_settings):
         env.setdefault('local_tasks_bin',
                        path.join(path.dirname(__file__), 'tasks.py'))
 
+    # the local copy of the wheelhouses, used to send them to each server
+    if 'DEPLOYDIR' in os.environ:
+        env.setdefault('local_wheelhouse_dir',
+                       path.join(os.environ['DEPLOYDIR'], '.wheelhouse'))
+    else:
+        env.setdefault('local_wheelhouse_dir',
+                       path.join(path.dirname(__file__), '.wheelhouse'))
+
     # valid environments - used for require statements in fablib
     env.valid_envs = env.host_list.keys()
 
@@ -67,9 +141,11 @@ def _linux_type():
     if 'linux_type' not in env:
         # work out if we're based on redhat or centos
         # TODO: look up stackoverflow question about this.
-        if files.exists('/etc/redhat-release'):
+        _probe_remote_files('/etc/redhat-release', '/etc/debian_version',
+                            permanent=True)
+        if _exists('/etc/redhat-release'):
             env.linux_type = 'redhat'
-        elif files.exists('/etc/debian_version'):
+        elif _exists('/etc/debian_version'):
             env.linux_type = 'debian'
         else:
             # TODO: should we print a warning here?
@@ -80,7 +156,8 @@ def _linux_type():
 def _get_python():
     if 'python_bin' not in env:
         python26 = path.join('/', 'usr', 'bin', 'python2.6')
-        if files.exists(python26):
+        _probe_remote_files(python26, permanent=True)
+        if _exists(python26):
             env.python_bin = python26
         else:
             env.python_bin = path.join('/', 'usr', 'bin', 'python')
@@ -93,11 +170,13 @@ def _get_tasks_bin():
     return env.tasks_bin
 
 
-def _tasks(tasks_args, verbose=False):
-    tasks_cmd = _get_tasks_bin()
+def _tasks(tasks_args, verbose=False, read_only=False, tasks_bin=None):
+    if tasks_bin is None:
+        tasks_bin = _get_tasks_bin()
+    tasks_cmd = tasks_bin
     if env.verbose or verbose:
         tasks_cmd += ' -v'
-    sudo_or_run(tasks_cmd + ' ' + tasks_args)
+    return sudo_or_run(tasks_cmd + ' ' + tasks_args, read_only=read_only)
 
 
 def _get_svn_user_and_pass():
@@ -132,8 +211,8 @@ def clean_files():
 
 
 def _create_dir_if_not_exists(path):
-    if not files.exists(path):
-        sudo_or_run('mkdir -p %s' % path)
+    if not _exists(path):
+        _queue_command('mkdir -p %s' % path, creates=[path])
 
 
 def deploy(revision=None, keep=None, rebuild_ve=True):
@@ -147,6 +226,83 @@ def deploy(revision=None, keep=None, rebuild_ve=True):
       5)"""
     require('server_project_home', provided_by=env.valid_envs)
 
+    _deploy_pre_checks()
+    prepare_seconds = _deploy_build_next(revision=revision, rebuild_ve=rebuild_ve)
+    downtime_start, downtime_end = _deploy_switch_to_next()
+    _deploy_tidy_up(keep)
+    _report_downtime(downtime_start, downtime_end, prepare_seconds)
+    _report_db_dump()
+    _report_round_trips()
+
+
+@runs_once
+def parallel_deploy(revision=None, keep=None, rebuild_ve=True, pool_size=None):
+    """ deploy to all the hosts for this environment at the same time
+
+    This takes the same arguments as deploy, plus:
+
+    * pool_size is the maximum number of hosts to work on at once (default
+      is env.deploy_pool_size, or all hosts if that is not set)
+
+    Copying the current version, the VCS checkout and building the virtualenv
+    are done on all hosts in parallel, with the output of each line prefixed by
+    the host name.  Anything that might prompt is done first, one host at a
+    time, the wheels (if wheelhouse_dir is set) are built once between the
+    checkout and the virtualenv, and the switch to the new version (including any database
+    migrations) is done one host at a time, so that two hosts never migrate
+    the same database at once."""
+    require('server_project_home', provided_by=env.valid_envs)
+    if pool_size is None:
+        pool_size = env.deploy_pool_size
+    if pool_size is not None:
+        pool_size = int(pool_size)
+    hosts = env.hosts
+    # the svn details are prompted for - get them before we fork
+    if env.repo_type == 'svn':
+        _get_svn_user_and_pass()
+
+    host_state = execute(_deploy_pre_checks, hosts=hosts)
+    with settings(output_prefix=True):
+        checkout_results = execute(
+            parallel(pool_size=pool_size)(_deploy_stage_on_host),
+            host_state, _deploy_checkout_next, revision=revision, hosts=hosts)
+        # the other processes changed the files, so our cache is out of date
+        _forget_remote_files_on_all_hosts()
+        if env.wheelhouse_dir:
+            # build the wheels once, before the hosts install them
+            execute(_deploy_build_wheelhouse_on_host, host_state, hosts=hosts)
+        build_results = execute(
+            parallel(pool_size=pool_size)(_deploy_stage_on_host),
+            host_state, _deploy_install_next, rebuild_ve=rebuild_ve, hosts=hosts)
+        _forget_remote_files_on_all_hosts()
+    for host, result in build_results.items():
+        host_state[host]['prepare_seconds'] = result['result']
+    host_downtimes = execute(_deploy_switch_on_host, host_state, keep,
+                             hosts=hosts)
+    _report_combined_downtime(host_downtimes)
+    _report_db_dump()
+    # the build was done in other processes, so add on their round trips
+    round_trips = dict((host, state['round_trips']) for (host, state) in
+                       env.get('remote_state', {}).items())
+    for results in (checkout_results, build_results):
+        for host, result in results.items():
+            round_trips[host] = round_trips.get(host, 0) + result['round_trips']
+    _report_round_trips(round_trips)
+
+
+def _deploy_pre_checks():
+    """ The checks that have to be done before we start building the next
+    version.  These might prompt the user.  Returns the per-host state the
+    later stages require, for use by parallel_deploy. """
+    # find out about everything the checks look at in one go
+    _probe_remote_files(
+        path.join(env.server_project_home, 'README.mkd'),
+        path.join(env.server_project_home, 'previous'),
+        env.server_project_home,
+        path.join(env.vcs_root_dir, "." + env.repo_type),
+        env.vcs_root_dir,
+        env.next_dir,
+    )
     # if the <server_project_home>/previous/ directory doesn't exist, this does
     # nothing
     _migrate_directory_structure()
@@ -160,31 +316,84 @@ def deploy(revision=None, keep=None, rebuild_ve=True):
     # might just mean we did a rollback, so maybe don't bother as the
     # deploy-in-progress should be enough
     # _check_for_deploy_in_progress()
+    _check_next_dir_does_not_exist()
+    return {
+        'vcs_root_dir_timestamp': env.vcs_root_dir_timestamp,
+        'revision': env.get('revision'),
+    }
 
+
+def _deploy_build_next(revision=None, rebuild_ve=True):
+    """ Create the next version, without taking the site offline """
+    _deploy_checkout_next(revision=revision)
+    return _deploy_install_next(rebuild_ve=rebuild_ve)
+
+
+def _deploy_checkout_next(revision=None):
     # TODO: create deploy-in-progress.json file
     # _set_deploy_in_progress()
     create_copy_for_next()
+    if env.background_db_dump:
+        # after the copy, so the dump is not copied into next
+        _dump_db_in_background(env.vcs_root_dir_timestamp)
     checkout_or_update(in_next=True, revision=revision)
     # remove any old pyc files - essential if the .py file is removed by VCS
     if env.project_type == "django":
         rm_pyc_files(path.join(env.next_dir, env.relative_django_dir))
+
+
+def _deploy_install_next(rebuild_ve=True):
+    """ Install the virtualenv and prepare the checked out next version.
+    Returns how long the preparation took. """
     # create the deploy virtualenv if we use it
     create_deploy_virtualenv(in_next=True, rebuild_ve=rebuild_ve)
+    return prepare_next()
+
+
+def prepare_next():
+    """ Use tasks.py prepare:env in the next version to do the parts of the
+    deploy that don't need the database (settings, collectstatic ...) before
+    we take the site offline.  Returns how long it took. """
+    require('next_dir', 'environment', provided_by=env.valid_envs)
+    prepare_start = datetime.now()
+    _tasks('prepare:' + env.environment,
+           tasks_bin=path.join(env.next_dir, env.relative_deploy_dir, 'tasks.py'))
+    return (datetime.now() - prepare_start).total_seconds()
+
 
+def _deploy_switch_to_next():
+    """ Take the site offline, point current at next and do the deploy in
+    the new version.  Returns the start and end times of the downtime. """
     # we only have to disable this site after creating the rollback copy
     # (do this so that apache carries on serving other sites on this server
     # and the maintenance page for this vhost)
+    _probe_webserver_conf_files()
+    _probe_remote_files(env.current_link)
+    if env.project_type == 'django':
+        _probe_remote_files(path.join(env.django_settings_dir, 'local_settings.py'))
+    if env.background_db_dump:
+        # so we know the dump has taken its snapshot - and hasn't already
+        # failed - before we take the site offline
+        _wait_for_background_dump(env.vcs_root_dir_timestamp, snapshot_only=True)
+        dump_db = False
+        # work this out before the downtime starts
+        finish_dump_first = _background_dump_must_finish()
+    else:
+        # work this out before the downtime starts
+        dump_db = _decide_db_dump()
     downtime_start = datetime.now()
     link_webserver_conf(maintenance=True)
     with settings(warn_only=True):
         webserver_cmd('reload')
-    # TODO: do a database dump in the old directory
-    point_current_to_next()
+    if not dump_db and not env.background_db_dump:
+        _create_db_restore_point(env.vcs_root_dir_timestamp)
+    point_current_to_next(dump_db=dump_db)
 
-    # Use tasks.py deploy:env to actually do the deployment, including
-    # creating the virtualenv if it thinks it necessary, ignoring
-    # env.use_virtualenv as tasks.py knows nothing about it.
-    _tasks('deploy:' + env.environment)
+    if env.background_db_dump and finish_dump_first:
+        _wait_for_background_dump(env.vcs_root_dir_timestamp)
+    # Use tasks.py activate:env to do the rest of the deployment (prepare_next
+    # has done everything that doesn't need the database)
+    _tasks('activate:' + env.environment)
 
     # bring this vhost back in, reload the webserver and touch the WSGI
     # handler (which reloads the wsgi app)
@@ -192,7 +401,14 @@ def deploy(revision=None, keep=None, rebuild_ve=True):
     webserver_cmd('reload')
     downtime_end = datetime.now()
     touch_wsgi()
+    if env.background_db_dump and not finish_dump_first:
+        # the site is back up, so this costs no downtime - it just checks
+        # the dump worked
+        _wait_for_background_dump(env.vcs_root_dir_timestamp)
+    return downtime_start, downtime_end
+
 
+def _deploy_tidy_up(keep=None):
     delete_old_rollback_versions(keep)
     if env.environment == 'production':
         setup_db_dumps()
@@ -200,14 +416,87 @@ def deploy(revision=None, keep=None, rebuild_ve=True):
     # TODO: _remove_deploy_in_progress()
     # move the deploy-in-progress.json file into the old directory as
     # deploy-details.json
-    _report_downtime(downtime_start, downtime_end)
 
 
-def _report_downtime(downtime_start, downtime_end):
+def _restore_host_state(host_state):
+    """ execute() runs each host in a fresh copy of env (in a separate
+    process when running in parallel), so put back what _deploy_pre_checks
+    worked out for this host. """
+    for key, value in host_state[env.host_string].items():
+        env[key] = value
+
+
+def _deploy_stage_on_host(host_state, stage, **kwargs):
+    _restore_host_state(host_state)
+    round_trips_before = _remote_state()['round_trips']
+    result = stage(**kwargs)
+    # this may be run in another process, so pass the results back
+    return {
+        'round_trips': _remote_state()['round_trips'] - round_trips_before,
+        'result': result,
+    }
+
+
+@runs_once
+def _deploy_build_wheelhouse_on_host(host_state):
+    _restore_host_state(host_state)
+    _build_wheelhouse(_get_bootstrap_path(in_next=True))
+
+
+def _deploy_switch_on_host(host_state, keep=None):
+    _restore_host_state(host_state)
+    prepare_seconds = env.pop('prepare_seconds', None)
+    downtime = _deploy_switch_to_next()
+    # each host decides about the dump for itself, so keep what it decided
+    # for parallel_deploy to report
+    env.setdefault('host_db_dump_reports', {})[env.host_string] = \
+        env.pop('db_dump_report', None)
+    _deploy_tidy_up(keep)
+    _report_downtime(downtime[0], downtime[1], prepare_seconds)
+    return downtime
+
+
+def _report_downtime(downtime_start, downtime_end, prepare_seconds=None):
     downtime = downtime_end - downtime_start
     utils.puts("Downtime lasted for %.1f seconds" % downtime.total_seconds())
     utils.puts("(Downtime started at %s and finished at %s)" %
                (downtime_start, downtime_end))
+    if prepare_seconds is not None:
+        utils.puts("Preparing the new version before the downtime saved "
+                   "%.1f seconds of downtime" % prepare_seconds)
+
+
+def _report_db_dump():
+    if env.get('db_dump_report'):
+        utils.puts(env.db_dump_report)
+    # from parallel_deploy, which switches each host in turn
+    host_reports = env.get('host_db_dump_reports', {})
+    for host in sorted(host_reports):
+        if host_reports[host]:
+            utils.puts("%s: %s" % (host, host_reports[host]), show_prefix=False)
+
+
+def _report_combined_downtime(host_downtimes):
+    """ host_downtimes is a dict of host: (downtime_start, downtime_end) as
+    returned by execute() """
+    if not host_downtimes:
+        return
+    seconds = {}
+    for host, (downtime_start, downtime_end) in host_downtimes.items():
+        seconds[host] = (downtime_end - downtime_start).total_seconds()
+    utils.puts("Downtime per host:", show_prefix=False)
+    for host in sorted(seconds):
+        utils.puts("  %s: %.1f seconds" % (host, seconds[host]),
+                   show_prefix=False)
+    worst_host = max(seconds, key=seconds.get)
+    utils.puts("Longest downtime was %.1f seconds (on %s)" %
+               (seconds[worst_host], worst_host), show_prefix=False)
+    utils.puts("Total downtime across %d hosts was %.1f seconds" %
+               (len(seconds), sum(seconds.values())), show_prefix=False)
+    first_start = min(start for (start, end) in host_downtimes.values())
+    last_end = max(end for (start, end) in host_downtimes.values())
+    utils.puts("(Some host was down between %s and %s)" %
+               (first_start, last_end), show_prefix=False)
 
 
 def set_up_celery_daemon():
@@ -237,12 +526,12 @@ def clean_old_celery():
     require('vcs_root_dir', provided_by=env)
     for command in ('celerybeat', 'celeryd'):
         celery_run_script = path.join('/etc', 'init.d', command)
-        if files.exists(celery_run_script):
+        if _exists(celery_run_script):
             sudo_or_run('/etc/init.d/%s stop' % command)
             sudo_or_run('rm %s' % celery_run_script)
 
         celery_configuration_destination = path.join('/etc', 'default', command)
-        if files.exists(celery_configuration_destination):
+        if _exists(celery_configuration_destination):
             sudo_or_run('rm %s' % celery_configuration_destination)
 
 
@@ -264,16 +553,19 @@ def _migrate_directory_structure():
     deploy was in <server project home>/dev/"""
     # check if the README is present
     readme_path = path.join(env.server_project_home, 'README.mkd')
-    if not files.exists(readme_path):
+    if not _exists(readme_path):
         local_readme_path = path.join(path.dirname(path.realpath(__file__)),
                                       'static', 'README-server-project-home.mkd')
+        _count_round_trip()
         put(local_readme_path, readme_path, use_sudo=env.use_sudo)
+        _set_remote_file_exists(readme_path, True)
 
     prev_root = path.join(env.server_project_home, 'previous')
-    if not files.exists(prev_root):
+    if not _exists(prev_root):
         return
     # the if v at the end is to filter any empty strings (say if output of
     # run(...) ends in \n )
+    _count_round_trip()
     prev_versions = [v.strip() for v in
                      run('ls -1 ' + prev_root).split('\n')
                      if v.startswith('20')]
@@ -308,16 +600,60 @@ def _migrate_directory_structure():
 
 def _set_vcs_root_dir_timestamp():
     """ Find what the real directory name is that current/ points to. """
-    env.vcs_root_dir_timestamp = sudo_or_run('readlink -f %s' % env.vcs_root_dir)
+    env.vcs_root_dir_timestamp = sudo_or_run('readlink -f %s' % env.vcs_root_dir,
+                                             read_only=True)
 
 
 def create_copy_for_next():
     """Copy the current version to "next" so that we can do stuff like
     the VCS update and virtualenv update without taking the site offline"""
+    _check_next_dir_does_not_exist()
+
+    # if this is the initial deploy, the vcs_root_dir won't exist yet. In that
+    # case, don't create it (otherwise the checkout code will get confused).
+    if _exists(env.vcs_root_dir):
+        # cp -a - amongst other things this preserves links and timestamps
+        # so the compare that bootstrap.py does to see if the virtualenv
+        # needs an update should still work.
+        copy_options = {
+            'copy': '-a',
+            # copy on write where the filesystem supports it (btrfs, xfs
+            # with reflink=1), a normal copy otherwise
+            'reflink': '-a --reflink=auto',
+            # hard links share the timestamps as well as the contents
+            'hardlink': '-al',
+        }
+        if env.release_copy_mode not in copy_options:
+            utils.abort('Unknown release_copy_mode: %s (use one of %s)' %
+                        (env.release_copy_mode, ', '.join(copy_options)))
+        with _batched_commands():
+            _queue_command('cp %s %s %s' % (copy_options[env.release_copy_mode],
+                                            env.vcs_root_dir_timestamp,
+                                            env.next_dir),
+                           creates=[env.next_dir])
+            if env.release_copy_mode == 'hardlink':
+                _queue_command(_unshare_hardlinks_cmd(env.next_dir))
+
+
+def _unshare_hardlinks_cmd(dir_path):
+    """ VCS checkouts and pip replace files rather than writing to them, so
+    it is safe for them to be hard linked to the previous version.  But some
+    files are written in place (sqlite databases, the virtualenv timestamp
+    ...) which would change the previous version as well.  So give any files
+    matching env.release_copy_unshare their own copy, keeping the timestamps.
+    """
+    name_tests = ' -o '.join(["-name '%s'" % pattern
+                              for pattern in env.release_copy_unshare])
+    return ('find %s -type f -links +1 \\( %s \\) -exec sh -c '
+            '\'cp -p "$1" "$1.unshare" && mv "$1.unshare" "$1"\' sh {} \\;' %
+            (dir_path, name_tests))
+
+
+def _check_next_dir_does_not_exist():
     # check if next directory already exists
     # if it does maybe there was an aborted deploy, or maybe someone else is
     # deploying.  Either way, stop and ask the user what to do.
-    if files.exists(env.next_dir):
+    if _exists(env.next_dir):
         utils.warn('The "next" directory already exists.  Maybe a previous '
                    'deploy failed, or maybe another deploy is in progress.')
         continue_anyway = prompt('Would you like to continue anyway '
@@ -327,44 +663,194 @@ def create_copy_for_next():
             utils.abort("Aborting deploy - try again when you're certain what to do.")
         sudo_or_run('rm -rf %s' % env.next_dir)
 
-    # if this is the initial deploy, the vcs_root_dir won't exist yet. In that
-    # case, don't create it (otherwise the checkout code will get confused).
-    if files.exists(env.vcs_root_dir):
-        # cp -a - amongst other things this preserves links and timestamps
-        # so the compare that bootstrap.py does to see if the virtualenv
-        # needs an update should still work.
-        sudo_or_run('cp -a %s %s' % (env.vcs_root_dir_timestamp, env.next_dir))
-
 
-def point_current_to_next():
+def point_current_to_next(dump_db=True):
     """ Change the soft link `current` to point to the new next_dir """
     # dump the database in the old directory - do this before we remove
     # the current link
-    _dump_db_in_directory(env.vcs_root_dir_timestamp)
-    if files.exists(env.current_link):
-        sudo_or_run('rm %s' % env.current_link)
-    with cd(env.server_project_home):
-        sudo_or_run('ln -s %s current' % env.next_dir)
+    if dump_db:
+        _dump_db_in_directory(env.vcs_root_dir_timestamp)
+    with _batched_commands():
+        _delete_file(env.current_link)
+        with cd(env.server_project_home):
+            _queue_command('ln -s %s current' % env.next_dir,
+                           creates=[env.current_link])
 
 
-def _dump_db_in_directory(dump_dir):
+def _can_dump_db():
     require('django_settings_dir', provided_by=env.valid_envs)
-    if (env.project_type == 'django' and
-            files.exists(path.join(env.django_settings_dir, 'local_settings.py'))):
-        # dump database (provided local_settings has been set up properly)
+    # provided local_settings has been set up properly
+    return (env.project_type == 'django' and
+            _exists(path.join(env.django_settings_dir, 'local_settings.py')))
+
+
+def _restore_db_args(dump_file, parallel, task='restore_db'):
+    args = '%s:%s,parallel=%s' % (task, dump_file, parallel)
+    if env.db_restore_fast:
+        args += ',fast=true'
+    return args
+
+
+def _low_impact_dump_args():
+    args = ''
+    if env.db_dump_low_impact:
+        args += ',low_impact=true'
+        if env.db_dump_bandwidth_limit:
+            args += ',bandwidth_limit=%s' % env.db_dump_bandwidth_limit
+    return args
+
+
+def _dump_db_args():
+    """ the arguments for dump_db:db_dump.sql - into the store or compressed """
+    if env.db_dump_store:
+        args = ',store=' + env.db_dump_store_dir
+    else:
+        args = ',compressor=' + env.db_dump_compressor
+    return args + _low_impact_dump_args()
+
+
+def _dump_db_in_directory(dump_dir):
+    if _can_dump_db():
+        dump_start = datetime.now()
         with cd(dump_dir):
             # just in case there is some other reason why the dump fails
             with settings(warn_only=True):
-                _tasks('dump_db')
-            # and compress the dump
-            dump_file = 'db_dump.sql'
-            dump_file_compressed = dump_file + '.gz'
-            sudo_or_run('gzip -c %s > %s' % (dump_file, dump_file_compressed))
-            sudo_or_run('rm %s' % dump_file)
+                # read_only as it only creates the dump file, which is not
+                # something we check for
+                _tasks('dump_db:db_dump.sql' + _dump_db_args(), read_only=True)
+        # so a deploy that skips the dump can say how long it saved
+        sudo_or_run('echo %.1f > %s' % ((datetime.now() - dump_start).total_seconds(),
+                                        _db_dump_seconds_file()),
+                    read_only=True)
+
+
+def _db_dump_seconds_file():
+    return path.join(env.server_project_home, '.db_dump_seconds')
+
+
+def _pending_migrations():
+    """ The number of migrations (and new tables) the next version would
+    apply to the database, or None if that can't be worked out """
+    tasks_bin = path.join(env.next_dir, env.relative_deploy_dir, 'tasks.py')
+    with settings(warn_only=True):
+        output = _tasks('pending_migrations', read_only=True, tasks_bin=tasks_bin)
+    if output.failed:
+        return None
+    match = re.search(r'^pending_migrations: (\d+)', output, re.MULTILINE)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def _decide_db_dump():
+    """ Whether the deploy needs a full dump of the database - only when
+    there are migrations to run, if db_dump_only_for_migrations is set.
+    Sets env.db_dump_report to say what was decided. """
+    if not _can_dump_db():
+        return False
+    if not env.db_dump_only_for_migrations:
+        env.db_dump_report = 'Took a full database dump before the deploy'
+        return True
+    pending = _pending_migrations()
+    if pending is None:
+        env.db_dump_report = ('Took a full database dump before the deploy '
+                              '(could not work out the pending migrations)')
+        return True
+    if pending > 0:
+        env.db_dump_report = ('Took a full database dump before the deploy '
+                              '(%d migrations pending)' % pending)
+        return True
+    env.db_dump_report = ('Skipped the full database dump (no migrations are '
+                          'pending) - recorded a restore point instead')
+    with settings(warn_only=True):
+        dump_seconds = sudo_or_run('cat %s 2> /dev/null' % _db_dump_seconds_file(),
+                                   read_only=True).strip()
+    try:
+        env.db_dump_report += (' - saved about %.1f seconds of downtime' %
+                               float(dump_seconds))
+    except ValueError:
+        pass
+    return False
+
+
+def _background_dump_must_finish():
+    """ Whether the background dump has to finish before activate runs -
+    migrations that change a table the dump hasn't got to yet would break
+    the dump, so only when there are migrations to run.  Sets
+    env.db_dump_report to say what was decided. """
+    if not _can_dump_db():
+        return False
+    pending = _pending_migrations()
+    if pending == 0:
+        env.db_dump_report = ('No migrations are pending, so the background '
+                              'database dump finished after the downtime')
+        return False
+    if pending is None:
+        env.db_dump_report = ('Waited for the background database dump during '
+                              'the downtime (could not work out the pending '
+                              'migrations)')
+    else:
+        env.db_dump_report = ('Waited for the background database dump during '
+                              'the downtime (%d migrations pending)' % pending)
+    return True
+
+
+def _create_db_restore_point(dump_dir):
+    """ Instead of a dump, record where the database was when we moved on
+    from the version in dump_dir - rollback can't restore this, but it tells
+    you where to start from (the binary log position and the latest daily
+    dump) if you need to. """
+    if _can_dump_db():
+        with cd(dump_dir):
+            with settings(warn_only=True):
+                _tasks('create_restore_point:db_restore_point.json,dump_dir=%s' %
+                       env.dump_dir, read_only=True)
+
+
+def _dump_db_in_background(dump_dir):
+    """ Start a dump of a consistent snapshot of the database into dump_dir,
+    without waiting for it to finish.  The site carries on working while the
+    dump runs.  The output goes to db_dump.log, and the exit code to
+    db_dump.status when it has finished. """
+    if not _can_dump_db():
+        return
+    tasks_cmd = _get_tasks_bin()
+    if env.verbose:
+        tasks_cmd += ' -v'
+    with cd(dump_dir):
+        # no pty, or the dump would be killed when this command returns
+        sudo_or_run('rm -f db_dump.log db_dump.status && '
+                    '(nohup %s dump_db:db_dump.sql,single_transaction=true%s '
+                    '> db_dump.log 2>&1; echo $? > db_dump.status) '
+                    '> /dev/null 2>&1 &' % (tasks_cmd, _dump_db_args()),
+                    read_only=True, pty=False)
+
+
+def _wait_for_background_dump(dump_dir, snapshot_only=False):
+    """ Wait for the dump started by _dump_db_in_background() to finish, or
+    if snapshot_only is True, just until it has taken its snapshot. """
+    with cd(dump_dir):
+        if snapshot_only:
+            wait_cmd = ("while [ -f db_dump.log ] && [ ! -f db_dump.status ] && "
+                        "! grep -q -e '-- Retrieving table structure' db_dump.log; "
+                        "do sleep 1; done")
+        else:
+            wait_cmd = ("while [ -f db_dump.log ] && [ ! -f db_dump.status ]; "
+                        "do sleep 1; done")
+        wait_cmd += '; cat db_dump.status 2> /dev/null || true'
+        wait_start = datetime.now()
+        status = sudo_or_run(wait_cmd, read_only=True).strip()
+    if status not in ('', '0'):
+        utils.warn('The database dump failed - see %s' %
+                   path.join(dump_dir, 'db_dump.log'))
+    elif not snapshot_only:
+        utils.puts('Waited %.1f seconds for the database dump to finish' %
+                   (datetime.now() - wait_start).total_seconds())
 
 
 def _get_list_of_versions():
     require('server_project_home', provided_by=env.valid_envs)
+    _count_round_trip()
     with cd(env.server_project_home):
         versions = run('ls -1')
     # we're expecting timestamps, so this test will be safe until 2100
@@ -390,9 +876,10 @@ def delete_old_rollback_versions(keep=None):
     version_list = _get_list_of_versions()
     # mylist[:-6] would be the list missing the last 6 elements
     versions_to_delete = version_list[:versions_to_keep]
-    for version_to_delete in versions_to_delete:
-        sudo_or_run('rm -rf ' + path.join(
-            env.server_project_home, version_to_delete))
+    with _batched_commands():
+        for version_to_delete in versions_to_delete:
+            version_path = path.join(env.server_project_home, version_to_delete)
+            _queue_command('rm -rf ' + version_path, removes=[version_path])
 
 
 def list_versions():
@@ -407,10 +894,10 @@ def list_versions():
     utils.puts('Current version is %s' % env.vcs_root_dir_timestamp)
 
 
-def rollback(version='last', migrate=False, restore_db=False):
+def rollback(version='last', migrate=False, restore_db=False, shadow=None):
     """Redeploy one of the old versions.
 
-    Arguments are 'version', 'migrate' and 'restore_db':
+    Arguments are 'version', 'migrate', 'restore_db' and 'shadow':
 
     * if version is 'last' (the default) then the most recent version will be
       restored. Otherwise specify by timestamp - use list_versions to get a
@@ -420,6 +907,11 @@ def rollback(version='last', migrate=False, restore_db=False):
     * if migrate is True, then fabric will attempt to work out the new and old
       migration status and run the migrations to match the database versions.
       The default is False
+    * if shadow is True, the dump is restored into <database>_restore before
+      the webserver is stopped, and the tables are then swapped in.  The
+      current tables are kept in <database>_previous (use undo_db_swap to
+      put them back) rather than being dumped.  The default is the
+      db_restore_shadow setting.
 
     Note that migrate and restore_db cannot both be True."""
     require('server_project_home', 'vcs_root_dir', provided_by=env.valid_envs)
@@ -437,26 +929,61 @@ def rollback(version='last', migrate=False, restore_db=False):
         version = version_list[current_index - 1]
     # check version specified exists
     rollback_dir = path.join(env.server_project_home, version)
-    if not files.exists(rollback_dir):
+    if not _exists(rollback_dir):
         utils.abort("Cannot rollback to version %s, it does not exist, use"
                     "list_versions to see versions available" % version)
 
+    if shadow is None:
+        shadow = env.db_restore_shadow
+    if restore_db:
+        # the extension depends on the compressor used, or is .store for a
+        # dump in the dump store
+        with cd(rollback_dir):
+            dump_file = sudo_or_run('ls -1d db_dump.sql* 2> /dev/null | head -n 1',
+                                    read_only=True).strip()
+        if not dump_file:
+            if _exists(path.join(rollback_dir, 'db_restore_point.json')):
+                utils.abort('Cannot restore the database, there is no dump in '
+                            '%s - no migrations were run when moving on from '
+                            'this version, so the database does not need '
+                            'restoring (see db_restore_point.json there)'
+                            % rollback_dir)
+            utils.abort('Cannot restore the database, there is no dump in %s'
+                        % rollback_dir)
+        if shadow:
+            # the slow part, while the site is still up
+            with cd(rollback_dir):
+                _tasks(_restore_db_args(dump_file, env.db_restore_parallel,
+                                        task='restore_shadow_db'))
+
     webserver_cmd("stop")
-    # first make a db dump of the current state
-    _dump_db_in_directory(env.vcs_root_dir)
+    if not (restore_db and shadow):
+        # first make a db dump of the current state
+        _dump_db_in_directory(env.vcs_root_dir)
     if migrate:
         # run the south migrations back to the old version
         # but how to work out what the old version is??
         pass
     if restore_db:
-        # feed the dump file into mysql command
-        with cd(rollback_dir):
-            _tasks('load_dbdump')
+        if shadow:
+            _tasks('swap_db')
+        else:
+            # feed the dump file into mysql
+            with cd(rollback_dir):
+                _tasks(_restore_db_args(dump_file, env.db_restore_parallel))
     # change current link
-    if files.exists(env.current_link):
-        sudo_or_run('rm %s' % env.current_link)
-    with cd(env.server_project_home):
-        sudo_or_run('ln -s %s current' % version)
+    with _batched_commands():
+        _delete_file(env.current_link)
+        with cd(env.server_project_home):
+            _queue_command('ln -s %s current' % version,
+                           creates=[env.current_link])
+    webserver_cmd("start")
+
+
+def undo_db_swap():
+    """ put back the database tables that rollback(shadow=True) swapped out """
+    webserver_cmd("stop")
+    _tasks('swap_db:_previous')
     webserver_cmd("start")
 
 
@@ -498,11 +1025,13 @@ def _check_git_branch():
     with cd(env.vcs_root_dir):
         with settings(warn_only=True):
             # get branch information
-            server_branch = sudo_or_run('git rev-parse --abbrev-ref HEAD')
-            server_commit = sudo_or_run('git rev-parse HEAD')
+            server_branch = sudo_or_run('git rev-parse --abbrev-ref HEAD',
+                                        read_only=True)
+            server_commit = sudo_or_run('git rev-parse HEAD', read_only=True)
             local_branch = local('git rev-parse --abbrev-ref HEAD', capture=True)
             default_branch = env.default_branch.get(env.environment, 'master')
-            git_branch_r = sudo_or_run('git branch --color=never -r')
+            git_branch_r = sudo_or_run('git branch --color=never -r',
+                                       read_only=True)
             git_branch_r = git_branch_r.split('\n')
             branches = [b.split('/')[-1].strip() for b in git_branch_r if 'HEAD' not in b]
 
@@ -544,9 +1073,9 @@ def check_for_local_changes():
     if env.repo_type == 'cvs':
         print "TODO: write CVS status command"
         return
-    if files.exists(path.join(env.vcs_root_dir, "." + env.repo_type)):
+    if _exists(path.join(env.vcs_root_dir, "." + env.repo_type)):
         with cd(env.vcs_root_dir):
-            status = sudo_or_run(status_cmd[env.repo_type])
+            status = sudo_or_run(status_cmd[env.repo_type], read_only=True)
             if status:
                 print 'Found local changes on %s server' % env.environment
                 print status
@@ -587,7 +1116,7 @@ def _checkout_or_update_svn(vcs_root_dir, revision=None):
     # if the .svn directory exists, do an update, otherwise do
     # a checkout
     cmd = 'svn %s --non-interactive --no-auth-cache --username %s --password %s'
-    if files.exists(path.join(vcs_root_dir, ".svn")):
+    if _exists(path.join(vcs_root_dir, ".svn")):
         cmd = cmd % ('update', env.svnuser, env.svnpass)
         if revision:
             cmd += " --revision " + revision
@@ -607,7 +1136,7 @@ def _checkout_or_update_svn(vcs_root_dir, revision=None):
 def _checkout_or_update_git(vcs_root_dir, revision=None):
     # if the .git directory exists, do an update, otherwise do
     # a clone
-    if files.exists(path.join(vcs_root_dir, ".git")):
+    if _exists(path.join(vcs_root_dir, ".git")):
         with cd(vcs_root_dir):
             sudo_or_run('git remote rm origin')
             sudo_or_run('git remote add origin %s' % env.repository)
@@ -635,13 +1164,13 @@ def _checkout_or_update_git(vcs_root_dir, revision=None):
             sudo_or_run('git clone -b %s %s %s' %
                     (default_branch, env.repository, vcs_root_dir))
 
-    if files.exists(path.join(vcs_root_dir, ".gitmodules")):
+    if _exists(path.join(vcs_root_dir, ".gitmodules")):
         with cd(vcs_root_dir):
             sudo_or_run('git submodule update --init')
 
 
 def _checkout_or_update_cvs(vcs_root_dir, revision=None):
-    if files.exists(vcs_root_dir):
+    if _exists(vcs_root_dir):
         with cd(vcs_root_dir):
             sudo_or_run('CVS_RSH="ssh" cvs update -d -P')
     else:
@@ -665,28 +1194,275 @@ def _checkout_or_update_cvs(vcs_root_dir, revision=None):
                                                       env.cvs_project))
 
 
-def sudo_or_run(command):
+def sudo_or_run(command, read_only=False, pty=True):
+    """ Run the command, using sudo if env.use_sudo is set.
+
+    Unless read_only is True, we assume the command might have changed any
+    file, so the cache of which files exist is cleared."""
+    if not read_only:
+        _forget_remote_files()
+    _count_round_trip()
     if env.use_sudo:
-        return sudo(command)
+        return sudo(command, pty=pty)
+    else:
+        return run(command, pty=pty)
+
+
+#
+# Every sudo_or_run() or files.exists() is a separate ssh command (with its own
+# sudo handshake), which adds up on high latency links.  So we cache which
+# files exist, check lots of files with a single command and queue up changes
+# so they can be run together as one command.
+#
+def _remote_state():
+    """ The state we keep about the current host """
+    if 'remote_state' not in env:
+        env.remote_state = {}
+    return env.remote_state.setdefault(env.host_string, {
+        'exists': {},           # path: True/False
+        'permanent': set(),     # paths that won't change during the run
+        'queue': None,          # list of commands when batching
+        'round_trips': 0,
+    })
+
+
+def _count_round_trip(count=1):
+    _remote_state()['round_trips'] += count
+
+
+def _forget_remote_files(*paths):
+    """ Forget whether the paths exist (and anything inside them).  With no
+    paths, forget everything except the paths marked permanent. """
+    state = _remote_state()
+    for cached_path in state['exists'].keys():
+        if cached_path in state['permanent']:
+            continue
+        if not paths or [p for p in paths if cached_path == p or
+                         cached_path.startswith(p.rstrip('/') + '/')]:
+            del state['exists'][cached_path]
+
+
+def _forget_remote_files_on_all_hosts():
+    """ _forget_remote_files() for every host.  Commands run by execute() in
+    other processes (as parallel_deploy does) don't update our cache, so it
+    has to be cleared after them. """
+    for state in env.get('remote_state', {}).values():
+        for cached_path in state['exists'].keys():
+            if cached_path not in state['permanent']:
+                del state['exists'][cached_path]
+
+
+def _set_remote_file_exists(file_path, exists):
+    _forget_remote_files(file_path)
+    _remote_state()['exists'][file_path] = exists
+
+
+def _probe_remote_files(*paths, **kwargs):
+    """ Find out which of the paths exist with a single remote command and
+    cache the results.  If permanent=True the results are kept for the rest
+    of the run, however many other commands are run. """
+    state = _remote_state()
+    if kwargs.get('permanent', False):
+        state['permanent'].update(paths)
+    paths = [p for p in paths if p not in state['exists']]
+    if not paths:
+        return
+    # the same test that files.exists() does
+    script = '; '.join(['if test -e "$(echo %s)"; then echo 1; else echo 0; fi'
+                        % p for p in paths])
+    _count_round_trip()
+    with settings(hide('everything'), warn_only=True):
+        output = run(script)
+    results = [line.strip() for line in output.splitlines() if line.strip()]
+    if len(results) != len(paths):
+        utils.abort('Could not check which files exist on the server:\n%s'
+                    % output)
+    for file_path, result in zip(paths, results):
+        state['exists'][file_path] = (result == '1')
+
+
+def _exists(file_path):
+    """ files.exists(), but cached """
+    _probe_remote_files(file_path)
+    return _remote_state()['exists'][file_path]
+
+
+def _queue_command(command, creates=(), removes=()):
+    """ Run the command as part of the current batch (or straight away if we
+    are not batching).  creates and removes are the paths the command will
+    create or remove, so we can keep the file cache correct without asking
+    the server. """
+    state = _remote_state()
+    if state['queue'] is None:
+        sudo_or_run(command)
     else:
-        return run(command)
+        # cd() has to apply to the queued command, not where we are when we
+        # run the batch
+        if env.cwd:
+            command = 'cd %s && %s' % (env.cwd, command)
+        state['queue'].append(command)
+    for file_path in removes:
+        _set_remote_file_exists(file_path, False)
+    for file_path in creates:
+        _set_remote_file_exists(file_path, True)
+
+
+@contextmanager
+def _batched_commands():
+    """ Any commands queued with _queue_command() inside this block are run
+    as a single remote command at the end of the block.  The commands stop at
+    the first failure, as they would when run one by one. """
+    state = _remote_state()
+    if state['queue'] is not None:
+        # already batching - the outer block will run the commands
+        yield
+        return
+    state['queue'] = []
+    try:
+        yield
+        commands = state['queue']
+    finally:
+        state['queue'] = None
+    if commands:
+        # keep our idea of what exists, as the commands have told us
+        exists = dict(_remote_state()['exists'])
+        sudo_or_run(' && '.join(['(%s)' % c for c in commands]))
+        _remote_state()['exists'].update(exists)
+
+
+def _report_round_trips(round_trips=None):
+    """ round_trips is a dict of host: round trips, the default is the round
+    trips we have counted in this process """
+    if round_trips is None:
+        round_trips = dict((host, state['round_trips']) for (host, state) in
+                           env.get('remote_state', {}).items())
+    for host in sorted(round_trips):
+        utils.puts("%d remote commands were run on %s" %
+                   (round_trips[host], host), show_prefix=False)
 
 
 def create_deploy_virtualenv(in_next=False, rebuild_ve=True):
     """ if using new style dye stuff, create the virtualenv to hold dye """
     require('deploy_dir', provided_by=env.valid_envs)
-    if in_next:
-        # TODO: use relative_deploy_dir
-        bootstrap_path = path.join(env.next_dir, 'deploy', 'bootstrap.py')
-    else:
-        bootstrap_path = path.join(env.deploy_dir, 'bootstrap.py')
+    bootstrap_path = _get_bootstrap_path(in_next)
     if rebuild_ve:
         args = '--full-rebuild --quiet'
     else:
         args = '--quiet'
+    if env.wheelhouse_dir:
+        args += ' --wheelhouse=%s' % _get_wheelhouse(bootstrap_path)
     sudo_or_run('%s %s %s' % (_get_python(), bootstrap_path, args))
 
 
+def _get_bootstrap_path(in_next=False):
+    if in_next:
+        return path.join(env.next_dir, env.relative_deploy_dir, 'bootstrap.py')
+    return path.join(env.deploy_dir, 'bootstrap.py')
+
+
+def _wheelhouse_paths(bootstrap_path):
+    """ The name of the wheelhouse for the requirements the bootstrap.py at
+    bootstrap_path will install (and the python and platform of this host),
+    and the paths of the wheelhouse on this host and locally. """
+    req_hash = sudo_or_run('%s %s hash' % (_get_python(), bootstrap_path),
+                           read_only=True).strip().splitlines()[-1]
+    return (req_hash, path.join(env.wheelhouse_dir, req_hash),
+            path.join(env.local_wheelhouse_dir, req_hash))
+
+
+def _get_wheelhouse(bootstrap_path):
+    """ Make sure this host has a wheelhouse for the requirements the
+    bootstrap.py at bootstrap_path will install, and return its path.
+
+    The wheels are built once by _build_wheelhouse() and the local copy is
+    sent to each host that doesn't have them yet.  Wheelhouses are named
+    after the python, the platform and the hash of the requirements, so each
+    is only built once."""
+    req_hash, wheelhouse, local_wheelhouse = _wheelhouse_paths(bootstrap_path)
+    complete_file = path.join(wheelhouse, '.complete')
+    if _exists(complete_file):
+        return wheelhouse
+    _build_wheelhouse(bootstrap_path)
+    if _exists(complete_file):
+        # we built it here
+        return wheelhouse
+    if not path.exists(path.join(local_wheelhouse, '.complete')):
+        utils.abort('There is no local copy of the wheelhouse %s to send to '
+                    'this host' % req_hash)
+
+    # upload to a temporary directory and move it into place, so we never
+    # have a partial wheelhouse in place
+    upload_dir = path.join(env.wheelhouse_dir, 'upload-%s' % req_hash)
+    with _batched_commands():
+        _queue_command('rm -rf %s' % upload_dir)
+        _queue_command('mkdir -p %s' % upload_dir)
+    _count_round_trip()
+    put(local_wheelhouse, upload_dir, use_sudo=env.use_sudo)
+    _forget_remote_files(upload_dir)
+    with _batched_commands():
+        _queue_command('rm -rf %s' % wheelhouse)
+        _queue_command('mv %s %s' % (path.join(upload_dir, req_hash), wheelhouse),
+                       creates=[wheelhouse, complete_file])
+        _queue_command('rm -rf %s' % upload_dir)
+    return wheelhouse
+
+
+@runs_once
+def _build_wheelhouse(bootstrap_path):
+    """ Make sure there is a local copy of the wheelhouse in
+    env.local_wheelhouse_dir, building it if no host has it yet - locally if
+    env.wheelhouse_build is 'local', otherwise on this host.
+
+    This only runs once, however many hosts we deploy to - parallel_deploy
+    runs it before it forks, so the hosts don't all build the wheels and
+    write to the local copy at the same time.  The wheels are built in a
+    temporary directory and moved into place, so a failed build never leaves
+    a partial wheelhouse to be used next time. """
+    req_hash, wheelhouse, local_wheelhouse = _wheelhouse_paths(bootstrap_path)
+    complete_file = path.join(wheelhouse, '.complete')
+    if path.exists(path.join(local_wheelhouse, '.complete')):
+        return
+    if not path.exists(env.local_wheelhouse_dir):
+        os.makedirs(env.local_wheelhouse_dir)
+    local_build_dir = path.join(env.local_wheelhouse_dir, 'build-%s' % req_hash)
+    # anything left here is from a build that didn't finish
+    for partial_dir in (local_build_dir, local_wheelhouse):
+        if path.exists(partial_dir):
+            shutil.rmtree(partial_dir)
+
+    if not _exists(complete_file) and env.wheelhouse_build == 'local':
+        local_bootstrap = path.join(path.dirname(env.local_tasks_bin),
+                                    'bootstrap.py')
+        local_hash = local('python %s hash' % local_bootstrap,
+                           capture=True).strip().splitlines()[-1]
+        if local_hash != req_hash:
+            utils.abort('Your local requirements, python or platform are '
+                        'not the same as those being deployed to (%s here, '
+                        '%s there), so cannot build the wheels locally.  '
+                        'Update your local copy, or set wheelhouse_build to '
+                        '"first_host".' % (local_hash, req_hash))
+        local('python %s wheels --wheelhouse=%s' %
+              (local_bootstrap, local_build_dir))
+        os.rename(local_build_dir, local_wheelhouse)
+        return
+
+    if not _exists(complete_file):
+        build_dir = path.join(env.wheelhouse_dir, 'build-%s' % req_hash)
+        with _batched_commands():
+            _queue_command('rm -rf %s' % build_dir)
+            _queue_command('%s %s wheels --wheelhouse=%s' %
+                           (_get_python(), bootstrap_path, build_dir))
+            _queue_command('rm -rf %s' % wheelhouse)
+            _queue_command('mv %s %s' % (build_dir, wheelhouse),
+                           creates=[wheelhouse, complete_file])
+    # keep a copy to send to the other hosts
+    os.makedirs(local_build_dir)
+    _count_round_trip()
+    get(wheelhouse, local_build_dir)
+    os.rename(path.join(local_build_dir, req_hash), local_wheelhouse)
+    shutil.rmtree(local_build_dir)
+
+
 def update_requirements():
     """ update external dependencies on remote host """
     _tasks('update_ve')
@@ -705,30 +1481,273 @@ def clean_db(revision=None):
 
 
 def get_remote_dump(filename='/tmp/db_dump.sql', local_filename='./db_dump.sql',
-        rsync=True):
-    """ do a remote database dump and copy it to the local filesystem """
+        rsync=True, incremental=False, subset=None):
+    """ do a remote database dump and copy it to the local filesystem
+
+    With incremental, the dump is a directory with a file per table that is
+    kept on the server (in incremental_dump_dir) and locally (in
+    local_filename), and only the tables that have changed since the last
+    time are dumped and copied.
+
+    subset only dumps the data described by db_dump_subset in
+    project_settings.  It is on by default if db_dump_subset is set. """
     # future enhancement, do a mysqldump --skip-extended-insert (one insert
     # per line) and then do rsync rather than get() - less data transferred on
     # however rsync might need ssh keys etc
     require('user', 'host', provided_by=env.valid_envs)
+    if subset is None:
+        subset = bool(env.get('db_dump_subset'))
+    if subset and incremental:
+        utils.abort('get_remote_dump cannot do both incremental and subset')
+    subset_arg = ''
+    if subset:
+        subset_arg = ',subset=true'
+    if incremental:
+        _tasks('dump_db:%s,incremental=true,parallel=%s,compressor=%s' % (
+            env.incremental_dump_dir, env.db_dump_parallel or 1,
+            env.db_dump_compressor))
+        # --delete so tables that have been dropped go too
+        local("rsync -avz --delete -e 'ssh -p %s' %s@%s:%s/ %s/" % (env.port,
+            env.user, env.host, env.incremental_dump_dir, local_filename))
+        return
     if rsync:
-        _tasks('dump_db:' + filename + ',for_rsync=true')
+        _tasks('dump_db:' + filename + ',for_rsync=true' + subset_arg)
         local("rsync -vz -e 'ssh -p %s' %s@%s:%s %s" % (env.port,
             env.user, env.host, filename, local_filename))
     else:
-        _tasks('dump_db:' + filename)
+        _tasks('dump_db:' + filename + subset_arg)
         get(filename, local_path=local_filename)
     sudo_or_run('rm ' + filename)
 
 
 def get_remote_dump_and_load(filename='/tmp/db_dump.sql',
-        local_filename='./db_dump.sql', keep_dump=True, rsync=True):
+        local_filename='./db_dump.sql', keep_dump=True, rsync=True,
+        parallel=None, incremental=False, subset=None, stream=False,
+        resume_file='./db_dump_stream.state'):
     """ do a remote database dump, copy it to the local filesystem and then
-    load it into the local database """
-    get_remote_dump(filename=filename, local_filename=local_filename, rsync=rsync)
-    local(env.local_tasks_bin + ' restore_db:' + local_filename)
+    load it into the local database, using `parallel` connections (default
+    db_restore_parallel)
+
+    With stream, there is no dump file - see _stream_remote_dump_and_load() """
+    if stream:
+        _stream_remote_dump_and_load(subset, resume_file)
+        return
+    if parallel is None:
+        parallel = env.db_restore_parallel
+    get_remote_dump(filename=filename, local_filename=local_filename, rsync=rsync,
+                    incremental=incremental, subset=subset)
+    local(env.local_tasks_bin + ' ' + _restore_db_args(local_filename, parallel))
     if not keep_dump:
-        local('rm ' + local_filename)
+        local('rm -rf ' + local_filename)
+
+
+def refresh_db_from(source_environment, tables=None, skip_tables=None,
+                    compressor='gzip', subset=None, verify=False):
+    """ load the database from another environment into this one, straight
+    from server to server, eg
+
+        fab staging refresh_db_from:production
+
+    This server connects to the source server with ssh - using the ssh agent
+    forwarded from here, so your key needs to work for both - and the dump
+    is streamed through the connection into the local restore, compressed
+    with compressor ('none' to send it as it is).
+
+    tables and skip_tables are lists of tables separated by '+' to dump, or
+    to leave out.  subset is as for get_remote_dump.  If verify is True the
+    tables are then checked with verify_db_against. """
+    require('user', 'host', 'environment', provided_by=env.valid_envs)
+    if source_environment not in env.host_list:
+        utils.abort('%s not defined in project_settings.host_list' %
+                    source_environment)
+    if source_environment == env.environment:
+        utils.abort('refresh_db_from cannot load %s into itself' %
+                    source_environment)
+    if env.environment == 'production':
+        utils.abort('do not refresh the production database')
+    if subset is None:
+        subset = bool(env.get('db_dump_subset'))
+    source_host = env.host_list[source_environment][0]
+    source_port = None
+    if ':' in source_host:
+        source_host, source_port = source_host.split(':')
+
+    dump_args = 'dump_db:-,single_transaction=true'
+    if compressor != 'none':
+        dump_args += ',compressor=' + compressor
+    if tables:
+        dump_args += ',tables=' + tables
+    if skip_tables:
+        dump_args += ',skip_tables=' + skip_tables
+    if subset:
+        dump_args += ',subset=true'
+    # the deploy directory is in the same place on each server
+    dump_cmd = _get_tasks_bin() + ' ' + dump_args
+    if env.use_sudo:
+        # there is nothing to type a password into
+        dump_cmd = 'sudo -n ' + dump_cmd
+    ssh_cmd = 'ssh -o BatchMode=yes'
+    if source_port:
+        ssh_cmd += ' -p ' + source_port
+
+    with settings(forward_agent=True):
+        _count_round_trip()
+        # sudo does not pass on the agent socket, but root can use it
+        auth_sock = run('echo $SSH_AUTH_SOCK').strip()
+        if not auth_sock:
+            utils.abort('ssh agent forwarding is not working - is your key '
+                        'loaded with ssh-add?')
+        # a name of its own, so refreshes running at the same time (or for
+        # other projects) don't use each other's file
+        bytes_file = sudo_or_run('mktemp /tmp/refresh_db.XXXXXXXX',
+                                 read_only=True).strip().splitlines()[-1]
+        try:
+            pipeline = 'set -o pipefail; SSH_AUTH_SOCK=%s %s %s@%s "%s"' % (
+                auth_sock, ssh_cmd, env.user, source_host, dump_cmd)
+            if compressor != 'none':
+                pipeline += ' | dd bs=1M 2> %s | %s -dc' % (bytes_file, compressor)
+            else:
+                pipeline += ' | dd bs=1M 2> %s' % bytes_file
+            pipeline += ' | ' + _get_tasks_bin() + ' restore_db:-'
+            if env.db_restore_fast:
+                pipeline += ',fast=true'
+            start = datetime.now()
+            sudo_or_run(pipeline)
+            seconds = max((datetime.now() - start).total_seconds(), 0.001)
+            # dd ends with "<bytes> bytes (...) copied, ..."
+            transferred = sudo_or_run('tail -n 1 %s' % bytes_file,
+                                      read_only=True).split()[0]
+        finally:
+            sudo_or_run('rm -f %s' % bytes_file, read_only=True)
+    megabytes = int(transferred) / 1048576.0
+    utils.puts('Copied %.1f MB from %s in %.1f seconds (%.2f MB/s)' %
+               (megabytes, source_environment, seconds, megabytes / seconds))
+    if verify and not subset:
+        verify_db_against(source_environment, tables)
+
+
+def _db_checksums(tables=None):
+    """ {table: checksum} from tasks.py verify_db on the current host """
+    args = 'verify_db'
+    if tables:
+        args += ':tables=' + tables
+    output = _tasks(args, read_only=True)
+    return dict(re.findall(r'^checksum (\S+) (\S+)\s*$', output, re.MULTILINE))
+
+
+def verify_db_against(source_environment, tables=None):
+    """ check the database here has the same data as the database in
+    source_environment, by comparing the checksum of each table
+
+    tables is a list of tables separated by '+' to check (default all).
+    Tables that have been written to since the copy was made will be
+    different, of course. """
+    require('user', 'host', 'environment', provided_by=env.valid_envs)
+    if source_environment not in env.host_list:
+        utils.abort('%s not defined in project_settings.host_list' %
+                    source_environment)
+    start = datetime.now()
+    with settings(host_string='%s@%s' % (env.user,
+                                         env.host_list[source_environment][0])):
+        source_checksums = _db_checksums(tables)
+    checksums = _db_checksums(tables)
+    mismatches = []
+    for table in sorted(set(source_checksums) | set(checksums)):
+        if source_checksums.get(table) != checksums.get(table):
+            mismatches.append('%s: %s in %s, %s in %s' % (
+                table, source_checksums.get(table, 'missing'), source_environment,
+                checksums.get(table, 'missing'), env.environment))
+    if mismatches:
+        utils.abort('%d tables are different to %s:\n%s' % (
+            len(mismatches), source_environment, '\n'.join(mismatches)))
+    utils.puts('All %d tables match %s (checked in %.1f seconds)' % (
+        len(checksums), source_environment,
+        (datetime.now() - start).total_seconds()))
+
+
+def _stream_remote_dump_and_load(subset=None, resume_file='./db_dump_stream.state'):
+    """ Load the output of mysqldump on the server into the local database
+    as it arrives.  The dump is gzipped on the server, sent over the ssh
+    connection fabric already has and decompressed here, so the dump,
+    transfer and load all happen at the same time.
+
+    The local restore adds each table it finishes to resume_file.  If the
+    connection drops, running this again leaves those tables out. """
+    require('user', 'host', provided_by=env.valid_envs)
+    if subset is None:
+        subset = bool(env.get('db_dump_subset'))
+    skip_tables = []
+    if path.exists(resume_file):
+        skip_tables = [line.strip() for line in open(resume_file) if line.strip()]
+        utils.puts('Carrying on from %s - %d tables already loaded' %
+                   (resume_file, len(skip_tables)))
+
+    dump_cmd = '%s dump_db:-,compressor=gzip,single_transaction=true' % \
+        _get_tasks_bin()
+    if subset:
+        dump_cmd += ',subset=true'
+    if skip_tables:
+        dump_cmd += ',skip_tables=' + '+'.join(skip_tables)
+    # with no password to send, sudo -S would wait for one forever, so -n
+    # makes it fail straight away instead
+    sudo_needs_password = env.use_sudo and not env.password
+    if sudo_needs_password:
+        dump_cmd = 'sudo -n ' + dump_cmd
+    elif env.use_sudo:
+        # -S reads the password from the channel, and the empty prompt keeps
+        # it out of the dump
+        dump_cmd = "sudo -S -p '' " + dump_cmd
+
+    restore_cmd = env.local_tasks_bin + ' restore_db:-,resume_file=' + resume_file
+    if env.db_restore_fast:
+        restore_cmd += ',fast=true'
+    restore_proc = subprocess.Popen(restore_cmd, shell=True, stdin=subprocess.PIPE)
+    _count_round_trip()
+    channel = connections[env.host_string].get_transport().open_session()
+    # so we can keep reading stderr while waiting for the dump
+    channel.settimeout(1.0)
+    channel.exec_command(dump_cmd)
+    if env.use_sudo and env.password:
+        channel.sendall(env.password + '\n')
+
+    start = datetime.now()
+    received = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        while True:
+            while channel.recv_stderr_ready():
+                sys.stderr.write(channel.recv_stderr(65536))
+            try:
+                data = channel.recv(65536)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            received += len(data)
+            while data:
+                restore_proc.stdin.write(decompressor.decompress(data))
+                # a gzip stream can be more than one gzip file joined up
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        restore_proc.stdin.write(decompressor.flush())
+    finally:
+        restore_proc.stdin.close()
+        restore_returncode = restore_proc.wait()
+    dump_returncode = channel.recv_exit_status()
+    while channel.recv_stderr_ready():
+        sys.stderr.write(channel.recv_stderr(65536))
+    channel.close()
+
+    seconds = max((datetime.now() - start).total_seconds(), 0.001)
+    utils.puts('Received %.1f MB of compressed dump in %.1f seconds (%.2f MB/s)' %
+               (received / 1048576.0, seconds, received / 1048576.0 / seconds))
+    if dump_returncode != 0 and sudo_needs_password and not received:
+        utils.abort('sudo on %s could not run the dump without a password - '
+                    'give fab the password with -p' % env.host_string)
+    if dump_returncode != 0 or restore_returncode != 0:
+        utils.abort('The dump did not finish loading - run this again to carry '
+                    'on from the last table loaded')
 
 
 def update_db(force_use_migrations=False):
@@ -739,7 +1758,44 @@ def update_db(force_use_migrations=False):
 def setup_db_dumps():
     """ set up mysql database dumps """
     require('dump_dir', provided_by=env.valid_envs)
-    _tasks('setup_db_dumps:' + env.dump_dir)
+    store_args = ''
+    if env.db_dump_store:
+        # the same store as the deploy dumps, so they share chunks and are
+        # pruned together
+        store_args = ',store=%s,keep_days=%s,keep_count=%s' % (
+            env.db_dump_store_dir, env.db_dump_store_keep_days,
+            env.db_dump_store_keep_count)
+    _tasks('setup_db_dumps:%s,parallel=%s,compressor=%s%s%s' % (
+        env.dump_dir, env.db_dump_parallel, env.db_dump_compressor,
+        _low_impact_dump_args(), store_args))
+
+
+def setup_binlog_backups():
+    """ set up point in time backups - needs binary logging turned on in
+    the mysql server """
+    require('db_binlog_backup_dir', provided_by=env.valid_envs)
+    _tasks('setup_binlog_backups:%s,compressor=%s' % (
+        env.db_binlog_backup_dir, env.db_dump_compressor))
+
+
+def restore_db_to_time(stop_datetime):
+    """ restore the database as it was at stop_datetime, eg
+    restore_db_to_time:'2014-03-01 12:00:00' - from the backups made by
+    setup_binlog_backups """
+    require('db_binlog_backup_dir', provided_by=env.valid_envs)
+    # save the current state first, so this can be undone
+    _tasks('backup_binlogs:%s,compressor=%s' % (env.db_binlog_backup_dir,
+                                                env.db_dump_compressor))
+    webserver_cmd("stop")
+    _tasks("restore_db:%s,stop_datetime='%s'" % (env.db_binlog_backup_dir,
+                                                stop_datetime))
+    webserver_cmd("start")
+
+
+def list_db_dumps():
+    """ list the dumps in the dump store, and how much space they use """
+    require('db_dump_store_dir', provided_by=env.valid_envs)
+    _tasks('list_dumps:' + env.db_dump_store_dir, read_only=True)
 
 
 def touch_wsgi():
@@ -760,13 +1816,14 @@ def rm_pyc_files(py_dir=None):
 
 
 def _delete_file(path):
-    if files.exists(path):
-        sudo_or_run('rm %s' % path)
+    if _exists(path):
+        _queue_command('rm %s' % path, removes=[path])
 
 
 def _link_files(source_file, target_path):
-    if not files.exists(target_path):
-        sudo_or_run('ln -s %s %s' % (source_file, target_path))
+    if not _exists(target_path):
+        _queue_command('ln -s %s %s' % (source_file, target_path),
+                       creates=[target_path])
 
 
 def link_webserver_conf(maintenance=False):
@@ -774,30 +1831,44 @@ def link_webserver_conf(maintenance=False):
     require('vcs_root_dir', provided_by=env.valid_envs)
     if env.webserver is None:
         return
-    vcs_config_stub = path.join(env.vcs_root_dir, env.webserver, env.environment)
-    vcs_config_live = vcs_config_stub + '.conf'
-    vcs_config_maintenance = vcs_config_stub + '-maintenance.conf'
+    vcs_config_live, vcs_config_maintenance = _vcs_webserver_conf_paths()
     webserver_conf = _webserver_conf_path()
-
-    if maintenance:
-        _delete_file(webserver_conf)
-        if not files.exists(vcs_config_maintenance):
-            return
-        _link_files(vcs_config_maintenance, webserver_conf)
-    else:
-        if not files.exists(vcs_config_live):
-            utils.abort('No %s conf file found - expected %s' %
-                    (env.webserver, vcs_config_live))
-        _delete_file(webserver_conf)
-        _link_files(vcs_config_live, webserver_conf)
-
-    # debian has sites-available/sites-enabled split with links
-    if _linux_type() == 'debian':
-        webserver_conf_enabled = webserver_conf.replace('available', 'enabled')
-        sudo_or_run('ln -s %s %s' % (webserver_conf, webserver_conf_enabled))
+    _probe_webserver_conf_files()
+
+    with _batched_commands():
+        if maintenance:
+            _delete_file(webserver_conf)
+            if not _exists(vcs_config_maintenance):
+                return
+            _link_files(vcs_config_maintenance, webserver_conf)
+        else:
+            if not _exists(vcs_config_live):
+                utils.abort('No %s conf file found - expected %s' %
+                        (env.webserver, vcs_config_live))
+            _delete_file(webserver_conf)
+            _link_files(vcs_config_live, webserver_conf)
+
+        # debian has sites-available/sites-enabled split with links
+        if _linux_type() == 'debian':
+            webserver_conf_enabled = webserver_conf.replace('available', 'enabled')
+            _queue_command('ln -s %s %s' % (webserver_conf, webserver_conf_enabled),
+                           creates=[webserver_conf_enabled])
     webserver_configtest()
 
 
+def _vcs_webserver_conf_paths():
+    """ The live and maintenance webserver conf files in the VCS checkout """
+    vcs_config_stub = path.join(env.vcs_root_dir, env.webserver, env.environment)
+    return vcs_config_stub + '.conf', vcs_config_stub + '-maintenance.conf'
+
+
+def _probe_webserver_conf_files():
+    """ Check all the files link_webserver_conf() might look at at once """
+    if env.webserver is None:
+        return
+    _probe_remote_files(_webserver_conf_path(), *_vcs_webserver_conf_paths())
+
+
 def _webserver_conf_path():
     webserver_conf_dir = {
         'apache_redhat': '/etc/httpd/conf.d',
@@ -821,6 +1892,7 @@ def webserver_configtest():
     if env.webserver:
         key = env.webserver + '_' + _linux_type()
         if key in tests:
+            _count_round_trip()
             sudo(tests[key])
         else:
             utils.abort('webserver %s is not supported (linux type %s)' %
@@ -846,6 +1918,7 @@ def webserver_cmd(cmd):
     if env.webserver:
         key = env.webserver + '_' + _linux_type()
         if key in cmd_strings:
+            _count_round_trip()
             sudo(cmd_strings[key] + ' ' + cmd)
         else:
             utils.abort('webserver %s is not supported' % env.webserver)
@@ -1,9 +1,23 @@
 import os
 from os import path
+import datetime
+import json
+import multiprocessing
+import Queue
+import re
+import shutil
 import sqlite3
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import MySQLdb
 
-from .exceptions import InvalidArgumentError, InvalidProjectError
+from .dumpstore import DumpStore, POINTER_EXTENSION, open_pointer
+from .exceptions import (InvalidArgumentError, InvalidProjectError,
+                         ShellCommandError, TasksError)
 from .util import (_check_call_wrapper, _capture_command,
                    _call_command, _create_dir_if_not_exists,
                    CalledProcessError, _ask_for_password, _get_file_contents)
@@ -11,6 +25,784 @@ from .util import (_check_call_wrapper, _capture_command,
 # this is a global dictionary
 from .environment import env
 
+# the compressors dump_db can pipe through, as:
+# name: (file extension, compress command, decompress command)
+COMPRESSORS = {
+    'gzip': ('.gz', ['gzip', '-c'], ['gzip', '-dc']),
+    # multi-threaded gzip, producing normal .gz files
+    'pigz': ('.gz', ['pigz', '-c'], ['pigz', '-dc']),
+    'zstd': ('.zst', ['zstd', '-q', '-c', '-T0'], ['zstd', '-q', '-dc']),
+    'lz4': ('.lz4', ['lz4', '-q', '-c'], ['lz4', '-q', '-dc']),
+}
+
+# how much of the dump to read at a time
+DUMP_CHUNK_SIZE = 1024 * 1024
+# a fast restore wraps the dump in these, to turn off the checks that are
+# not needed when loading a dump, and to only commit at the end of each
+# table (mysqldump's LOCK/UNLOCK TABLES commit).  The settings are put back
+# at the end.
+FAST_RESTORE_START = """
+SET @FAST_RESTORE_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;
+SET @FAST_RESTORE_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;
+SET @FAST_RESTORE_AUTOCOMMIT=@@AUTOCOMMIT, AUTOCOMMIT=0;
+SET @FAST_RESTORE_BULK_INSERT_BUFFER_SIZE=@@BULK_INSERT_BUFFER_SIZE,
+    BULK_INSERT_BUFFER_SIZE=268435456;
+"""
+FAST_RESTORE_END = """
+COMMIT;
+SET FOREIGN_KEY_CHECKS=@FAST_RESTORE_FOREIGN_KEY_CHECKS,
+    UNIQUE_CHECKS=@FAST_RESTORE_UNIQUE_CHECKS,
+    AUTOCOMMIT=@FAST_RESTORE_AUTOCOMMIT,
+    BULK_INSERT_BUFFER_SIZE=@FAST_RESTORE_BULK_INSERT_BUFFER_SIZE;
+"""
+
+# the index of an indexed dump is the dump filename plus this
+DUMP_INDEX_EXTENSION = '.index'
+# the rough maximum size of each INSERT statement in a parallel dump
+DUMP_INSERT_SIZE = 1024 * 1024
+# how many rows to fetch from the server at a time in a parallel dump
+DUMP_FETCH_ROWS = 1000
+# how a parallel dump writes the data of each table - INSERT statements, or
+# the tab separated format LOAD DATA reads by default
+DUMP_FORMATS = ('sql', 'tab')
+TAB_ESCAPE_RE = re.compile(r'[\\\t\n\r\x00]')
+TAB_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\x00': '\\0'}
+# every sqlite database file starts with this
+SQLITE_HEADER = 'SQLite format 3\x00'
+# how many pages a sqlite backup copies before letting other connections in
+SQLITE_BACKUP_PAGES = 100
+# how many times a low impact parallel dump tries to get all its
+# connections onto the same snapshot
+SNAPSHOT_ATTEMPTS = 5
+# the list of base backups in a point in time backup directory
+BINLOG_BACKUP_MANIFEST = 'backup.json'
+# the binary log position that mysqldump --master-data=2 writes in the header
+BINLOG_POSITION_RE = re.compile(
+    r"^-- CHANGE (?:MASTER|REPLICATION SOURCE) TO "
+    r"(?:MASTER|SOURCE)_LOG_FILE='(?P<file>[^']+)', "
+    r"(?:MASTER|SOURCE)_LOG_POS=(?P<position>\d+);")
+
+# for picking apart mysqldump output
+SECTION_RE = re.compile(r'^-- (?P<section>.*)$')
+DUMPING_DATA_RE = re.compile(r'^Dumping data for table `(?P<table>[^`]+)`')
+TABLE_STRUCTURE_RE = re.compile(r'^Table structure for table `(?P<table>[^`]+)`')
+CREATE_TABLE_RE = re.compile(r'^CREATE TABLE `(?P<table>[^`]+)` \($')
+SECONDARY_KEY_RE = re.compile(r'^\s+(UNIQUE )?KEY ')
+CONSTRAINT_RE = re.compile(r'^\s+CONSTRAINT ')
+AUTO_INCREMENT_COLUMN_RE = re.compile(r'^\s+(?P<column>`[^`]+`) .* AUTO_INCREMENT')
+INSERT_RE = re.compile(r'^INSERT INTO `(?P<table>[^`]+)`')
+QUOTED_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'")
+
+
+def _command_exists(command):
+    for bin_dir in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(path.join(bin_dir, command), os.X_OK):
+            return True
+    return False
+
+
+def _lower_priority():
+    """ Run this process, and the commands it starts, at a low CPU and I/O
+    priority so a dump does not slow down the site """
+    os.nice(19)
+    if _command_exists('ionice'):
+        # best effort class rather than idle, so the dump does finish on a
+        # busy server
+        subprocess.call(['ionice', '-c', '2', '-n', '7', '-p', str(os.getpid())])
+
+
+class _Throttle(object):
+    """ Keeps the rate data goes through it, from any number of threads, to
+    megabytes_per_second by sleeping in wait() """
+
+    def __init__(self, megabytes_per_second):
+        self.bytes_per_second = float(megabytes_per_second) * 1024 * 1024
+        self.start = time.time()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def wait(self, new_bytes):
+        self.lock.acquire()
+        try:
+            self.total_bytes += new_bytes
+            due = self.start + self.total_bytes / self.bytes_per_second
+        finally:
+            self.lock.release()
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _throttled_lines(lines, throttle):
+    for line in lines:
+        throttle.wait(len(line))
+        yield line
+
+
+def _get_compressor(compressor):
+    """ Return (extension, compress command, decompress command) for the
+    compressor.  pigz falls back to gzip if it is not installed. """
+    if compressor not in COMPRESSORS:
+        raise InvalidArgumentError('Unknown compressor %s - use one of %s' %
+                                   (compressor, ', '.join(sorted(COMPRESSORS))))
+    if compressor == 'pigz' and not _command_exists('pigz'):
+        compressor = 'gzip'
+    return COMPRESSORS[compressor]
+
+
+def _compressor_for_filename(filename):
+    """ Return the name of the compressor for the file extension, or None
+    if the file is not compressed """
+    # sorted so .gz files always get gzip rather than pigz
+    for compressor in sorted(COMPRESSORS):
+        if filename.endswith(COMPRESSORS[compressor][0]):
+            return compressor
+    return None
+
+
+def _dump_compressor(dump_filename, compressor, store=None):
+    """ Return the filename and compressor for a dump.  The compressor's
+    extension is added to dump_filename, or if no compressor is given it is
+    chosen from the extension.  A dump to stdout ('-') is still compressed,
+    but a dump into a store is not, as the store compresses it itself. """
+    if store:
+        return dump_filename, None
+    if dump_filename == '-':
+        return dump_filename, compressor
+    if compressor:
+        extension = _get_compressor(compressor)[0]
+        if not dump_filename.endswith(extension):
+            dump_filename += extension
+        return dump_filename, compressor
+    return dump_filename, _compressor_for_filename(dump_filename)
+
+
+def _dump_stats(raw_bytes, file_bytes, seconds):
+    """ Return a one line report on how fast the dump was and how well it
+    compressed """
+    megabytes = raw_bytes / (1024.0 * 1024.0)
+    stats = '%.1f MB in %.1f seconds (%.1f MB/s)' % (
+        megabytes, seconds, megabytes / max(seconds, 0.001))
+    if file_bytes != raw_bytes:
+        stats += ', compressed to %.1f MB (ratio %.1f:1)' % (
+            file_bytes / (1024.0 * 1024.0), raw_bytes / float(max(file_bytes, 1)))
+    return stats
+
+
+class _CompressedFile(object):
+    """ A file that compresses everything written to it by piping it through
+    one of the COMPRESSORS (or not, if compressor is None), and counts how
+    much was written.  A filename of '-' writes to stdout. """
+
+    def __init__(self, filename, compressor=None):
+        self.filename = filename
+        self.raw_bytes = 0
+        if filename == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(filename, 'wb')
+        self.compress_proc = None
+        if compressor:
+            self.compress_proc = subprocess.Popen(
+                _get_compressor(compressor)[1],
+                stdin=subprocess.PIPE, stdout=self.file)
+            self.output = self.compress_proc.stdin
+        else:
+            self.output = self.file
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self.output.write(data)
+
+    def close(self):
+        """ Returns the exit code of the compressor """
+        returncode = 0
+        if self.compress_proc:
+            self.compress_proc.stdin.close()
+            returncode = self.compress_proc.wait()
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+        return returncode
+
+    def file_bytes(self):
+        if self.filename == '-':
+            # we can't tell how big the compressed output was
+            return self.raw_bytes
+        return path.getsize(self.filename)
+
+
+def _progress_line(label, done_bytes, total_bytes, seconds, width=30):
+    """ Return a progress bar showing how far through total_bytes we are """
+    fraction = min(float(done_bytes) / max(total_bytes, 1), 1.0)
+    rate = done_bytes / max(seconds, 0.001)
+    eta = int((total_bytes - done_bytes) / max(rate, 1))
+    return '%s [%-*s] %3d%% %.1f MB/s ETA %d:%02d' % (
+        label, width, '#' * int(fraction * width), fraction * 100,
+        rate / (1024.0 * 1024.0), eta / 60, eta % 60)
+
+
+class _ProgressBar(object):
+    """ Shows a progress bar on stderr, so a long restore is obviously
+    still going.  When stderr is not a terminal, it writes a line now and
+    then instead. """
+
+    def __init__(self, total_bytes, label):
+        self.total_bytes = total_bytes
+        self.label = label
+        self.done_bytes = 0
+        self.start = time.time()
+        self.last_shown = 0
+        self.is_tty = sys.stderr.isatty()
+        if self.is_tty:
+            self.interval = 0.5
+        else:
+            self.interval = 30
+
+    def update(self, new_bytes):
+        self.done_bytes += new_bytes
+        now = time.time()
+        if now - self.last_shown >= self.interval:
+            self.show(now)
+
+    def show(self, now):
+        self.last_shown = now
+        line = _progress_line(self.label, self.done_bytes, self.total_bytes,
+                              now - self.start)
+        if self.is_tty:
+            sys.stderr.write('\r' + line)
+        else:
+            sys.stderr.write(line + '\n')
+        sys.stderr.flush()
+
+    def finish(self):
+        self.show(time.time())
+        if self.is_tty:
+            sys.stderr.write('\n')
+
+
+def _copy_stream(source, dest, progress_bar=None, close_dest=False):
+    """ Copy from one file object to another until the end of source, or
+    until whatever is reading dest stops """
+    try:
+        try:
+            while True:
+                chunk = source.read(DUMP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dest.write(chunk)
+                if progress_bar:
+                    progress_bar.update(len(chunk))
+        except IOError:
+            # the reader has stopped, its exit code will say why
+            pass
+    finally:
+        if close_dest:
+            try:
+                dest.close()
+            except IOError:
+                pass
+
+
+def _run_in_parallel(func, items, worker_args):
+    """ Call func(worker_arg, item) for every item, with a thread for each
+    of worker_args taking the next item until there are none left.
+    Returns a list of error messages. """
+    item_queue = Queue.Queue()
+    for item in items:
+        item_queue.put(item)
+    errors = []
+
+    def worker(worker_arg):
+        while True:
+            try:
+                item = item_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(worker_arg, item)
+            except Exception as e:
+                errors.append('%s: %s' % (item, e))
+
+    threads = [threading.Thread(target=worker, args=(worker_arg,))
+               for worker_arg in worker_args]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def _compare_checksums(expected, actual, expected_label, actual_label):
+    """ Compare two {table: checksum} dicts and return a message for each
+    table that is different, or only in one of them """
+    mismatches = []
+    for table in sorted(set(expected) | set(actual)):
+        if table not in actual or actual[table] is None:
+            mismatches.append('%s: not in %s' % (table, actual_label))
+        elif table not in expected:
+            mismatches.append('%s: not in %s' % (table, expected_label))
+        elif expected[table] != actual[table]:
+            mismatches.append('%s: checksum %s in %s, %s in %s' % (
+                table, expected[table], expected_label, actual[table], actual_label))
+    return mismatches
+
+
+def _tab_field(value):
+    """ Return value, as MySQLdb fetched it, as a field of the tab separated
+    format LOAD DATA reads by default """
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.timedelta):
+        # TIME columns - str() would give "1 day, 2:00:00"
+        microseconds = (value.days * 86400 + value.seconds) * 1000000 + \
+            value.microseconds
+        sign = ''
+        if microseconds < 0:
+            sign, microseconds = '-', -microseconds
+        seconds, microseconds = divmod(microseconds, 1000000)
+        text = '%s%d:%02d:%02d' % (sign, seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
+        if microseconds:
+            text += '.%06d' % microseconds
+        return text
+    if isinstance(value, float):
+        text = repr(value)
+    elif isinstance(value, unicode):
+        text = value.encode('utf8')
+    elif isinstance(value, (set, frozenset)):
+        # SET columns
+        text = ','.join(sorted(value))
+    else:
+        text = str(value)
+    if TAB_ESCAPE_RE.search(text):
+        text = TAB_ESCAPE_RE.sub(lambda match: TAB_ESCAPES[match.group()], text)
+    return text
+
+
+def _count_insert_rows(line):
+    """ Count the rows in an extended INSERT statement, ignoring anything
+    that looks like a row separator inside a string """
+    return QUOTED_STRING_RE.sub('', line).count('),(') + 1
+
+
+def _split_mysqldump(dump_lines, data_dir):
+    """ Split the lines of a mysqldump file into the schema, which is
+    returned as a string, and a file in data_dir for the data of each table.
+    Each data file starts with the header of the dump, so it can be loaded
+    on its own.  Returns (schema, {table: (data filename, row count)}). """
+    header = []
+    schema = []
+    tables = {}
+    # where lines are going - None for the header
+    output = None
+    data_file = None
+    previous_line = None
+    try:
+        for line in dump_lines:
+            # sections start with "--", "-- <section name>", "--"
+            match = SECTION_RE.match(line)
+            if match and previous_line == '--\n':
+                data_match = DUMPING_DATA_RE.match(match.group('section'))
+                if data_file:
+                    data_file.close()
+                    data_file = None
+                if data_match:
+                    table = data_match.group('table')
+                    data_filename = path.join(data_dir, table + '.sql')
+                    data_file = open(data_filename, 'wb')
+                    data_file.writelines(header)
+                    tables[table] = [data_filename, 0]
+                    output = data_file
+                else:
+                    if output is None:
+                        schema.extend(header)
+                    output = schema
+            if output is None:
+                header.append(line)
+            elif output is data_file:
+                if line.startswith('INSERT INTO'):
+                    tables[table][1] += _count_insert_rows(line)
+                data_file.write(line)
+            else:
+                schema.append(line)
+            previous_line = line
+    finally:
+        if data_file:
+            data_file.close()
+    if output is None:
+        schema.extend(header)
+    return ''.join(schema), dict([(t, tuple(d)) for t, d in tables.items()])
+
+
+def _subset_where_clauses(tables, subset, foreign_keys, primary_keys):
+    """ Work out which rows of each table go in a subset dump.  subset is
+    the db_dump_subset setting from project_settings:
+
+    * 'structure_only': tables to dump without any rows
+    * 'where': {table: condition} to only dump some rows
+    * 'limit': {table: n} to dump at most n rows
+    * 'follow_foreign_keys': (default True) only dump rows whose foreign
+      keys refer to rows that are dumped, so the sample is consistent
+
+    foreign_keys is {table: [(columns, referenced table, referenced
+    columns), ...]} and primary_keys is {table: [columns]}.
+
+    Returns {table: value for mysqldump --where, or None for all rows} for
+    the tables that have data dumped. """
+    structure_only = set(subset.get('structure_only', []))
+    wheres = subset.get('where', {})
+    limits = subset.get('limit', {})
+    follow_foreign_keys = subset.get('follow_foreign_keys', True)
+    conditions = {}
+
+    def quote_columns(columns):
+        quoted = ', '.join(['`%s`' % c for c in columns])
+        if len(columns) > 1:
+            quoted = '(%s)' % quoted
+        return quoted
+
+    def order_and_limit(table):
+        clause = ''
+        if primary_keys.get(table):
+            clause += ' ORDER BY ' + ', '.join(['`%s`' % c for c in primary_keys[table]])
+        return clause + ' LIMIT %d' % int(limits[table])
+
+    def referenced_rows(table, columns, following):
+        """ SQL for the columns of the rows of table that are dumped, or
+        None if all of them are """
+        if table in structure_only:
+            return 'SELECT %s FROM `%s` WHERE 0' % (', '.join(['`%s`' % c for c in columns]), table)
+        condition = table_condition(table, following)
+        if condition is None and table not in limits:
+            return None
+        query = 'SELECT %s FROM `%s`' % (', '.join(['`%s`' % c for c in columns]), table)
+        if condition is not None:
+            query += ' WHERE ' + condition
+        if table in limits:
+            # MySQL does not allow LIMIT in an IN subquery, but it does
+            # in a derived table
+            query = 'SELECT * FROM (%s%s) AS `%s_sample`' % (
+                query, order_and_limit(table), table)
+        return query
+
+    def table_condition(table, following=()):
+        if table in conditions:
+            return conditions[table]
+        parts = []
+        if table in wheres:
+            parts.append('(%s)' % wheres[table])
+        if follow_foreign_keys:
+            for columns, referenced_table, referenced_columns in \
+                    foreign_keys.get(table, []):
+                # don't go round in circles
+                if referenced_table == table or referenced_table in following:
+                    continue
+                rows = referenced_rows(referenced_table, referenced_columns,
+                                       following + (table,))
+                if rows is None:
+                    continue
+                parts.append('(%s OR %s IN (%s))' % (
+                    ' OR '.join(['`%s` IS NULL' % c for c in columns]),
+                    quote_columns(columns), rows))
+        conditions[table] = ' AND '.join(parts) or None
+        return conditions[table]
+
+    where_clauses = {}
+    for table in tables:
+        if table in structure_only:
+            continue
+        condition = table_condition(table)
+        if table in limits:
+            condition = (condition or '1') + order_and_limit(table)
+        where_clauses[table] = condition
+    return where_clauses
+
+
+def _choose_base_backup(bases, stop_datetime=None):
+    """ Return the newest of the bases taken before stop_datetime (a string
+    like '2014-03-01 12:00:00'), or None """
+    candidates = [base for base in bases
+                  if stop_datetime is None or base['created'] <= stop_datetime]
+    if not candidates:
+        return None
+    return sorted(candidates, key=lambda base: base['created'])[-1]
+
+
+def _update_cron_file(cron_file, contents):
+    """ Write contents to cron_file, unless it has exactly that in it
+    already - so changes to the dump settings reach the cron jobs of an
+    existing install.  Returns whether the file was written. """
+    if path.exists(cron_file):
+        old_file = open(cron_file)
+        try:
+            if old_file.read() == contents:
+                return False
+        finally:
+            old_file.close()
+    # don't use "with" for compatibility with python 2.3 on whov2hinari
+    f = open(cron_file, 'w')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+    os.chmod(cron_file, 0755)
+    return True
+
+
+def _strip_compressor_extension(filename):
+    compressor = _compressor_for_filename(filename)
+    if compressor:
+        return filename[:-len(_get_compressor(compressor)[0])]
+    return filename
+
+
+def _binlogs_to_replay(base_binlog_file, binlog_filenames):
+    """ Return the (maybe compressed) binary logs to replay after a base
+    backup taken at base_binlog_file, in order.  The first must be
+    base_binlog_file itself, and there must be no gaps. """
+    binlogs = sorted([filename for filename in binlog_filenames
+                      if _strip_compressor_extension(filename) >= base_binlog_file],
+                     key=_strip_compressor_extension)
+    if not binlogs:
+        return []
+    expected = base_binlog_file
+    for filename in binlogs:
+        name = _strip_compressor_extension(filename)
+        if name != expected:
+            raise TasksError('Binary log %s is missing, so the logs after it '
+                             'cannot be replayed' % expected)
+        stem, number = name.rsplit('.', 1)
+        expected = '%s.%0*d' % (stem, len(number), int(number) + 1)
+    return binlogs
+
+
+def _filter_schema_tables(schema_sql, tables):
+    """ Return the header of schema_sql (as written by mysqldump) and the
+    sections for the tables in the list, leaving out the other tables,
+    views and routines """
+    lines = []
+    keep = True
+    # as in _write_indexed_dump()
+    held_line = None
+    for line in schema_sql.splitlines(True):
+        if held_line is not None:
+            match = SECTION_RE.match(line)
+            if match:
+                table_match = TABLE_STRUCTURE_RE.match(match.group('section'))
+                keep = (table_match is not None and
+                        table_match.group('table') in tables)
+            if keep:
+                lines.append(held_line)
+            held_line = None
+        if line == '--\n':
+            held_line = line
+        elif keep:
+            lines.append(line)
+    if held_line is not None and keep:
+        lines.append(held_line)
+    return ''.join(lines)
+
+
+def _strip_secondary_keys(schema_sql):
+    """ Remove the secondary keys and foreign keys from the CREATE TABLE
+    statements in schema_sql (as written by mysqldump) so the data loads
+    faster.  Returns the new schema and a dict of
+    table: (key definitions, foreign key definitions) to add afterwards. """
+    lines = []
+    stripped = {}
+    table = None
+    for line in schema_sql.splitlines(True):
+        if table is None:
+            match = CREATE_TABLE_RE.match(line)
+            if match:
+                table = match.group('table')
+                create_line = line
+                definitions = []
+            else:
+                lines.append(line)
+            continue
+        if not line.startswith(')'):
+            definitions.append(line.rstrip().rstrip(','))
+            continue
+        keys = [d.strip() for d in definitions if SECONDARY_KEY_RE.match(d)]
+        foreign_keys = [d.strip() for d in definitions if CONSTRAINT_RE.match(d)]
+        # an AUTO_INCREMENT column has to have a key, so leave the keys alone
+        # unless the primary key starts with it
+        auto_increment = [AUTO_INCREMENT_COLUMN_RE.match(d).group('column')
+                          for d in definitions if AUTO_INCREMENT_COLUMN_RE.match(d)]
+        if auto_increment and not [d for d in definitions if d.strip().startswith(
+                'PRIMARY KEY (%s' % auto_increment[0])]:
+            keys = []
+        if keys or foreign_keys:
+            stripped[table] = (keys, foreign_keys)
+            definitions = [d for d in definitions
+                           if d.strip() not in keys and d.strip() not in foreign_keys]
+        lines.append(create_line)
+        lines.append(',\n'.join(definitions) + '\n')
+        lines.append(line)
+        table = None
+    return ''.join(lines), stripped
+
+
+class _IndexedCompressedFile(object):
+    """ A compressed file written as a series of separately compressed
+    members - one for each table - with an index of where each member is,
+    so one table can be read without decompressing the rest.  gzip, zstd
+    and lz4 all decompress concatenated members as one stream, so the file
+    can be used like any other compressed dump.
+
+    The index is written to the filename plus DUMP_INDEX_EXTENSION, as
+    {"compressor": ..., "members": [{"table": ..., "offset": ...,
+    "length": ...}, ...]}.  The table is None for the header and anything
+    else that is not a table. """
+
+    def __init__(self, filename, compressor):
+        self.filename = filename
+        self.compressor = compressor
+        self.raw_bytes = 0
+        self.returncode = 0
+        self.members = []
+        self.file = open(filename, 'wb')
+        self.compress_proc = None
+
+    def start_member(self, table=None):
+        self._end_member()
+        self.members.append({'table': table, 'offset': self._file_size()})
+        self.compress_proc = subprocess.Popen(
+            _get_compressor(self.compressor)[1],
+            stdin=subprocess.PIPE, stdout=self.file)
+
+    def current_table(self):
+        if self.members:
+            return self.members[-1]['table']
+        return None
+
+    def write(self, data):
+        if self.compress_proc is None:
+            self.start_member()
+        self.raw_bytes += len(data)
+        self.compress_proc.stdin.write(data)
+
+    def _file_size(self):
+        # the compressors write straight to the file descriptor
+        self.file.flush()
+        return os.fstat(self.file.fileno()).st_size
+
+    def _end_member(self):
+        if self.compress_proc is not None:
+            self.compress_proc.stdin.close()
+            self.returncode = self.returncode or self.compress_proc.wait()
+            self.compress_proc = None
+            member = self.members[-1]
+            member['length'] = self._file_size() - member['offset']
+
+    def close(self):
+        """ Returns the exit code of the first compressor to fail, if any """
+        self._end_member()
+        self.file.close()
+        index_file = open(self.filename + DUMP_INDEX_EXTENSION, 'w')
+        try:
+            json.dump({'compressor': self.compressor, 'members': self.members},
+                      index_file, indent=2)
+        finally:
+            index_file.close()
+        return self.returncode
+
+    def file_bytes(self):
+        return path.getsize(self.filename)
+
+
+def _write_indexed_dump(dump_lines, output):
+    """ Write the lines of a mysqldump to an _IndexedCompressedFile, with a
+    new member for each table """
+    # sections start with "--", "-- <section name>", "--" so hold on to
+    # "--" until we know whether a new section is starting
+    held_line = None
+    for line in dump_lines:
+        if held_line is not None:
+            match = SECTION_RE.match(line)
+            if match:
+                section = match.group('section')
+                table_match = TABLE_STRUCTURE_RE.match(section)
+                if table_match:
+                    output.start_member(table_match.group('table'))
+                elif (output.current_table() is not None and
+                        not DUMPING_DATA_RE.match(section)):
+                    # views, routines etc
+                    output.start_member(None)
+            output.write(held_line)
+            held_line = None
+        if line == '--\n':
+            held_line = line
+        else:
+            output.write(line)
+    if held_line is not None:
+        output.write(held_line)
+
+
+def _dump_to_file(dump_cmd, dump_filename, compressor=None, report=True,
+                  indexed=False, throttle=None, output=None, cmd_env=None):
+    """ Run dump_cmd, sending the output through the compressor (if any) to
+    dump_filename without an intermediate file.  Returns the exit code.
+    dump_cmd can also be a list of commands, which are run one after the
+    other into the same file.
+
+    If indexed is True, the output of mysqldump is written with
+    _IndexedCompressedFile.  The output is read at the rate allowed by
+    throttle (a _Throttle), if given, which slows down dump_cmd too.
+
+    output is a file object to write to instead, with the same methods as
+    _CompressedFile, and cmd_env is the environment to run dump_cmd in. """
+    if dump_cmd and isinstance(dump_cmd[0], list):
+        dump_cmds = dump_cmd
+    else:
+        dump_cmds = [dump_cmd]
+    if output is not None:
+        pass
+    elif indexed:
+        output = _IndexedCompressedFile(dump_filename, compressor)
+    else:
+        output = _CompressedFile(dump_filename, compressor)
+    returncode = 0
+    try:
+        start = time.time()
+        for dump_cmd in dump_cmds:
+            dump_proc = subprocess.Popen(dump_cmd, stdout=subprocess.PIPE,
+                                         env=cmd_env)
+            try:
+                if indexed:
+                    # so the header of this dump is not part of the last
+                    # table of the previous one
+                    if output.current_table() is not None:
+                        output.start_member(None)
+                    dump_lines = iter(dump_proc.stdout.readline, '')
+                    if throttle:
+                        dump_lines = _throttled_lines(dump_lines, throttle)
+                    _write_indexed_dump(dump_lines, output)
+                else:
+                    while True:
+                        chunk = dump_proc.stdout.read(DUMP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if throttle:
+                            throttle.wait(len(chunk))
+                        output.write(chunk)
+            finally:
+                returncode = returncode or dump_proc.wait()
+    finally:
+        compress_returncode = output.close()
+    returncode = returncode or compress_returncode
+    if returncode == 0 and report:
+        # keep stdout for the dump if that is where it is going
+        report_file = sys.stdout
+        if dump_filename == '-':
+            report_file = sys.stderr
+        report_file.write('Dumped %s\n' % _dump_stats(
+            output.raw_bytes, output.file_bytes(), time.time() - start))
+    return returncode
+
 
 # the methods in this class are those used externally
 class DBManager(object):
@@ -25,20 +817,59 @@ class DBManager(object):
     def test_db_table_exists(self, table):
         raise NotImplementedError()
 
-    # these four are only required for fablib deploy, which is why I
-    # haven't implemented them for sqlite
-    def dump_db(self, dump_filename='db_dump.sql', for_rsync=False):
+    # these are only required for fablib deploy
+    def dump_db(self, dump_filename='db_dump.sql', for_rsync=False,
+                single_transaction=False, compressor=None, parallel=0,
+                incremental=False, subset=False, skip_tables=None,
+                tables=None, low_impact=False, bandwidth_limit=None,
+                store=None, checksums=False, data_format='sql'):
+        raise NotImplementedError()
+
+    def restore_db(self, dump_filename, parallel=0, tables=None,
+                   resume_file=None, fast=False, store=None,
+                   stop_datetime=None):
+        raise NotImplementedError()
+
+    def verify_db(self, manifest=None, workers=4, tables=None):
         raise NotImplementedError()
 
-    def restore_db(self, dump_filename):
+    def create_dbdump_cron_file(self, cron_file, dump_file_stub, parallel=0,
+                                compressor=None, low_impact=False,
+                                bandwidth_limit=None, store=None,
+                                keep_days=None, keep_count=None):
         raise NotImplementedError()
 
-    def create_dbdump_cron_file(self, cron_file, dump_file_stub):
+    def setup_db_dumps(self, dump_dir, parallel=0, compressor=None,
+                       low_impact=False, bandwidth_limit=None, store=None,
+                       keep_days=None, keep_count=None):
         raise NotImplementedError()
 
-    def setup_db_dumps(self, dump_dir):
+    # these are used by fablib rollback to restore a dump while the site
+    # is still up
+    def create_shadow_db(self, suffix='_restore'):
         raise NotImplementedError()
 
+    def swap_db(self, source_suffix='_restore', previous_suffix='_previous'):
+        raise NotImplementedError()
+
+    def drop_shadow_db(self, suffix='_restore'):
+        raise NotImplementedError()
+
+    # point in time backups, restored with restore_db(stop_datetime=...)
+    def backup_db_base(self, backup_dir, compressor='gzip', keep_bases=2):
+        raise NotImplementedError()
+
+    def backup_binlogs(self, backup_dir, compressor='gzip'):
+        raise NotImplementedError()
+
+    def setup_binlog_backups(self, backup_dir, compressor='gzip'):
+        raise NotImplementedError()
+
+    def get_binlog_position(self):
+        """ (binary log, position) the database has got to, or None if it
+        does not keep a binary log """
+        return None
+
 
 class SqliteManager(DBManager):
 
@@ -68,6 +899,202 @@ class SqliteManager(DBManager):
         finally:
             conn.close()
 
+    def _backup_to(self, backup_filename):
+        """ Copy the database to backup_filename with sqlite's online backup
+        API, which copies a few pages at a time so the site can carry on
+        using the database while it runs """
+        if not path.exists(self.file_path):
+            raise InvalidProjectError('There is no database at %s' % self.file_path)
+        if hasattr(sqlite3.Connection, 'backup'):
+            source = sqlite3.connect(self.file_path)
+            try:
+                dest = sqlite3.connect(backup_filename)
+                try:
+                    source.backup(dest, pages=SQLITE_BACKUP_PAGES)
+                finally:
+                    dest.close()
+            finally:
+                source.close()
+            return
+        # python 2's sqlite3 has no backup(), but the sqlite3 shell's .backup
+        # uses the same API
+        if not _command_exists('sqlite3'):
+            raise InvalidProjectError(
+                'Install the sqlite3 command line tool to dump sqlite databases')
+        returncode = subprocess.call(['sqlite3', self.file_path,
+                                      ".backup '%s'" % backup_filename])
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to back up %s: returned %s' % (self.file_path, returncode),
+                returncode)
+
+    def dump_db(self, dump_filename='db_dump.sql', for_rsync=False,
+                single_transaction=False, compressor=None, parallel=0,
+                incremental=False, subset=False, skip_tables=None,
+                tables=None, low_impact=False, bandwidth_limit=None,
+                store=None, checksums=False, data_format='sql'):
+        """Copy the database to dump_filename with the online backup API
+        (see _backup_to()), so the dump does not stop the site writing to
+        the database.  The dump is a sqlite database rather than SQL, and
+        is always a consistent snapshot.
+
+        compressor, low_impact and bandwidth_limit are as for
+        MySQLManager.dump_db(), and a dump_filename of '-' sends the dump to
+        stdout.  The other options are not supported for sqlite."""
+        if (int(parallel) > 0 or incremental or subset or skip_tables or
+                tables or store or checksums or data_format != 'sql'):
+            raise InvalidArgumentError(
+                'sqlite dumps can only use compressor, low_impact and '
+                'bandwidth_limit')
+        if low_impact:
+            _lower_priority()
+        throttle = None
+        if bandwidth_limit:
+            throttle = _Throttle(bandwidth_limit)
+        if dump_filename == '-':
+            backup_dir = None
+        else:
+            if compressor:
+                extension = _get_compressor(compressor)[0]
+                if not dump_filename.endswith(extension):
+                    dump_filename += extension
+            else:
+                compressor = _compressor_for_filename(dump_filename)
+            backup_dir = path.dirname(path.abspath(dump_filename))
+        start = time.time()
+        fd, backup_filename = tempfile.mkstemp(dir=backup_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            self._backup_to(backup_filename)
+            if dump_filename != '-' and not compressor:
+                os.rename(backup_filename, dump_filename)
+                raw_bytes = file_bytes = path.getsize(dump_filename)
+            else:
+                # so an old dump is only replaced by a complete one
+                output_filename = dump_filename
+                if dump_filename != '-':
+                    output_filename += '.tmp'
+                output = _CompressedFile(output_filename, compressor)
+                backup_file = open(backup_filename, 'rb')
+                try:
+                    while True:
+                        chunk = backup_file.read(DUMP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if throttle:
+                            throttle.wait(len(chunk))
+                        output.write(chunk)
+                finally:
+                    backup_file.close()
+                    returncode = output.close()
+                if returncode != 0:
+                    raise ShellCommandError(
+                        'Failed to compress dump of %s: returned %s' %
+                        (self.file_path, returncode), returncode)
+                raw_bytes, file_bytes = output.raw_bytes, output.file_bytes()
+                if dump_filename != '-':
+                    os.rename(output_filename, dump_filename)
+        finally:
+            if path.exists(backup_filename):
+                os.remove(backup_filename)
+        # keep stdout for the dump if that is where it is going
+        report_file = sys.stdout
+        if dump_filename == '-':
+            report_file = sys.stderr
+        report_file.write('Dumped %s\n' % _dump_stats(
+            raw_bytes, file_bytes, time.time() - start))
+
+    def restore_db(self, dump_filename, parallel=0, tables=None,
+                   resume_file=None, fast=False, store=None,
+                   stop_datetime=None):
+        """Put back a dump written by dump_db(), decompressing it if the
+        extension says it is compressed.  The dump is written next to the
+        database and renamed over it, so the database is swapped in one go.
+        A dump_filename of '-' reads the dump from stdin.
+
+        parallel and fast make no difference to sqlite, and the other
+        options are not supported."""
+        if (tables or resume_file or store or stop_datetime or
+                dump_filename.endswith(POINTER_EXTENSION)):
+            raise InvalidArgumentError(
+                'sqlite dumps can only be restored whole, from a file or stdin')
+        if dump_filename == '-':
+            dump_file = sys.stdin
+            compressor = None
+        else:
+            dump_file = open(dump_filename, 'rb')
+            compressor = _compressor_for_filename(dump_filename)
+        fd, restore_filename = tempfile.mkstemp(
+            dir=path.dirname(self.file_path), prefix='.restore-')
+        try:
+            restore_file = os.fdopen(fd, 'wb')
+            try:
+                if compressor:
+                    returncode = subprocess.call(_get_compressor(compressor)[2],
+                                                 stdin=dump_file, stdout=restore_file)
+                    if returncode != 0:
+                        raise ShellCommandError(
+                            'Failed to decompress %s: returned %s' %
+                            (dump_filename, returncode), returncode)
+                else:
+                    _copy_stream(dump_file, restore_file)
+            finally:
+                restore_file.close()
+                if dump_file is not sys.stdin:
+                    dump_file.close()
+            if open(restore_filename, 'rb').read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                raise InvalidArgumentError(
+                    '%s is not a sqlite database dump' % dump_filename)
+            if path.exists(self.file_path):
+                # so the webserver can still write to it
+                old_stat = os.stat(self.file_path)
+                os.chmod(restore_filename, old_stat.st_mode)
+                try:
+                    os.chown(restore_filename, old_stat.st_uid, old_stat.st_gid)
+                except OSError:
+                    pass
+            # the journal of the old database would corrupt the new one
+            for suffix in ('-wal', '-shm', '-journal'):
+                if path.exists(self.file_path + suffix):
+                    os.remove(self.file_path + suffix)
+            os.rename(restore_filename, self.file_path)
+        finally:
+            if path.exists(restore_filename):
+                os.remove(restore_filename)
+
+    def create_dbdump_cron_file(self, cron_file, dump_file_stub, parallel=0,
+                                compressor=None, low_impact=False,
+                                bandwidth_limit=None, store=None,
+                                keep_days=None, keep_count=None):
+        if int(parallel) > 0 or store:
+            raise InvalidArgumentError(
+                'sqlite dumps cannot be parallel or use a store')
+        dump_args = ''
+        if compressor:
+            dump_args += ',compressor=%s' % compressor
+        if low_impact:
+            dump_args += ',low_impact=true'
+        if bandwidth_limit:
+            dump_args += ',bandwidth_limit=%s' % bandwidth_limit
+        cron_file.write('#!/bin/sh\n')
+        cron_file.write('%s dump_db:%s`/bin/date +\\%%d`.sqlite%s\n' % (
+            path.join(env['deploy_dir'], 'tasks.py'), dump_file_stub, dump_args))
+
+    def setup_db_dumps(self, dump_dir, parallel=0, compressor=None,
+                       low_impact=False, bandwidth_limit=None, store=None,
+                       keep_days=None, keep_count=None):
+        """ set up daily sqlite database dumps in /etc/cron.daily """
+        if not path.isabs(dump_dir):
+            raise InvalidArgumentError(
+                'dump_dir must be an absolute path, you gave %s' % dump_dir)
+        cron_file = path.join('/etc', 'cron.daily', 'dump_' + env['project_name'])
+        _create_dir_if_not_exists(dump_dir)
+        contents = StringIO.StringIO()
+        self.create_dbdump_cron_file(contents, path.join(dump_dir, 'daily-dump-'),
+                                     parallel, compressor, low_impact,
+                                     bandwidth_limit, store)
+        _update_cron_file(cron_file, contents.getvalue())
+
 
 class MySQLManager(DBManager):
 
@@ -179,6 +1206,19 @@ class MySQLManager(DBManager):
         cmdline_args.append(self.name)
         return cmdline_args
 
+    def _create_root_cmdline_args(self):
+        """ Like create_cmdline_args() but for the root user, and with no
+        database """
+        cmdline_args = [
+            '-u', 'root',
+            '-p%s' % self.get_root_password(),
+        ]
+        if self.host:
+            cmdline_args.append('--host=%s' % self.host)
+        if self.port:
+            cmdline_args.append('--port=%s' % self.port)
+        return cmdline_args
+
     def sql_exec(self, sql_cmd, db_name=None, capture_output=False):
         """execute a SQL statement using the mysql command line client.
         We do this rather than using the python libraries so this script can
@@ -266,32 +1306,1491 @@ class MySQLManager(DBManager):
     def drop_db(self):
         self.exec_as_root('DROP DATABASE IF EXISTS %s' % self.name)
 
-    def dump_db(self, dump_filename='db_dump.sql', for_rsync=False):
-        """Dump the database in the current working directory"""
+    def _sibling_db(self, suffix):
+        """ Return a MySQLManager for another database with the same user,
+        named after this one """
+        return MySQLManager(self.name + suffix, self.user, self.password,
+                            port=self.port, host=self.host,
+                            root_password=self.get_root_password(),
+                            grant_enabled=self.grant_enabled)
+
+    def _get_base_tables(self, db_name):
+        cursor = self.get_root_db_cursor()
+        try:
+            cursor.execute("SELECT table_name FROM information_schema.tables "
+                           "WHERE table_schema = %s AND table_type = 'BASE TABLE'",
+                           (db_name,))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def _get_triggers(self, db_name):
+        """ Return [(trigger, sql_mode, CREATE TRIGGER statement)] for the
+        triggers in db_name, in the order they fire """
+        cursor = self.get_root_db_cursor()
+        try:
+            cursor.execute("SELECT trigger_name FROM information_schema.triggers "
+                           "WHERE trigger_schema = %s "
+                           "ORDER BY event_object_table, action_order",
+                           (db_name,))
+            triggers = []
+            for (trigger,) in cursor.fetchall():
+                cursor.execute('SHOW CREATE TRIGGER `%s`.`%s`' % (db_name, trigger))
+                row = cursor.fetchone()
+                triggers.append((trigger, row[1], row[2]))
+            return triggers
+        finally:
+            cursor.close()
+
+    def _create_triggers(self, db_name, triggers):
+        """ Create triggers (as returned by _get_triggers()) in db_name """
+        cursor = self.get_root_db_cursor()
+        try:
+            cursor.execute('SELECT @@SESSION.sql_mode')
+            sql_mode = cursor.fetchone()[0]
+            cursor.execute('USE `%s`' % db_name)
+            try:
+                for trigger, trigger_sql_mode, create_sql in triggers:
+                    # the trigger behaves as it did under its own sql_mode
+                    cursor.execute('SET SESSION sql_mode = %s', (trigger_sql_mode,))
+                    cursor.execute(create_sql)
+            finally:
+                cursor.execute('SET SESSION sql_mode = %s', (sql_mode,))
+        finally:
+            cursor.close()
+
+    def create_shadow_db(self, suffix='_restore'):
+        """ Create an empty database next to this one, for restoring a dump
+        into while this one is still in use, and return a MySQLManager for
+        it.  Any existing database with that name is dropped. """
+        shadow = self._sibling_db(suffix)
+        shadow.drop_db()
+        shadow.create_db_if_not_exists()
+        shadow.grant_all_privileges_for_database()
+        return shadow
+
+    def swap_db(self, source_suffix='_restore', previous_suffix='_previous'):
+        """ Move the tables from the source database into this one, and the
+        tables currently in this one into the previous database, so they can
+        be swapped back.  This is one RENAME TABLE, so anything using the
+        database sees either all the old tables or all the new ones.
+
+        If source_suffix and previous_suffix are the same, the two sets of
+        tables are exchanged - so swap_db('_previous', '_previous') undoes a
+        swap.
+
+        MySQL cannot move tables with triggers to another database, so the
+        triggers are dropped first and created again afterwards, in the
+        database their tables have moved to. """
+        source = self._sibling_db(source_suffix)
+        previous = self._sibling_db(previous_suffix)
+        source_tables = self._get_base_tables(source.name)
+        if not source_tables:
+            raise InvalidArgumentError('There are no tables in %s to swap in' %
+                                       source.name)
+        live_tables = self._get_base_tables(self.name)
+        if source.name == previous.name:
+            # park the live tables in another database while the source
+            # tables move in
+            parking = self._sibling_db('_swap')
+        else:
+            parking = previous
+        parking.drop_db()
+        parking.create_db_if_not_exists()
+        parking.grant_all_privileges_for_database()
+
+        live_triggers = self._get_triggers(self.name)
+        source_triggers = self._get_triggers(source.name)
+        renames = [(self.name, table, parking.name) for table in live_tables]
+        renames += [(source.name, table, self.name) for table in source_tables]
+        if parking is not previous:
+            renames += [(parking.name, table, previous.name) for table in live_tables]
+        start = time.time()
+        self.exec_as_root(*(
+            ['DROP TRIGGER `%s`.`%s`' % (self.name, trigger[0])
+             for trigger in live_triggers] +
+            ['DROP TRIGGER `%s`.`%s`' % (source.name, trigger[0])
+             for trigger in source_triggers]))
+        self.exec_as_root('RENAME TABLE ' + ', '.join([
+            '`%s`.`%s` TO `%s`.`%s`' % (from_db, table, to_db, table)
+            for from_db, table, to_db in renames]))
+        self._create_triggers(self.name, source_triggers)
+        self._create_triggers(previous.name, live_triggers)
+        if parking is not previous:
+            parking.drop_db()
+        else:
+            # it is empty now
+            source.drop_db()
+        print 'Swapped %d tables from %s into %s in %.2f seconds, the old tables are in %s' % (
+            len(source_tables), source.name, self.name, time.time() - start,
+            previous.name)
+
+    def drop_shadow_db(self, suffix='_restore'):
+        """ Drop a database made by create_shadow_db() or swap_db() """
+        self._sibling_db(suffix).drop_db()
+
+    def dump_db(self, dump_filename='db_dump.sql', for_rsync=False,
+                single_transaction=False, compressor=None, parallel=0,
+                incremental=False, subset=False, skip_tables=None,
+                tables=None, low_impact=False, bandwidth_limit=None,
+                store=None, checksums=False, data_format='sql'):
+        """Dump the database in the current working directory.  A
+        dump_filename of '-' sends the dump to stdout.
+
+        The dump is compressed as it is written by compressor, one of
+        COMPRESSORS, and the compressor's extension is added to
+        dump_filename.  If compressor is not given it is chosen from the
+        extension of dump_filename, so db_dump.sql.gz is gzipped.  Compressed
+        dumps are indexed (see _IndexedCompressedFile) so restore_db can
+        restore some of the tables without reading the rest.
+
+        single_transaction dumps a consistent snapshot without locking the
+        tables, so the site can carry on using the database.  It also prints
+        progress on stderr - once "-- Retrieving table structure" appears the
+        snapshot has been taken.
+
+        If parallel is more than 0, dump_filename is a directory and the
+        tables are dumped from a consistent snapshot by that many
+        connections at once - see _dump_db_parallel().  incremental
+        (which implies parallel) only dumps the tables that have changed
+        since the last dump into that directory.
+
+        subset dumps only some of the data, as set by db_dump_subset in
+        project_settings - see _subset_where_clauses().
+
+        skip_tables is a list of tables (or a string with the tables
+        separated by '+') to leave out of the dump, and tables (in the same
+        form) is the only tables to dump.
+
+        low_impact is for dumping a busy database: the dump is of a snapshot
+        (as single_transaction) and runs at a low CPU and I/O priority.
+        bandwidth_limit is the most MB/s of (uncompressed) dump to write -
+        mysqldump, or the parallel dump connections, are slowed down to
+        match.
+
+        store is a DumpStore directory to write the dump into, so only the
+        parts that are different to the dumps already there take up space.
+        dump_filename plus POINTER_EXTENSION is then a small file saying
+        which dump in the store it is, which restore_db understands.  The
+        store compresses the dump itself, so compressor is not used.
+
+        checksums (which implies parallel) records the CHECKSUM TABLE of
+        each table in the manifest, taken from the same snapshot as the
+        data, so verify_db can check a restore of the dump.
+
+        data_format 'tab' (which implies parallel) writes the data of each
+        table as tab separated rows rather than INSERT statements, which
+        restore_db loads with LOAD DATA - much faster for big tables.  The
+        server the dump is restored into needs local_infile turned on."""
+        parallel = int(parallel)
+        if data_format not in DUMP_FORMATS:
+            raise InvalidArgumentError('data_format must be one of %s' %
+                                       ', '.join(DUMP_FORMATS))
+        if store and (parallel > 0 or dump_filename == '-'):
+            raise InvalidArgumentError(
+                'store cannot be used with parallel or incremental dumps, or stdout')
+        if low_impact:
+            _lower_priority()
+            single_transaction = True
+        throttle = None
+        if bandwidth_limit:
+            throttle = _Throttle(bandwidth_limit)
+        if incremental or checksums or data_format != 'sql':
+            parallel = max(parallel, 1)
+        if subset and parallel > 0:
+            raise InvalidArgumentError(
+                'subset cannot be used with parallel or incremental dumps')
+        if tables and (subset or parallel > 0):
+            raise InvalidArgumentError(
+                'tables cannot be used with subset, parallel or incremental dumps')
+        if parallel > 0:
+            self._dump_db_parallel(dump_filename, parallel,
+                                   compressor or 'gzip', for_rsync,
+                                   bool(incremental), throttle, bool(checksums),
+                                   data_format, bool(low_impact))
+            return
+
         dump_cmd = ['mysqldump'] + self.create_cmdline_args()
         # this option will mean that there will be one line per insert
         # thus making the dump file better for rsync, but slightly bigger
         if for_rsync:
             dump_cmd.append('--skip-extended-insert')
+        if single_transaction:
+            dump_cmd += ['--single-transaction', '--quick', '--verbose']
+        if isinstance(skip_tables, basestring):
+            skip_tables = skip_tables.split('+')
+        skip_tables = skip_tables or []
+        for table in skip_tables:
+            dump_cmd.append('--ignore-table=%s.%s' % (self.name, table))
+        if isinstance(tables, basestring):
+            tables = tables.split('+')
+        if tables:
+            # mysqldump takes the tables after the database name
+            dump_cmd += tables
+        if subset:
+            dump_cmd = self._create_subset_dump_cmds(dump_cmd, skip_tables)
 
-        dump_file = open(dump_filename, 'w')
+        dump_filename, compressor = _dump_compressor(dump_filename, compressor,
+                                                     store)
         if env['verbose']:
-            print 'Executing mysqldump command: %s\nSending stdout to %s' % \
-                (' '.join(dump_cmd), dump_filename)
-        _call_command(dump_cmd, stdout=dump_file)
-        dump_file.close()
+            sys.stderr.write('Executing mysqldump command: %s\nSending stdout to %s\n' %
+                (dump_cmd, dump_filename))
+        # an index needs a file we can write alongside
+        indexed = compressor is not None and dump_filename != '-'
+        output = None
+        if store:
+            dump_store = DumpStore(store)
+            output = dump_store.writer(dump_filename)
+        returncode = _dump_to_file(dump_cmd, dump_filename, compressor,
+                                   indexed=indexed, throttle=throttle,
+                                   output=output)
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to dump database %s: returned %s' % (self.name, returncode),
+                returncode)
+        if store:
+            dump_store.write_pointer(dump_filename, output.name)
+            print 'Stored as %s in %s - %d of %d chunks were new' % (
+                output.name, dump_store.store_dir, output.new_chunks,
+                len(output.chunks))
+
+    def _get_foreign_keys(self):
+        """ Return {table: [(columns, referenced table, referenced columns)]} """
+        cursor = self.get_user_db_cursor()
+        try:
+            cursor.execute(
+                "SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, "
+                "REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+                "FROM information_schema.KEY_COLUMN_USAGE "
+                "WHERE TABLE_SCHEMA = %s AND REFERENCED_TABLE_SCHEMA = %s "
+                "ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION",
+                (self.name, self.name))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        constraints = {}
+        for table, constraint, column, referenced_table, referenced_column in rows:
+            key = (table, constraint)
+            if key not in constraints:
+                constraints[key] = ([], referenced_table, [])
+            constraints[key][0].append(column)
+            constraints[key][2].append(referenced_column)
+        foreign_keys = {}
+        for (table, constraint) in sorted(constraints):
+            foreign_keys.setdefault(table, []).append(constraints[(table, constraint)])
+        return foreign_keys
+
+    def _get_primary_keys(self):
+        """ Return {table: [primary key columns]} """
+        cursor = self.get_user_db_cursor()
+        try:
+            cursor.execute(
+                "SELECT TABLE_NAME, COLUMN_NAME "
+                "FROM information_schema.KEY_COLUMN_USAGE "
+                "WHERE TABLE_SCHEMA = %s AND CONSTRAINT_NAME = 'PRIMARY' "
+                "ORDER BY TABLE_NAME, ORDINAL_POSITION", (self.name,))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        primary_keys = {}
+        for table, column in rows:
+            primary_keys.setdefault(table, []).append(column)
+        return primary_keys
+
+    def _create_subset_dump_cmds(self, dump_cmd, skip_tables=()):
+        """ Return the mysqldump commands for a subset dump: one for the
+        schema, one for the tables with all their rows and one for each of
+        the other tables with the rows to dump """
+        if not env.get('db_dump_subset'):
+            raise InvalidProjectError(
+                'Set db_dump_subset in project_settings to do a subset dump')
+        tables = [t for t in self._get_tables_by_size() if t not in skip_tables]
+        where_clauses = _subset_where_clauses(
+            tables, env['db_dump_subset'],
+            self._get_foreign_keys(), self._get_primary_keys())
+        # all the commands should see the same data, as far as they can
+        if '--single-transaction' not in dump_cmd:
+            dump_cmd = dump_cmd + ['--single-transaction', '--quick']
+        dump_cmds = [dump_cmd + ['--no-data']]
+        all_rows = sorted([t for t, w in where_clauses.items() if w is None])
+        if all_rows:
+            dump_cmds.append(dump_cmd + ['--no-create-info'] + all_rows)
+        for table, where in sorted(where_clauses.items()):
+            if where is not None:
+                dump_cmds.append(dump_cmd + ['--no-create-info', '--where=' + where, table])
+        return dump_cmds
+
+    def _get_tables_by_size(self):
+        """ Return the names of the tables (not views), biggest first """
+        cursor = self.get_user_db_cursor()
+        try:
+            cursor.execute(
+                "SELECT TABLE_NAME FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE' "
+                "ORDER BY DATA_LENGTH DESC", (self.name,))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def _create_snapshot_connection(self):
+        """ Return a connection with a transaction open on a consistent
+        snapshot of the database """
+        conn = self.create_db_connection(
+            user=self.user,
+            passwd=self.password,
+            db=self.name,
+            charset='utf8',
+            use_unicode=False
+        )
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+        finally:
+            cursor.close()
+        return conn
+
+    def _restart_snapshot(self, conn):
+        """ Move the connection on to a new snapshot, and return where its
+        snapshot is in the binary log - or None if the server can't say
+        (only MariaDB can) """
+        cursor = conn.cursor()
+        try:
+            cursor.execute('ROLLBACK')
+            cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+            cursor.execute("SHOW STATUS LIKE 'binlog_snapshot_%'")
+            status = dict(cursor.fetchall())
+        finally:
+            cursor.close()
+        if not status.get('binlog_snapshot_file'):
+            return None
+        return (status['binlog_snapshot_file'],
+                int(status['binlog_snapshot_position']))
+
+    def _lock_for_snapshot(self, cursor, low_impact):
+        """ Take the lock the parallel dump connections open their snapshots
+        under, and return the statement that releases it (or None).
+
+        Normally that is FLUSH TABLES WITH READ LOCK, which stops all writes
+        until the schema has been dumped.  A low_impact dump never stops
+        writes: it takes LOCK INSTANCE FOR BACKUP (MySQL 8.0), which only
+        stops changes to the schema, where the server has it.  Tables that
+        are not InnoDB have no snapshot, so are not dumped consistently. """
+        if not low_impact:
+            cursor.execute('FLUSH TABLES WITH READ LOCK')
+            return 'UNLOCK TABLES'
+        cursor.execute(
+            "SELECT TABLE_NAME FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE' "
+            "AND ENGINE != 'InnoDB'", (self.name,))
+        other_tables = [row[0] for row in cursor.fetchall()]
+        if other_tables:
+            print 'Warning: these tables are not InnoDB, so will not be ' \
+                'dumped from the same snapshot as the others: %s' % \
+                ', '.join(other_tables)
+        try:
+            cursor.execute('LOCK INSTANCE FOR BACKUP')
+        except MySQLdb.Error:
+            return None
+        return 'UNLOCK INSTANCE'
+
+    def _sync_snapshots(self, conns, cursor):
+        """ For a low impact dump, which opens its snapshots without
+        stopping writes: restart the snapshots of all the connections until
+        they are all at the same place in the binary log, and return that
+        place (as SHOW MASTER STATUS would).  If the server can't say where
+        the snapshots are, or they never line up, the tables may be from
+        snapshots a moment apart - a transaction that changed two tables in
+        between would only be in one of them. """
+        for attempt in range(SNAPSHOT_ATTEMPTS):
+            positions = [self._restart_snapshot(conn) for conn in conns]
+            if None in positions:
+                break
+            if len(set(positions)) == 1:
+                return positions[0]
+        else:
+            print 'Warning: the dump connections could not get the same ' \
+                'snapshot, so the tables may be from a moment apart'
+        cursor.execute('SHOW MASTER STATUS')
+        return cursor.fetchone()
 
-    def restore_db(self, dump_filename):
-        """Restore a database dump file by name"""
+    def _dump_table(self, conn, table, dump_filename, compressor, for_rsync,
+                    throttle=None):
+        """ Write INSERT statements for every row of the table to
+        dump_filename.  The rows are read with a server side cursor, so the
+        table is never all in memory, at the rate allowed by throttle. """
+        output = _CompressedFile(dump_filename, compressor)
+        rows = 0
+        try:
+            output.write('SET NAMES utf8;\nSET FOREIGN_KEY_CHECKS=0;\n')
+            # for_rsync means one row per INSERT, like --skip-extended-insert
+            insert_size = 0 if for_rsync else DUMP_INSERT_SIZE
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            try:
+                cursor.execute('SELECT * FROM `%s`' % table)
+                values = []
+                values_size = 0
+                while True:
+                    fetched = cursor.fetchmany(DUMP_FETCH_ROWS)
+                    if not fetched:
+                        break
+                    for row in fetched:
+                        value = '(%s)' % ','.join([conn.literal(v) for v in row])
+                        values.append(value)
+                        values_size += len(value)
+                        if values_size >= insert_size:
+                            if throttle:
+                                throttle.wait(values_size)
+                            output.write('INSERT INTO `%s` VALUES %s;\n' %
+                                         (table, ','.join(values)))
+                            values = []
+                            values_size = 0
+                    rows += len(fetched)
+                if values:
+                    output.write('INSERT INTO `%s` VALUES %s;\n' %
+                                 (table, ','.join(values)))
+            finally:
+                cursor.close()
+        finally:
+            returncode = output.close()
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to compress dump of table %s: returned %s' %
+                (table, returncode), returncode)
+        return {
+            'file': path.basename(dump_filename),
+            'rows': rows,
+            'bytes': output.raw_bytes,
+            'file_bytes': output.file_bytes(),
+        }
+
+    def _dump_table_tab(self, conn, table, dump_filename, compressor,
+                        throttle=None):
+        """ Write every row of the table to dump_filename in the tab
+        separated format of LOAD DATA, like _dump_table() """
+        output = _CompressedFile(dump_filename, compressor)
+        rows = 0
+        try:
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            try:
+                cursor.execute('SELECT * FROM `%s`' % table)
+                while True:
+                    fetched = cursor.fetchmany(DUMP_FETCH_ROWS)
+                    if not fetched:
+                        break
+                    data = ''.join(['\t'.join([_tab_field(v) for v in row]) + '\n'
+                                    for row in fetched])
+                    if throttle:
+                        throttle.wait(len(data))
+                    output.write(data)
+                    rows += len(fetched)
+            finally:
+                cursor.close()
+        finally:
+            returncode = output.close()
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to compress dump of table %s: returned %s' %
+                (table, returncode), returncode)
+        return {
+            'file': path.basename(dump_filename),
+            'rows': rows,
+            'bytes': output.raw_bytes,
+            'file_bytes': output.file_bytes(),
+        }
+
+    def _checksum_table(self, conn, table):
+        cursor = conn.cursor()
+        try:
+            cursor.execute('CHECKSUM TABLE `%s`' % table)
+            return cursor.fetchone()[1]
+        finally:
+            cursor.close()
+
+    def _get_previous_dump_tables(self, dump_dir, compressor, for_rsync,
+                                  data_format='sql'):
+        """ Return the tables from the manifest of the dump in dump_dir, if
+        the table files in it can be reused for a new dump """
+        manifest_path = path.join(dump_dir, 'manifest.json')
+        if not path.exists(manifest_path):
+            return {}
+        manifest = json.load(open(manifest_path))
+        if (manifest.get('compressor') != compressor or
+                manifest.get('for_rsync', False) != for_rsync or
+                manifest.get('format', 'sql') != data_format):
+            return {}
+        return manifest['tables']
+
+    def _dump_db_parallel(self, dump_dir, workers, compressor='gzip',
+                          for_rsync=False, incremental=False, throttle=None,
+                          checksums=False, data_format='sql', low_impact=False):
+        """ Dump the database into the directory dump_dir, with `workers`
+        connections dumping tables at the same time.  The directory contains:
+
+        * schema.sql - the tables, views etc with no data
+        * triggers.sql - the triggers, to be created after the data is loaded
+        * one file per table with the data, compressed by compressor - as
+          INSERT statements, or tab separated rows if data_format is 'tab'
+        * manifest.json - the files, row counts and the binlog position
+
+        All the connections read from the same snapshot: they start their
+        transactions while the root user holds FLUSH TABLES WITH READ LOCK,
+        which is released as soon as the schema has been dumped.  That
+        stops all writes for a moment, so a low_impact dump doesn't take it,
+        and lines the snapshots up afterwards instead - see
+        _lock_for_snapshot() and _sync_snapshots() for what that costs in
+        consistency.
+
+        If incremental is True the manifest also has the CHECKSUM TABLE of
+        each table, and a table with the same checksum as in the dump
+        already in dump_dir is not dumped again - the old file is hard
+        linked into the new dump.  So rsync will only copy the tables that
+        have changed.
+
+        throttle (a _Throttle) limits the rate all the connections dump at
+        between them, and checksums puts the checksums in the manifest
+        without incremental. """
+        extension = _get_compressor(compressor)[0]
+        data_extension = '.txt' if data_format == 'tab' else '.sql'
+        # dump into a temporary directory so an old dump is only replaced
+        # by a complete one
+        dump_dir = dump_dir.rstrip('/')
+        tmp_dir = dump_dir + '.tmp'
+        if path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        previous_tables = {}
+        if incremental:
+            previous_tables = self._get_previous_dump_tables(
+                dump_dir, compressor, for_rsync, data_format)
+
+        start = time.time()
+        tables = self._get_tables_by_size()
+        conns = []
+        try:
+            root_cursor = self.get_root_db_cursor()
+            try:
+                unlock = self._lock_for_snapshot(root_cursor, low_impact)
+                try:
+                    for i in range(min(workers, max(len(tables), 1))):
+                        conns.append(self._create_snapshot_connection())
+                    if low_impact:
+                        master_status = self._sync_snapshots(conns, root_cursor)
+                    else:
+                        root_cursor.execute('SHOW MASTER STATUS')
+                        master_status = root_cursor.fetchone()
+                    # we need the lock to get the schema that matches the data.
+                    # The triggers go in their own file so a restore can
+                    # create them after the data has been loaded
+                    schema_cmd = ['mysqldump'] + self.create_cmdline_args() + \
+                        ['--no-data', '--skip-lock-tables', '--routines',
+                         '--skip-triggers']
+                    returncode = _dump_to_file(schema_cmd,
+                        path.join(tmp_dir, 'schema.sql'), report=False)
+                    if returncode == 0:
+                        triggers_cmd = ['mysqldump'] + self.create_cmdline_args() + \
+                            ['--no-data', '--no-create-info', '--skip-opt',
+                             '--triggers']
+                        returncode = _dump_to_file(triggers_cmd,
+                            path.join(tmp_dir, 'triggers.sql'), report=False)
+                finally:
+                    if unlock:
+                        root_cursor.execute(unlock)
+            finally:
+                root_cursor.close()
+            if returncode != 0:
+                raise ShellCommandError(
+                    'Failed to dump schema of database %s: returned %s' %
+                    (self.name, returncode), returncode)
+
+            # the biggest tables are first so the workers finish at about the
+            # same time
+            table_details = {}
+            unchanged_tables = []
+
+            def dump_table(conn, table):
+                dump_filename = path.join(tmp_dir, table + data_extension + extension)
+                checksum = None
+                if incremental or checksums:
+                    checksum = self._checksum_table(conn, table)
+                if incremental:
+                    previous = previous_tables.get(table, {})
+                    previous_file = path.join(dump_dir, previous.get('file', ''))
+                    if (checksum is not None and
+                            previous.get('checksum') == checksum and
+                            path.isfile(previous_file)):
+                        os.link(previous_file, dump_filename)
+                        table_details[table] = previous
+                        unchanged_tables.append(table)
+                        return
+                if data_format == 'tab':
+                    table_details[table] = self._dump_table_tab(
+                        conn, table, dump_filename, compressor, throttle)
+                else:
+                    table_details[table] = self._dump_table(
+                        conn, table, dump_filename, compressor, for_rsync, throttle)
+                table_details[table]['checksum'] = checksum
+
+            errors = _run_in_parallel(dump_table, tables, conns)
+        finally:
+            for conn in conns:
+                conn.close()
+        if errors:
+            raise TasksError('Failed to dump tables from %s:\n%s' %
+                             (self.name, '\n'.join(errors)))
+
+        binlog_position = None
+        if master_status:
+            binlog_position = {
+                'file': master_status[0],
+                'position': master_status[1],
+            }
+        manifest = {
+            'database': self.name,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'compressor': compressor,
+            'for_rsync': for_rsync,
+            'format': data_format,
+            'schema': 'schema.sql',
+            'triggers': 'triggers.sql',
+            'binlog_position': binlog_position,
+            'tables': table_details,
+        }
+        manifest_file = open(path.join(tmp_dir, 'manifest.json'), 'w')
+        try:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        finally:
+            manifest_file.close()
+
+        if path.exists(dump_dir):
+            shutil.rmtree(dump_dir)
+        os.rename(tmp_dir, dump_dir)
+        dumped_tables = [details for table, details in table_details.items()
+                         if table not in unchanged_tables]
+        print 'Dumped %d tables with %d connections: %s' % (
+            len(dumped_tables), len(conns), _dump_stats(
+                sum([t['bytes'] for t in dumped_tables]),
+                sum([t['file_bytes'] for t in dumped_tables]),
+                time.time() - start))
+        if incremental:
+            print 'Kept %d unchanged tables from the previous dump' % \
+                len(unchanged_tables)
+
+    def restore_db(self, dump_filename, parallel=0, tables=None,
+                   resume_file=None, fast=False, store=None,
+                   stop_datetime=None):
+        """Restore a database dump file by name.  Compressed dumps are
+        decompressed on the fly, depending on the file extension.
+
+        fast turns off foreign key and unique checks and autocommit while
+        loading (see FAST_RESTORE_START), and checks the row counts of the
+        tables match the dump afterwards.
+
+        A dump_filename of '-' reads an uncompressed dump from stdin, and
+        records the tables it has loaded in resume_file - see
+        _restore_db_stream().
+
+        dump_filename can also be a directory written by
+        dump_db(parallel=N).  That, or a parallel of more than 0, uses
+        _restore_db_parallel() to load the tables on several connections.
+
+        tables is a list of tables (or a string with the tables separated by
+        '+') to restore, leaving the other tables alone.  It needs a
+        directory dump or an indexed dump file.
+
+        A dump in a DumpStore is restored from the pointer file dump_db
+        left (ending in POINTER_EXTENSION), or by its name in the store
+        directory `store`.  It is loaded on one connection.
+
+        If dump_filename is a directory of point in time backups (see
+        backup_db_base()), the database is restored as it was at
+        stop_datetime - or as recent as possible."""
+        parallel = int(parallel)
+        if isinstance(tables, basestring):
+            tables = tables.split('+')
+        fast = bool(fast)
+        if path.exists(path.join(dump_filename, BINLOG_BACKUP_MANIFEST)):
+            self._restore_point_in_time(dump_filename, stop_datetime, fast)
+            return
+        if stop_datetime:
+            raise InvalidArgumentError(
+                'stop_datetime needs a directory of point in time backups')
+        dump_file = dump_bytes = None
+        if store or dump_filename.endswith(POINTER_EXTENSION):
+            if tables:
+                raise InvalidArgumentError(
+                    'tables cannot be used with a dump in a store')
+            if store:
+                dump_store, dump_name = DumpStore(store), dump_filename
+            else:
+                dump_store, dump_name = open_pointer(dump_filename)
+            dump_file = dump_store.open_dump(dump_name)
+            dump_bytes = dump_store.dump_size(dump_name)
+            dump_filename = dump_name
+            parallel = 0
+        elif dump_filename == '-':
+            self._restore_db_stream(iter(sys.stdin.readline, ''), resume_file,
+                                    fast)
+            return
+        if dump_file is None and (parallel > 0 or path.isdir(dump_filename)):
+            self._restore_db_parallel(dump_filename, max(parallel, 1), tables,
+                                      fast)
+            return
+        if tables:
+            self._restore_tables_from_index(dump_filename, tables)
+            return
+        row_counts = None
+        if fast:
+            row_counts = {}
+        returncode = self._load_sql_file(dump_filename, fast=fast,
+                                         progress=True, row_counts=row_counts,
+                                         dump_file=dump_file,
+                                         dump_bytes=dump_bytes)
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to restore database %s: returned %s' % (self.name, returncode),
+                returncode)
+        if fast:
+            self._verify_row_counts(row_counts)
+
+    def _verify_row_counts(self, expected_rows):
+        """ Check each table has the number of rows in expected_rows """
+        # a new connection, so we don't see an old snapshot
+        self.close_user_db_connection()
+        cursor = self.get_user_db_cursor()
+        mismatches = []
+        try:
+            for table, rows in sorted(expected_rows.items()):
+                cursor.execute('SELECT COUNT(*) FROM `%s`' % table)
+                actual_rows = cursor.fetchone()[0]
+                if actual_rows != rows:
+                    mismatches.append('%s: %d rows in the dump, %d in the database'
+                                      % (table, rows, actual_rows))
+        finally:
+            cursor.close()
+            self.close_user_db_connection()
+        if mismatches:
+            raise TasksError('Row counts do not match after restoring %s:\n%s' %
+                             (self.name, '\n'.join(mismatches)))
+        print 'Row counts match the dump for %d tables' % len(expected_rows)
+
+    def _checksum_tables(self, tables, workers):
+        """ Return {table: CHECKSUM TABLE} for the tables, with `workers`
+        connections checksumming tables at the same time """
+        checksums = {}
+        conns = []
+        try:
+            for i in range(min(workers, max(len(tables), 1))):
+                conns.append(self.create_db_connection(
+                    user=self.user, passwd=self.password, db=self.name))
+
+            def checksum_table(conn, table):
+                checksums[table] = self._checksum_table(conn, table)
+
+            errors = _run_in_parallel(checksum_table, tables, conns)
+        finally:
+            for conn in conns:
+                conn.close()
+        if errors:
+            raise TasksError('Failed to checksum tables in %s:\n%s' %
+                             (self.name, '\n'.join(errors)))
+        return checksums
+
+    def verify_db(self, manifest=None, workers=4, tables=None):
+        """ Print the CHECKSUM TABLE of each table (or just of tables, a list
+        or a string with the tables separated by '+'), as lines of
+        "checksum <table> <checksum>", with `workers` connections doing
+        tables at the same time.
+
+        If manifest is given - a directory written by dump_db(checksums=True)
+        or the manifest.json in it - the checksums are compared with the ones
+        in the dump, and TasksError lists the tables that are different.
+
+        Run on two databases, the lines can be compared to check one is a
+        copy of the other (as fablib verify_db_against does), but tables
+        that are being written to will be different. """
+        start = time.time()
+        workers = int(workers)
+        if isinstance(tables, basestring):
+            tables = tables.split('+')
+        expected = None
+        if manifest:
+            if path.isdir(manifest):
+                manifest = path.join(manifest, 'manifest.json')
+            expected = dict([
+                (table, details['checksum'])
+                for table, details in json.load(open(manifest))['tables'].items()
+                if details.get('checksum') is not None])
+            if not expected:
+                raise InvalidArgumentError(
+                    'There are no checksums in %s - dump with checksums=true'
+                    % manifest)
+            if tables:
+                expected = dict([(t, expected[t]) for t in tables if t in expected])
+        if not tables:
+            # biggest first, so the connections finish at about the same time
+            tables = self._get_tables_by_size()
+        checksums = self._checksum_tables(tables, workers)
+        for table in sorted(checksums):
+            print 'checksum %s %s' % (table, checksums[table])
+        if expected is not None:
+            mismatches = _compare_checksums(expected, checksums, 'the dump',
+                                            self.name)
+            if mismatches:
+                raise TasksError('%d tables in %s do not match the dump:\n%s' %
+                                 (len(mismatches), self.name, '\n'.join(mismatches)))
+            print 'Checksums match the dump for %d tables' % len(expected)
+        print 'Checksummed %d tables with %d connections in %.1f seconds' % (
+            len(tables), workers, time.time() - start)
+
+    def _load_sql_file(self, sql_filename, compressor=None, fast=False,
+                       progress=False, row_counts=None, dump_file=None,
+                       dump_bytes=None):
+        """ Feed the file to the mysql client and return the exit code.  The
+        compressor is worked out from the file extension if not given.
+
+        fast wraps the file in FAST_RESTORE_START/END, progress shows a
+        progress bar on stderr and if row_counts is a dict, the rows in the
+        INSERT statements for each table are added to it.
+
+        If dump_file (an uncompressed file object, dump_bytes long) is given
+        it is read instead, and sql_filename is just its name. """
         restore_cmd = ['mysql'] + self.create_cmdline_args()
-        dump_file = open(dump_filename, 'r')
+        if dump_file is None:
+            compressor = compressor or _compressor_for_filename(sql_filename)
+            dump_bytes = path.getsize(sql_filename)
+            dump_file = open(sql_filename, 'rb')
+        progress_bar = None
+        if progress:
+            progress_bar = _ProgressBar(dump_bytes, path.basename(sql_filename))
         if env['verbose']:
             print 'Executing mysql restore command: %s\nSending stdin to %s' % \
-                (' '.join(restore_cmd), dump_filename)
-        _call_command(restore_cmd, stdin=dump_file)
-        dump_file.close()
+                (' '.join(restore_cmd), sql_filename)
+        restore_proc = subprocess.Popen(restore_cmd, stdin=subprocess.PIPE)
+        decompress_proc = None
+        try:
+            # the progress is measured on the file itself, compressed or not
+            if compressor:
+                decompress_proc = subprocess.Popen(
+                    _get_compressor(compressor)[2],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                feeder = threading.Thread(target=_copy_stream,
+                    args=(dump_file, decompress_proc.stdin, progress_bar, True))
+                feeder.start()
+                source = decompress_proc.stdout
+                source_progress_bar = None
+            else:
+                source = dump_file
+                source_progress_bar = progress_bar
+            try:
+                if fast:
+                    restore_proc.stdin.write(FAST_RESTORE_START)
+                if row_counts is None:
+                    _copy_stream(source, restore_proc.stdin, source_progress_bar)
+                else:
+                    for line in iter(source.readline, ''):
+                        match = INSERT_RE.match(line)
+                        if match:
+                            table = match.group('table')
+                            row_counts[table] = row_counts.get(table, 0) + \
+                                _count_insert_rows(line)
+                        restore_proc.stdin.write(line)
+                        if source_progress_bar:
+                            source_progress_bar.update(len(line))
+                if fast:
+                    restore_proc.stdin.write(FAST_RESTORE_END)
+            except IOError:
+                # mysql has stopped, its exit code will say why
+                pass
+        finally:
+            try:
+                restore_proc.stdin.close()
+            except IOError:
+                pass
+            returncode = restore_proc.wait()
+            if decompress_proc:
+                # so the decompressor gets SIGPIPE if mysql stopped early
+                decompress_proc.stdout.close()
+                feeder.join()
+                returncode = returncode or decompress_proc.wait()
+            dump_file.close()
+            if progress_bar:
+                progress_bar.finish()
+        return returncode
+
+    def _load_tab_file(self, tab_filename, table, compressor=None, fast=False):
+        """ Load a file written by _dump_table_tab() into table with LOAD
+        DATA LOCAL INFILE, decompressing it on the way, and return the exit
+        code.  The server needs local_infile turned on. """
+        load_sql = ("LOAD DATA LOCAL INFILE '/dev/stdin' INTO TABLE `%s` "
+                    "CHARACTER SET utf8;" % table)
+        if fast:
+            load_sql = FAST_RESTORE_START + load_sql + FAST_RESTORE_END
+        restore_cmd = ['mysql', '--local-infile=1'] + \
+            self.create_cmdline_args() + ['-e', load_sql]
+        if env['verbose']:
+            print 'Executing mysql restore command: %s\nSending stdin to %s' % \
+                (' '.join(restore_cmd), tab_filename)
+        tab_file = open(tab_filename, 'rb')
+        try:
+            if compressor:
+                decompress_proc = subprocess.Popen(
+                    _get_compressor(compressor)[2],
+                    stdin=tab_file, stdout=subprocess.PIPE)
+                restore_proc = subprocess.Popen(restore_cmd,
+                                                stdin=decompress_proc.stdout)
+                # so the decompressor gets SIGPIPE if mysql stops early
+                decompress_proc.stdout.close()
+                returncode = restore_proc.wait()
+                decompress_returncode = decompress_proc.wait()
+                returncode = returncode or decompress_returncode
+            else:
+                returncode = subprocess.call(restore_cmd, stdin=tab_file)
+        finally:
+            tab_file.close()
+        return returncode
+
+    def _load_sql(self, sql):
+        """ Feed the string of SQL to the mysql client """
+        restore_cmd = ['mysql'] + self.create_cmdline_args()
+        restore_proc = subprocess.Popen(restore_cmd, stdin=subprocess.PIPE)
+        restore_proc.communicate(sql)
+        if restore_proc.returncode != 0:
+            raise ShellCommandError(
+                'Failed to run SQL on database %s: returned %s' %
+                (self.name, restore_proc.returncode), restore_proc.returncode)
+
+    def _restore_db_stream(self, dump_lines, resume_file=None, fast=False):
+        """ Restore a mysqldump from an iterator of lines, such as stdin,
+        with a mysql client for each table.  The data for a table is only
+        complete when its client has finished, so at that point the table
+        is added to resume_file.  If the stream stops early, the tables
+        in resume_file can be left out when the dump is run again (see
+        dump_db(skip_tables=...)).  resume_file is deleted once the whole
+        dump has been loaded.  fast is as for restore_db(). """
+        start = time.time()
+        restore_cmd = ['mysql'] + self.create_cmdline_args()
+        header = []
+        # the table being loaded, its mysql client and whether its data has
+        # been seen yet
+        chunk = {'table': None, 'proc': None, 'has_data': False}
+        loaded_tables = []
+        row_counts = {}
+
+        def end_chunk(complete=True):
+            if chunk['proc'] is None:
+                return
+            if fast and complete:
+                chunk['proc'].stdin.write(FAST_RESTORE_END)
+            chunk['proc'].stdin.close()
+            returncode = chunk['proc'].wait()
+            chunk['proc'] = None
+            if not complete:
+                return
+            if returncode != 0:
+                raise ShellCommandError('Failed to restore table %s: returned %s' %
+                                        (chunk['table'], returncode), returncode)
+            if chunk['has_data']:
+                loaded_tables.append(chunk['table'])
+                if resume_file:
+                    state_file = open(resume_file, 'a')
+                    try:
+                        state_file.write(chunk['table'] + '\n')
+                    finally:
+                        state_file.close()
+                print 'Loaded %s after %.1f seconds' % (chunk['table'],
+                                                        time.time() - start)
+
+        def write(line):
+            if chunk['proc'] is None:
+                header.append(line)
+            else:
+                chunk['proc'].stdin.write(line)
+                if fast and line.startswith('INSERT INTO'):
+                    row_counts[chunk['table']] = row_counts.get(chunk['table'], 0) + \
+                        _count_insert_rows(line)
+
+        held_line = None
+        last_line = ''
+        try:
+            for line in dump_lines:
+                # a line cut off by the end of the stream
+                if not line.endswith('\n'):
+                    break
+                if held_line is not None:
+                    match = SECTION_RE.match(line)
+                    if match:
+                        section = match.group('section')
+                        table_match = (TABLE_STRUCTURE_RE.match(section) or
+                                       DUMPING_DATA_RE.match(section))
+                        if table_match and table_match.group('table') != chunk['table']:
+                            end_chunk()
+                            chunk['table'] = table_match.group('table')
+                            chunk['has_data'] = False
+                            chunk['proc'] = subprocess.Popen(
+                                restore_cmd, stdin=subprocess.PIPE)
+                            chunk['proc'].stdin.writelines(header)
+                            if fast:
+                                chunk['proc'].stdin.write(FAST_RESTORE_START)
+                        if DUMPING_DATA_RE.match(section):
+                            chunk['has_data'] = True
+                    write(held_line)
+                    held_line = None
+                if line == '--\n':
+                    held_line = line
+                else:
+                    write(line)
+                if line.strip():
+                    last_line = line
+        except:
+            end_chunk(complete=False)
+            raise
+        if not last_line.startswith('-- Dump completed'):
+            end_chunk(complete=False)
+            raise ShellCommandError(
+                'The dump stopped before the end, after loading %d tables - '
+                'run it again to carry on' % len(loaded_tables))
+        end_chunk()
+        if fast:
+            self._verify_row_counts(dict([(table, row_counts.get(table, 0))
+                                          for table in loaded_tables]))
+        if resume_file and path.exists(resume_file):
+            os.remove(resume_file)
+        print 'Loaded %d tables in %.1f seconds' % (len(loaded_tables),
+                                                   time.time() - start)
+
+    def _restore_tables_from_index(self, dump_filename, tables):
+        """ Restore just the tables from an indexed dump file, by reading
+        the header and the members for those tables """
+        index_filename = dump_filename + DUMP_INDEX_EXTENSION
+        if not path.exists(index_filename):
+            raise InvalidArgumentError(
+                'Cannot restore some tables from %s as it has no index (%s)' %
+                (dump_filename, index_filename))
+        start = time.time()
+        index = json.load(open(index_filename))
+        members = [m for m in index['members'] if m['table'] in tables]
+        missing_tables = set(tables) - set([m['table'] for m in members])
+        if missing_tables:
+            raise InvalidArgumentError('Tables not in %s: %s' %
+                (dump_filename, ', '.join(sorted(missing_tables))))
+        # the header sets the character set etc
+        if index['members'] and index['members'][0]['table'] is None:
+            members.insert(0, index['members'][0])
+
+        restore_cmd = ['mysql'] + self.create_cmdline_args()
+        decompress_proc = subprocess.Popen(
+            _get_compressor(index['compressor'])[2],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        restore_proc = subprocess.Popen(restore_cmd, stdin=decompress_proc.stdout)
+        decompress_proc.stdout.close()
+        dump_file = open(dump_filename, 'rb')
+        try:
+            for member in members:
+                dump_file.seek(member['offset'])
+                remaining = member['length']
+                while remaining > 0:
+                    chunk = dump_file.read(min(remaining, DUMP_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    decompress_proc.stdin.write(chunk)
+                    remaining -= len(chunk)
+        finally:
+            dump_file.close()
+            decompress_proc.stdin.close()
+            returncode = decompress_proc.wait()
+            returncode = restore_proc.wait() or returncode
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to restore tables into %s: returned %s' %
+                (self.name, returncode), returncode)
+        print 'Restored %s in %.1f seconds' % (', '.join(tables),
+                                               time.time() - start)
+
+    def _restore_db_parallel(self, dump_path, workers, tables=None, fast=False):
+        """ Restore a dump on `workers` connections at once.  dump_path is
+        either a directory written by dump_db(parallel=N) or a single
+        mysqldump file, which is split into a file per table first.
+
+        The schema is loaded without the secondary keys and foreign keys,
+        then the tables are loaded at the same time, biggest first, and
+        finally the keys are added back.
+
+        If tables is given, only those tables are restored.  fast is as for
+        restore_db(). """
+        start = time.time()
+        tmp_dir = None
+        data_format = 'sql'
+        try:
+            triggers_sql = ''
+            if path.isdir(dump_path):
+                manifest = json.load(open(path.join(dump_path, 'manifest.json')))
+                schema_sql = open(path.join(dump_path, manifest['schema'])).read()
+                # the triggers file is not split by table, so only restore
+                # the triggers when restoring everything
+                if manifest.get('triggers') and not tables:
+                    triggers_sql = open(path.join(dump_path, manifest['triggers'])).read()
+                compressor = manifest['compressor']
+                data_format = manifest.get('format', 'sql')
+                table_files = dict([
+                    (table, (path.join(dump_path, details['file']), details['rows']))
+                    for table, details in manifest['tables'].items()])
+            else:
+                tmp_dir = tempfile.mkdtemp(prefix='restore-',
+                                           dir=path.dirname(path.abspath(dump_path)))
+                print 'Splitting %s into a file per table' % dump_path
+                schema_sql, table_files = self._split_dump_file(dump_path, tmp_dir)
+                compressor = None
+            if tables:
+                missing_tables = set(tables) - set(table_files.keys())
+                if missing_tables:
+                    raise InvalidArgumentError('Tables not in %s: %s' %
+                        (dump_path, ', '.join(sorted(missing_tables))))
+                table_files = dict([(t, table_files[t]) for t in tables])
+                schema_sql = _filter_schema_tables(schema_sql, tables)
+            schema_sql, stripped_keys = _strip_secondary_keys(schema_sql)
+            self._load_sql(schema_sql)
+
+            tables = sorted(table_files.keys(), reverse=True,
+                            key=lambda t: path.getsize(table_files[t][0]))
+            done = []
+            print_lock = threading.Lock()
+
+            def load_table(worker, table):
+                table_start = time.time()
+                filename, rows = table_files[table]
+                if data_format == 'tab':
+                    returncode = self._load_tab_file(filename, table,
+                                                     compressor, fast)
+                else:
+                    returncode = self._load_sql_file(filename, compressor, fast)
+                if returncode != 0:
+                    raise ShellCommandError('mysql returned %s' % returncode,
+                                            returncode)
+                seconds = time.time() - table_start
+                print_lock.acquire()
+                try:
+                    done.append(table)
+                    print '[%d/%d] %s: %d rows in %.1f seconds (%.0f rows/s)' % (
+                        len(done), len(tables), table, rows, seconds,
+                        rows / max(seconds, 0.001))
+                finally:
+                    print_lock.release()
+
+            errors = _run_in_parallel(load_table, tables, range(workers))
+            if errors:
+                raise TasksError('Failed to restore tables into %s:\n%s' %
+                                 (self.name, '\n'.join(errors)))
+
+            # the foreign keys may need the keys of another table, so add
+            # all the keys first
+            key_start = time.time()
+            for key_type in (0, 1):
+                def add_keys(worker, table):
+                    definitions = stripped_keys[table][key_type]
+                    if definitions:
+                        self._load_sql('SET FOREIGN_KEY_CHECKS=0;\n'
+                                       'ALTER TABLE `%s` %s;\n' % (table,
+                                       ', '.join(['ADD ' + d for d in definitions])))
+                errors = _run_in_parallel(add_keys, stripped_keys.keys(),
+                                          range(workers))
+                if errors:
+                    raise TasksError('Failed to add keys in %s:\n%s' %
+                                     (self.name, '\n'.join(errors)))
+            if triggers_sql:
+                self._load_sql(triggers_sql)
+            print 'Added keys to %d tables in %.1f seconds' % (
+                len(stripped_keys), time.time() - key_start)
+            if fast:
+                self._verify_row_counts(dict([(table, table_files[table][1])
+                                              for table in tables]))
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir)
+        print 'Restored %d tables with %d connections in %.1f seconds' % (
+            len(tables), workers, time.time() - start)
+
+    def _split_dump_file(self, dump_filename, data_dir):
+        """ Decompress (if required) and split a mysqldump file with
+        _split_mysqldump() """
+        compressor = _compressor_for_filename(dump_filename)
+        dump_file = open(dump_filename, 'rb')
+        try:
+            if compressor:
+                decompress_proc = subprocess.Popen(
+                    _get_compressor(compressor)[2],
+                    stdin=dump_file, stdout=subprocess.PIPE)
+                try:
+                    result = _split_mysqldump(decompress_proc.stdout, data_dir)
+                finally:
+                    decompress_proc.stdout.close()
+                    returncode = decompress_proc.wait()
+                if returncode != 0:
+                    raise ShellCommandError(
+                        'Failed to decompress %s: returned %s' %
+                        (dump_filename, returncode), returncode)
+            else:
+                result = _split_mysqldump(dump_file, data_dir)
+        finally:
+            dump_file.close()
+        return result
+
+    def _check_binlog_enabled(self):
+        cursor = self.get_root_db_cursor()
+        try:
+            cursor.execute("SHOW VARIABLES LIKE 'log_bin'")
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        if row is None or row[1] != 'ON':
+            raise TasksError('Binary logging is not on - set log_bin (and '
+                             'server_id) in the [mysqld] section of my.cnf')
+
+    def get_binlog_position(self):
+        cursor = self.get_root_db_cursor()
+        try:
+            cursor.execute('SHOW MASTER STATUS')
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        if row is None:
+            return None
+        return row[0], int(row[1])
+
+    def _read_backup_manifest(self, backup_dir):
+        manifest_filename = path.join(backup_dir, BINLOG_BACKUP_MANIFEST)
+        if not path.exists(manifest_filename):
+            return {'database': self.name, 'bases': []}
+        return json.load(open(manifest_filename))
+
+    def _write_backup_manifest(self, backup_dir, manifest):
+        manifest_filename = path.join(backup_dir, BINLOG_BACKUP_MANIFEST)
+        manifest_file = open(manifest_filename + '.tmp', 'w')
+        try:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        finally:
+            manifest_file.close()
+        os.rename(manifest_filename + '.tmp', manifest_filename)
+
+    def _read_binlog_position(self, dump_filename, compressor):
+        """ Return the (binary log, position) in the header of a dump made
+        with --master-data=2 """
+        dump_file = open(dump_filename, 'rb')
+        decompress_proc = subprocess.Popen(_get_compressor(compressor)[2],
+                                           stdin=dump_file, stdout=subprocess.PIPE)
+        try:
+            # it is in the first few lines
+            for line_number, line in enumerate(iter(decompress_proc.stdout.readline, '')):
+                match = BINLOG_POSITION_RE.match(line)
+                if match:
+                    return match.group('file'), int(match.group('position'))
+                if line_number > 100:
+                    break
+        finally:
+            decompress_proc.stdout.close()
+            decompress_proc.wait()
+            dump_file.close()
+        raise TasksError('There is no binary log position in %s' % dump_filename)
+
+    def backup_db_base(self, backup_dir, compressor='gzip', keep_bases=2):
+        """ Take a full dump into backup_dir to replay the binary logs
+        collected by backup_binlogs() onto.  The dump is of a snapshot and
+        starts a new binary log, and records where in the binary logs it
+        is.  Only the newest keep_bases bases are kept, along with the
+        binary logs that come after the oldest of them. """
+        self._check_binlog_enabled()
+        backup_dir = path.abspath(backup_dir)
+        _create_dir_if_not_exists(backup_dir)
+        created = time.strftime('%Y-%m-%d %H:%M:%S')
+        base_filename = 'base-%s.sql%s' % (time.strftime('%Y%m%d-%H%M%S'),
+                                           _get_compressor(compressor)[0])
+        # as root, as --master-data needs the RELOAD privilege
+        dump_cmd = ['mysqldump'] + self._create_root_cmdline_args() + \
+            ['--single-transaction', '--quick', '--master-data=2',
+             '--flush-logs', '--routines', self.name]
+        returncode = _dump_to_file(dump_cmd, path.join(backup_dir, base_filename),
+                                   compressor)
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to dump database %s: returned %s' % (self.name, returncode),
+                returncode)
+        binlog_file, binlog_position = self._read_binlog_position(
+            path.join(backup_dir, base_filename), compressor)
 
-    def create_dbdump_cron_file(self, cron_file, dump_file_stub):
+        manifest = self._read_backup_manifest(backup_dir)
+        manifest['bases'].append({
+            'file': base_filename,
+            'created': created,
+            'binlog_file': binlog_file,
+            'binlog_position': binlog_position,
+        })
+        bases = sorted(manifest['bases'], key=lambda base: base['created'])
+        keep_bases = max(int(keep_bases), 1)
+        manifest['bases'] = bases[-keep_bases:]
+        self._write_backup_manifest(backup_dir, manifest)
+        for base in bases[:-keep_bases]:
+            os.remove(path.join(backup_dir, base['file']))
+        oldest_binlog = manifest['bases'][0]['binlog_file']
+        binlog_dir = path.join(backup_dir, 'binlogs')
+        if path.isdir(binlog_dir):
+            for filename in os.listdir(binlog_dir):
+                if _strip_compressor_extension(filename) < oldest_binlog:
+                    os.remove(path.join(binlog_dir, filename))
+        print 'Base backup %s is at %s position %d' % (base_filename,
+                                                      binlog_file, binlog_position)
+
+    def backup_binlogs(self, backup_dir, compressor='gzip'):
+        """ Copy the binary logs the server has finished writing into
+        backup_dir/binlogs, compressed.  A new binary log is started first,
+        so everything up to now is copied.  Binary logs from before the
+        oldest base backup are not needed, so are not copied. """
+        self._check_binlog_enabled()
+        binlog_dir = path.join(path.abspath(backup_dir), 'binlogs')
+        _create_dir_if_not_exists(binlog_dir)
+        cursor = self.get_root_db_cursor()
+        try:
+            cursor.execute('FLUSH BINARY LOGS')
+            cursor.execute('SHOW BINARY LOGS')
+            binlog_names = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        extension = _get_compressor(compressor)[0]
+        # backup_db_base() deletes the binary logs from before the oldest
+        # base, so don't copy those again
+        bases = self._read_backup_manifest(backup_dir)['bases']
+        oldest_binlog = ''
+        if bases:
+            oldest_binlog = sorted(bases, key=lambda base: base['created'])[0]['binlog_file']
+        # the newest one is still being written
+        new_binlogs = [name for name in binlog_names[:-1]
+                       if name >= oldest_binlog and
+                       not path.exists(path.join(binlog_dir, name + extension))]
+        if not new_binlogs:
+            print 'There are no new binary logs'
+            return
+        start = time.time()
+        tmp_dir = tempfile.mkdtemp(prefix='binlogs-', dir=binlog_dir)
+        try:
+            copy_cmd = ['mysqlbinlog', '--read-from-remote-server', '--raw',
+                        '--result-file=' + tmp_dir + os.sep] + \
+                self._create_root_cmdline_args() + new_binlogs
+            returncode = _call_command(copy_cmd)
+            if returncode != 0:
+                raise ShellCommandError(
+                    'Failed to copy the binary logs: mysqlbinlog returned %s' %
+                    returncode, returncode)
+            copied_bytes = 0
+            for name in new_binlogs:
+                binlog_filename = path.join(binlog_dir, name + extension)
+                output = _CompressedFile(binlog_filename + '.tmp', compressor)
+                binlog_file = open(path.join(tmp_dir, name), 'rb')
+                try:
+                    _copy_stream(binlog_file, output)
+                finally:
+                    binlog_file.close()
+                    returncode = output.close()
+                if returncode != 0:
+                    raise ShellCommandError('Failed to compress %s: returned %s' %
+                                            (name, returncode), returncode)
+                copied_bytes += output.raw_bytes
+                os.rename(binlog_filename + '.tmp', binlog_filename)
+        finally:
+            shutil.rmtree(tmp_dir)
+        print 'Copied %d binary logs (%.1f MB) in %.1f seconds' % (
+            len(new_binlogs), copied_bytes / 1048576.0, time.time() - start)
+
+    def _restore_point_in_time(self, backup_dir, stop_datetime=None, fast=False):
+        """ Restore the newest base backup from before stop_datetime, then
+        replay the binary logs after it up to stop_datetime """
+        start = time.time()
+        manifest = self._read_backup_manifest(backup_dir)
+        base = _choose_base_backup(manifest['bases'], stop_datetime)
+        if base is None:
+            raise InvalidArgumentError('There is no base backup from before %s in %s'
+                                       % (stop_datetime, backup_dir))
+        binlog_dir = path.join(backup_dir, 'binlogs')
+        binlogs = []
+        if path.isdir(binlog_dir):
+            binlogs = _binlogs_to_replay(base['binlog_file'], [
+                filename for filename in os.listdir(binlog_dir)
+                if not filename.endswith('.tmp') and
+                path.isfile(path.join(binlog_dir, filename))])
+
+        print 'Restoring the base backup from %s' % base['created']
+        self.restore_db(path.join(backup_dir, base['file']), fast=fast)
+        if not binlogs:
+            print 'There are no binary logs to replay after the base backup'
+            return
+
+        tmp_dir = tempfile.mkdtemp(prefix='replay-', dir=backup_dir)
+        try:
+            # mysqlbinlog cannot read compressed logs
+            binlog_paths = []
+            for filename in binlogs:
+                binlog_path = path.join(tmp_dir, _strip_compressor_extension(filename))
+                binlog_file = open(binlog_path, 'wb')
+                try:
+                    returncode = _call_command(
+                        _get_compressor(_compressor_for_filename(filename))[2] +
+                        [path.join(binlog_dir, filename)], stdout=binlog_file)
+                finally:
+                    binlog_file.close()
+                if returncode != 0:
+                    raise ShellCommandError('Failed to decompress %s: returned %s' %
+                                            (filename, returncode), returncode)
+                binlog_paths.append(binlog_path)
+            replay_cmd = ['mysqlbinlog', '--database=' + self.name,
+                          '--start-position=%d' % base['binlog_position']]
+            if stop_datetime:
+                replay_cmd.append('--stop-datetime=' + stop_datetime)
+            replay_proc = subprocess.Popen(replay_cmd + binlog_paths,
+                                           stdout=subprocess.PIPE)
+            # as root, as replaying row events needs the SUPER privilege
+            restore_proc = subprocess.Popen(
+                ['mysql'] + self._create_root_cmdline_args() + [self.name],
+                stdin=replay_proc.stdout)
+            replay_proc.stdout.close()
+            returncode = restore_proc.wait() or replay_proc.wait()
+        finally:
+            shutil.rmtree(tmp_dir)
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to replay the binary logs into %s: returned %s' %
+                (self.name, returncode), returncode)
+        print 'Replayed %d binary logs up to %s - restored in %.1f seconds' % (
+            len(binlogs), stop_datetime or 'the end', time.time() - start)
+
+    def setup_binlog_backups(self, backup_dir, compressor='gzip'):
+        """ set up a weekly base backup, and copying the binary logs every
+        hour, into backup_dir """
+        if not path.isabs(backup_dir):
+            raise InvalidArgumentError(
+                'backup_dir must be an absolute path, you gave %s' % backup_dir)
+        self._check_binlog_enabled()
+        _create_dir_if_not_exists(backup_dir)
+        tasks_bin = path.join(env['deploy_dir'], 'tasks.py')
+        for cron_dir, task in (('cron.weekly', 'backup_db_base'),
+                               ('cron.hourly', 'backup_binlogs')):
+            cron_file = path.join('/etc', cron_dir, task + '_' + env['project_name'])
+            if path.exists(cron_file):
+                continue
+            # don't use "with" for compatibility with python 2.3 on whov2hinari
+            f = open(cron_file, 'w')
+            try:
+                f.write('#!/bin/sh\n%s %s:%s,compressor=%s\n' % (
+                    tasks_bin, task, backup_dir, compressor))
+            finally:
+                f.close()
+            os.chmod(cron_file, 0755)
+        # so there is something to replay the binary logs onto
+        if not self._read_backup_manifest(backup_dir)['bases']:
+            self.backup_db_base(backup_dir, compressor)
+
+    def create_dbdump_cron_file(self, cron_file, dump_file_stub, parallel=0,
+                                compressor=None, low_impact=False,
+                                bandwidth_limit=None, store=None,
+                                keep_days=None, keep_count=None):
         # write something like:
         # #!/bin/sh
         # /usr/bin/mysqldump --user=projectname --password=aptivate --host=127.0.0.1 projectname >  /var/projectname/dumps/daily-dump-`/bin/date +\%d`.sql
@@ -300,6 +2799,43 @@ class MySQLManager(DBManager):
 
         # don't use "with" for compatibility with python 2.3 on whov2hinari
         cron_file.write('#!/bin/sh\n')
+        low_impact_args = ''
+        if low_impact:
+            low_impact_args += ',low_impact=true'
+        if bandwidth_limit:
+            low_impact_args += ',bandwidth_limit=%s' % bandwidth_limit
+        tasks_bin = path.join(env['deploy_dir'], 'tasks.py')
+        if store:
+            if int(parallel) > 0:
+                raise InvalidArgumentError(
+                    'store cannot be used with parallel dumps')
+            # dump into the store, then delete the dumps that are too old
+            cron_file.write('%s dump_db:%s`/bin/date +\\%%d`.sql,store=%s%s\n' % (
+                tasks_bin, dump_file_stub, store, low_impact_args))
+            prune_args = ''
+            if keep_days is not None:
+                prune_args += ',keep_days=%s' % keep_days
+            if keep_count is not None:
+                prune_args += ',keep_count=%s' % keep_count
+            cron_file.write('%s prune_dumps:%s%s\n' % (tasks_bin, store, prune_args))
+            return
+        if int(parallel) > 0:
+            # go through tasks.py to dump the tables in parallel, into a
+            # directory per day
+            cron_file.write('%s dump_db:%s`/bin/date +\\%%d`,parallel=%d%s\n' % (
+                path.join(env['deploy_dir'], 'tasks.py'), dump_file_stub,
+                int(parallel), low_impact_args))
+            return
+        if compressor or low_impact_args:
+            # go through tasks.py to get an indexed compressed dump, or a
+            # low impact one
+            compressor_args = ''
+            if compressor:
+                compressor_args = ',compressor=%s' % compressor
+            cron_file.write('%s dump_db:%s`/bin/date +\\%%d`.sql%s%s\n' % (
+                path.join(env['deploy_dir'], 'tasks.py'), dump_file_stub,
+                compressor_args, low_impact_args))
+            return
         if os.path.exists(r'/usr/bin/mysqldump'):
             mysql_dump_command = r'/usr/bin/mysqldump '
         else:
@@ -310,8 +2846,13 @@ class MySQLManager(DBManager):
         cron_file.write(r'`/bin/date +\%d`.sql')
         cron_file.write('\n')
 
-    def setup_db_dumps(self, dump_dir):
-        """ set up mysql database dumps in root crontab """
+    def setup_db_dumps(self, dump_dir, parallel=0, compressor=None,
+                       low_impact=False, bandwidth_limit=None, store=None,
+                       keep_days=None, keep_count=None):
+        """ set up mysql database dumps in root crontab.  store is the
+        directory of a DumpStore to put the dumps in - the same one the
+        deploy dumps use - and the dumps in it older than keep_days (apart
+        from the newest keep_count) are deleted. """
         if not path.isabs(dump_dir):
             raise InvalidArgumentError(
                 'dump_dir must be an absolute path, you gave %s' % dump_dir)
@@ -329,17 +2870,398 @@ class MySQLManager(DBManager):
         except CalledProcessError:
             cron_set = False
 
-        if cron_set or path.exists(cron_file):
+        # a crontab entry set up by hand is left alone, but the cron file is
+        # ours, so it is rewritten when the settings have changed
+        if cron_set and not path.exists(cron_file):
             return
 
-        # don't use "with" for compatibility with python 2.3 on whov2hinari
-        f = open(cron_file, 'w')
+        contents = StringIO.StringIO()
+        self.create_dbdump_cron_file(contents, dump_file_stub, parallel,
+                                     compressor, low_impact, bandwidth_limit,
+                                     store, keep_days, keep_count)
+        _update_cron_file(cron_file, contents.getvalue())
+
+
+def _is_pg_archive(dump_filename):
+    """ Whether dump_filename is a pg_dump directory or custom format file,
+    which pg_restore can restore in parallel, rather than SQL """
+    if path.isdir(dump_filename):
+        return path.exists(path.join(dump_filename, 'toc.dat'))
+    if not path.isfile(dump_filename):
+        return False
+    dump_file = open(dump_filename, 'rb')
+    try:
+        return dump_file.read(5) == 'PGDMP'
+    finally:
+        dump_file.close()
+
+
+class PostgresManager(DBManager):
+    """ Uses the postgres command line tools, so psycopg2 is not needed.
+    The database user's password is passed to them in PGPASSWORD.  Admin
+    commands are run as the postgres user with sudo, or over the network as
+    the postgres superuser if root_password is given. """
+
+    ENGINE = 'PostgreSQL'
+
+    def __init__(self, name, user, password, port=None, host=None,
+                 root_password=None, grant_enabled=True):
+        self.name = name
+        self.user = user
+        self.password = password
+        self.port = port
+        # no host means the local unix socket, as for django
+        self.host = host
+        self.root_password = root_password
+        self.grant_enabled = grant_enabled
+
+    def _connection_args(self, user):
+        cmdline_args = ['-U', user]
+        if self.host:
+            cmdline_args += ['-h', self.host]
+        if self.port:
+            cmdline_args += ['-p', str(self.port)]
+        return cmdline_args
+
+    def create_cmdline_args(self):
+        return self._connection_args(self.user) + ['-d', self.name]
+
+    def _pg_environ(self, password=None):
+        """ The environment to run the postgres tools in """
+        pg_environ = os.environ.copy()
+        pg_environ['PGPASSWORD'] = password or self.password
+        return pg_environ
+
+    def _psql_cmd(self, sql, as_root=False):
+        """ Return (command, environment) to run sql with psql, printing
+        just the values of any rows """
+        psql_cmd = ['psql', '-X', '-q', '-t', '-A', '-v', 'ON_ERROR_STOP=1']
+        if not as_root:
+            return (psql_cmd + self.create_cmdline_args() + ['-c', sql],
+                    self._pg_environ())
+        psql_cmd += ['-d', 'postgres', '-c', sql]
+        if self.root_password:
+            return (psql_cmd[:1] + self._connection_args('postgres') + psql_cmd[1:],
+                    self._pg_environ(self.root_password))
+        return ['sudo', '-n', '-u', 'postgres'] + psql_cmd, None
+
+    def _query(self, sql, as_root=False):
+        """ Return the rows sql returns, as lines of values separated by | """
+        psql_cmd, pg_environ = self._psql_cmd(sql, as_root)
+        psql_proc = subprocess.Popen(psql_cmd, stdout=subprocess.PIPE,
+                                     env=pg_environ)
+        output = psql_proc.communicate()[0]
+        if psql_proc.returncode != 0:
+            raise ShellCommandError('psql returned %s running: %s' %
+                                    (psql_proc.returncode, sql),
+                                    psql_proc.returncode)
+        return [line for line in output.splitlines() if line]
+
+    def exec_as_root(self, *sql_cmd_list):
+        """ execute SQL statements as the postgres superuser """
+        for sql in sql_cmd_list:
+            psql_cmd, pg_environ = self._psql_cmd(sql, as_root=True)
+            _check_call_wrapper(psql_cmd, env=pg_environ)
+
+    def _quote_ident(self, name):
+        return '"%s"' % name.replace('"', '""')
+
+    def _quote_literal(self, value):
+        return "'%s'" % value.replace("'", "''")
+
+    def test_sql_user_exists(self, user=None):
+        if not user:
+            user = self.user
+        return bool(self._query('SELECT 1 FROM pg_roles WHERE rolname = %s' %
+                                self._quote_literal(user), as_root=True))
+
+    def db_exists(self):
+        return bool(self._query('SELECT 1 FROM pg_database WHERE datname = %s' %
+                                self._quote_literal(self.name), as_root=True))
+
+    def test_db_table_exists(self, table_name):
+        return bool(self._query(
+            'SELECT 1 FROM information_schema.tables WHERE '
+            'table_schema = current_schema() AND table_name = %s' %
+            self._quote_literal(table_name)))
+
+    def create_user_if_not_exists(self):
+        if not self.test_sql_user_exists(self.user):
+            self.exec_as_root('CREATE ROLE %s LOGIN PASSWORD %s' % (
+                self._quote_ident(self.user), self._quote_literal(self.password)))
+
+    def set_user_password(self):
+        self.exec_as_root('ALTER ROLE %s WITH PASSWORD %s' % (
+            self._quote_ident(self.user), self._quote_literal(self.password)))
+
+    def grant_all_privileges_for_database(self):
+        if not self.grant_enabled:
+            return
+        self.exec_as_root('GRANT ALL PRIVILEGES ON DATABASE %s TO %s' % (
+            self._quote_ident(self.name), self._quote_ident(self.user)))
+
+    def create_db_if_not_exists(self):
+        if not self.db_exists():
+            self.exec_as_root(
+                "CREATE DATABASE %s OWNER %s ENCODING 'UTF8' TEMPLATE template0" %
+                (self._quote_ident(self.name), self._quote_ident(self.user)))
+
+    def ensure_user_and_db_exist(self):
+        self.create_user_if_not_exists()
+        self.set_user_password()
+        self.create_db_if_not_exists()
+        self.grant_all_privileges_for_database()
+
+    def drop_db(self):
+        self.exec_as_root('DROP DATABASE IF EXISTS %s' % self._quote_ident(self.name))
+
+    def _table_args(self, tables, skip_tables):
+        """ pg_dump arguments for the tables to dump, or to leave out """
+        if isinstance(tables, basestring):
+            tables = tables.split('+')
+        if isinstance(skip_tables, basestring):
+            skip_tables = skip_tables.split('+')
+        table_args = []
+        for table in tables or []:
+            table_args += ['-t', table]
+        for table in skip_tables or []:
+            table_args += ['-T', table]
+        return table_args
+
+    def dump_db(self, dump_filename='db_dump.sql', for_rsync=False,
+                single_transaction=False, compressor=None, parallel=0,
+                incremental=False, subset=False, skip_tables=None,
+                tables=None, low_impact=False, bandwidth_limit=None,
+                store=None, checksums=False, data_format='sql'):
+        """Dump the database with pg_dump, which always dumps a consistent
+        snapshot without stopping the site writing to the database.
+
+        If parallel is more than 0, dump_filename is a directory and pg_dump
+        dumps that many tables at once into it (its directory format), each
+        table gzipped.  Otherwise the dump is SQL, with compressor, store
+        and dump_filename '-' as for MySQLManager.dump_db().  Either way the
+        dump leaves out owners and privileges, so it can be restored for a
+        different user.
+
+        tables, skip_tables, low_impact and bandwidth_limit (for SQL dumps)
+        are as for MySQLManager.dump_db().  for_rsync and single_transaction
+        make no difference, and the other options are not supported."""
+        parallel = int(parallel)
+        if incremental or subset or checksums or data_format != 'sql':
+            raise InvalidArgumentError(
+                'postgres dumps cannot be incremental, subset, checksums or '
+                'another data_format')
+        if store and (parallel > 0 or dump_filename == '-'):
+            raise InvalidArgumentError(
+                'store cannot be used with parallel dumps, or stdout')
+        if low_impact:
+            _lower_priority()
+        dump_cmd = ['pg_dump', '--no-owner', '--no-privileges'] + \
+            self._table_args(tables, skip_tables)
+        if parallel > 0:
+            self._dump_db_parallel(dump_filename, parallel, dump_cmd)
+            return
+
+        throttle = None
+        if bandwidth_limit:
+            throttle = _Throttle(bandwidth_limit)
+        # so the dump replaces the tables when restored into a database
+        # that already has them
+        dump_cmd += ['--clean', '--if-exists'] + self.create_cmdline_args()
+        dump_filename, compressor = _dump_compressor(dump_filename, compressor,
+                                                     store)
+        if env['verbose']:
+            sys.stderr.write('Executing pg_dump command: %s\nSending stdout to %s\n' %
+                (dump_cmd, dump_filename))
+        output = None
+        if store:
+            dump_store = DumpStore(store)
+            output = dump_store.writer(dump_filename)
+        returncode = _dump_to_file(dump_cmd, dump_filename, compressor,
+                                   throttle=throttle, output=output,
+                                   cmd_env=self._pg_environ())
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to dump database %s: returned %s' % (self.name, returncode),
+                returncode)
+        if store:
+            dump_store.write_pointer(dump_filename, output.name)
+            print 'Stored as %s in %s - %d of %d chunks were new' % (
+                output.name, dump_store.store_dir, output.new_chunks,
+                len(output.chunks))
+
+    def _dump_db_parallel(self, dump_dir, jobs, dump_cmd):
+        """ Dump into dump_dir in pg_dump's directory format, with `jobs`
+        connections dumping tables at once.  All the connections share the
+        snapshot of the first one. """
+        start = time.time()
+        # pg_dump creates the directory, and an old dump is only replaced by
+        # a complete one
+        dump_dir = dump_dir.rstrip('/')
+        tmp_dir = dump_dir + '.tmp'
+        if path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        dump_cmd = dump_cmd + ['-Fd', '-j', str(jobs), '-f', tmp_dir] + \
+            self.create_cmdline_args()
+        if env['verbose']:
+            print 'Executing pg_dump command: %s' % ' '.join(dump_cmd)
+        returncode = subprocess.call(dump_cmd, env=self._pg_environ())
+        if returncode != 0:
+            if path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            raise ShellCommandError(
+                'Failed to dump database %s: returned %s' % (self.name, returncode),
+                returncode)
+        if path.exists(dump_dir):
+            shutil.rmtree(dump_dir)
+        os.rename(tmp_dir, dump_dir)
+        print 'Dumped %s with %d connections in %.1f seconds' % (
+            self.name, jobs, time.time() - start)
+
+    def restore_db(self, dump_filename, parallel=0, tables=None,
+                   resume_file=None, fast=False, store=None,
+                   stop_datetime=None):
+        """Restore a dump written by dump_db().
+
+        A directory (or a pg_dump custom format file) is restored by
+        pg_restore with `parallel` jobs - or one per CPU if parallel is 0 -
+        and tables (a list, or a string with the tables separated by '+')
+        restores just those tables.
+
+        An SQL dump, compressed or not, from a store or '-' for stdin, is
+        fed to psql.  fast loads it in a single transaction.  resume_file
+        and stop_datetime are not supported."""
+        if resume_file or stop_datetime:
+            raise InvalidArgumentError(
+                'postgres restores cannot use resume_file or stop_datetime')
+        if isinstance(tables, basestring):
+            tables = tables.split('+')
+        if _is_pg_archive(dump_filename) and not store:
+            self._restore_db_parallel(dump_filename, int(parallel), tables)
+            return
+        if tables:
+            raise InvalidArgumentError(
+                'tables needs a parallel (directory) dump to restore from')
+        compressor = None
+        if store or dump_filename.endswith(POINTER_EXTENSION):
+            if store:
+                dump_store, dump_name = DumpStore(store), dump_filename
+            else:
+                dump_store, dump_name = open_pointer(dump_filename)
+            dump_file = dump_store.open_dump(dump_name)
+        elif dump_filename == '-':
+            dump_file = sys.stdin
+        else:
+            dump_file = open(dump_filename, 'rb')
+            compressor = _compressor_for_filename(dump_filename)
+        start = time.time()
         try:
-            self.create_dbdump_cron_file(f, dump_file_stub)
+            returncode = self._load_sql_file(dump_file, compressor, bool(fast))
         finally:
-            f.close()
+            if dump_file is not sys.stdin:
+                dump_file.close()
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to restore database %s: returned %s' % (self.name, returncode),
+                returncode)
+        print 'Restored %s in %.1f seconds' % (self.name, time.time() - start)
+
+    def _load_sql_file(self, dump_file, compressor=None, single_transaction=False):
+        """ Feed dump_file (a file object) to psql, decompressing it with
+        compressor if given, and return the exit code """
+        restore_cmd = ['psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1'] + \
+            self.create_cmdline_args()
+        if single_transaction:
+            restore_cmd.append('--single-transaction')
+        if env['verbose']:
+            print 'Executing psql restore command: %s' % ' '.join(restore_cmd)
+        if compressor:
+            decompress_proc = subprocess.Popen(_get_compressor(compressor)[2],
+                                               stdin=dump_file,
+                                               stdout=subprocess.PIPE)
+            restore_proc = subprocess.Popen(restore_cmd, env=self._pg_environ(),
+                                            stdin=decompress_proc.stdout)
+            # so the decompressor gets SIGPIPE if psql stops early
+            decompress_proc.stdout.close()
+            returncode = restore_proc.wait()
+            decompress_returncode = decompress_proc.wait()
+            return returncode or decompress_returncode
+        restore_proc = subprocess.Popen(restore_cmd, env=self._pg_environ(),
+                                        stdin=subprocess.PIPE)
+        _copy_stream(dump_file, restore_proc.stdin, close_dest=True)
+        return restore_proc.wait()
+
+    def _restore_db_parallel(self, dump_path, jobs, tables=None):
+        start = time.time()
+        jobs = jobs or multiprocessing.cpu_count()
+        restore_cmd = ['pg_restore', '--no-owner', '--no-privileges', '--clean',
+                       '--if-exists', '--exit-on-error', '-j', str(jobs)]
+        for table in tables or []:
+            restore_cmd += ['-t', table]
+        restore_cmd += self.create_cmdline_args() + [dump_path]
+        if env['verbose']:
+            print 'Executing pg_restore command: %s' % ' '.join(restore_cmd)
+        returncode = subprocess.call(restore_cmd, env=self._pg_environ())
+        if returncode != 0:
+            raise ShellCommandError(
+                'Failed to restore database %s: returned %s' % (self.name, returncode),
+                returncode)
+        print 'Restored %s with %d connections in %.1f seconds' % (
+            self.name, jobs, time.time() - start)
+
+    def create_dbdump_cron_file(self, cron_file, dump_file_stub, parallel=0,
+                                compressor=None, low_impact=False,
+                                bandwidth_limit=None, store=None,
+                                keep_days=None, keep_count=None):
+        # the dumps go through tasks.py, which knows the password
+        tasks_bin = path.join(env['deploy_dir'], 'tasks.py')
+        dump_args = ''
+        if low_impact:
+            dump_args += ',low_impact=true'
+        if bandwidth_limit:
+            dump_args += ',bandwidth_limit=%s' % bandwidth_limit
+        cron_file.write('#!/bin/sh\n')
+        if int(parallel) > 0:
+            if store:
+                raise InvalidArgumentError(
+                    'store cannot be used with parallel dumps')
+            cron_file.write('%s dump_db:%s`/bin/date +\\%%d`,parallel=%d%s\n' % (
+                tasks_bin, dump_file_stub, int(parallel), dump_args))
+            return
+        if store:
+            dump_args += ',store=%s' % store
+        elif compressor:
+            dump_args += ',compressor=%s' % compressor
+        cron_file.write('%s dump_db:%s`/bin/date +\\%%d`.sql%s\n' % (
+            tasks_bin, dump_file_stub, dump_args))
+        if store:
+            prune_args = ''
+            if keep_days is not None:
+                prune_args += ',keep_days=%s' % keep_days
+            if keep_count is not None:
+                prune_args += ',keep_count=%s' % keep_count
+            cron_file.write('%s prune_dumps:%s%s\n' % (tasks_bin, store, prune_args))
+
+    def setup_db_dumps(self, dump_dir, parallel=0, compressor=None,
+                       low_impact=False, bandwidth_limit=None, store=None,
+                       keep_days=None, keep_count=None):
+        """ set up daily postgres database dumps in /etc/cron.daily.  store
+        is as for MySQLManager.setup_db_dumps(). """
+        if not path.isabs(dump_dir):
+            raise InvalidArgumentError(
+                'dump_dir must be an absolute path, you gave %s' % dump_dir)
+        cron_file = path.join('/etc', 'cron.daily', 'dump_' + env['project_name'])
+        _create_dir_if_not_exists(dump_dir)
+        contents = StringIO.StringIO()
+        self.create_dbdump_cron_file(contents, path.join(dump_dir, 'daily-dump-'),
+                                     parallel, compressor, low_impact,
+                                     bandwidth_limit, store, keep_days,
+                                     keep_count)
+        _update_cron_file(cron_file, contents.getvalue())
+
 
-        os.chmod(cron_file, 0755)
+# the last part of the django database ENGINEs that use postgres
+POSTGRES_ENGINES = ('postgresql_psycopg2', 'postgresql', 'postgis', 'postgres')
 
 
 def get_db_manager(engine, **kwargs):
@@ -347,5 +3269,7 @@ def get_db_manager(engine, **kwargs):
         return MySQLManager(**kwargs)
     elif engine.lower() == 'sqlite':
         return SqliteManager(**kwargs)
+    elif engine.lower() in POSTGRES_ENGINES:
+        return PostgresManager(**kwargs)
     else:
         raise InvalidProjectError('Database engine %s not supported' % engine)
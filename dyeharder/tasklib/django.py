@@ -1,11 +1,16 @@
 import os
 from os import path
+import glob
+import json
 import sys
 import random
+import re
 import subprocess
+import time
 
 from .exceptions import TasksError
 from .database import get_db_manager
+from .dumpstore import DumpStore
 from .exceptions import InvalidProjectError, ShellCommandError
 from .util import _check_call_wrapper
 # global dictionary for state
@@ -179,29 +184,155 @@ def update_db(syncdb=True, drop_test_db=True, force_use_migrations=False, databa
             _manage_py(['migrate', '--noinput'])
 
 
+# a table in the output of manage.py sqlall
+SQL_CREATE_TABLE_RE = re.compile(r'^CREATE TABLE [`"]?(?P<table>[^`"\s(]+)')
+
+
+def pending_migrations(database='default'):
+    """ list the South migrations and new tables that update_db would apply
+    to the database, then print 'pending_migrations: <count>' """
+    _create_db_objects(database=database)
+    pending = []
+    for app in env['django_apps']:
+        if path.exists(path.join(env['django_dir'], app, 'migrations')):
+            for line in _manage_py(['migrate', '--list', app]):
+                line = line.strip()
+                # South shows "( )" and django "[ ]" for unapplied migrations
+                if line.startswith('( )') or line.startswith('[ ]'):
+                    pending.append('%s: migration %s' % (app, line[3:].strip()))
+        else:
+            # syncdb only creates tables, so look for the missing ones
+            for line in _manage_py(['sqlall', app]):
+                match = SQL_CREATE_TABLE_RE.match(line)
+                if match and not env['db'].test_db_table_exists(match.group('table')):
+                    pending.append('%s: new table %s' % (app, match.group('table')))
+    for description in pending:
+        print description
+    print 'pending_migrations: %d' % len(pending)
+
+
+def create_restore_point(restore_point_file, dump_dir=None, database='default'):
+    """ record where the database is, instead of dumping it - the binary log
+    position, and the newest daily dump in dump_dir """
+    _create_db_objects(database=database)
+    restore_point = {'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    binlog_position = env['db'].get_binlog_position()
+    if binlog_position:
+        restore_point['binlog_file'], restore_point['binlog_position'] = binlog_position
+    if dump_dir:
+        daily_dumps = glob.glob(path.join(dump_dir, 'daily-dump-*'))
+        if daily_dumps:
+            restore_point['latest_daily_dump'] = max(daily_dumps, key=path.getmtime)
+    restore_point_out = open(restore_point_file, 'w')
+    try:
+        json.dump(restore_point, restore_point_out, indent=2, sort_keys=True)
+    finally:
+        restore_point_out.close()
+
+
 def create_test_db(drop_after_create=True, database='default'):
     _create_db_objects(database=database)
     env['test_db'].create_db_if_not_exists(drop_after_create=drop_after_create)
 
 
-def dump_db(dump_filename='db_dump.sql', for_rsync=False, database='default'):
+def dump_db(dump_filename='db_dump.sql', for_rsync=False, database='default',
+            single_transaction=False, compressor=None, parallel=0,
+            incremental=False, subset=False, skip_tables=None, tables=None,
+            low_impact=False, bandwidth_limit=None, store=None,
+            checksums=False, data_format='sql'):
+    _create_db_objects(database=database)
+    env['db'].dump_db(dump_filename, for_rsync,
+                      single_transaction=single_transaction,
+                      compressor=compressor, parallel=parallel,
+                      incremental=incremental, subset=subset,
+                      skip_tables=skip_tables, tables=tables,
+                      low_impact=low_impact, bandwidth_limit=bandwidth_limit,
+                      store=store, checksums=checksums,
+                      data_format=data_format)
+
+
+def restore_db(dump_filename='db_dump.sql', database='default', parallel=0,
+               tables=None, resume_file=None, fast=False, store=None,
+               stop_datetime=None):
+    _create_db_objects(database=database)
+    env['db'].restore_db(dump_filename, parallel, tables, resume_file, fast,
+                         store, stop_datetime)
+
+
+def verify_db(manifest=None, database='default', workers=4, tables=None):
+    """ checksum the tables, and compare them with the checksums in the
+    manifest of a dump if given """
+    _create_db_objects(database=database)
+    env['db'].verify_db(manifest, workers, tables)
+
+
+def backup_db_base(backup_dir, database='default', compressor='gzip',
+                   keep_bases=2):
+    """ take a full backup for the binary logs to be replayed onto """
+    _create_db_objects(database=database)
+    env['db'].backup_db_base(backup_dir, compressor, keep_bases)
+
+
+def backup_binlogs(backup_dir, database='default', compressor='gzip'):
+    """ copy the new binary logs into the point in time backups """
+    _create_db_objects(database=database)
+    env['db'].backup_binlogs(backup_dir, compressor)
+
+
+def setup_binlog_backups(backup_dir, database='default', compressor='gzip'):
+    _create_db_objects(database=database)
+    env['db'].setup_binlog_backups(backup_dir, compressor)
+
+
+def list_dumps(store):
+    """ list the dumps in a dump store, and how much space they all use """
+    dump_store = DumpStore(store)
+    for recipe in dump_store.list_dumps():
+        print '%s  %s  %.1f MB' % (recipe['created'], recipe['name'],
+                                   recipe['bytes'] / 1048576.0)
+    print 'The store uses %.1f MB' % (dump_store.stored_bytes() / 1048576.0)
+
+
+def prune_dumps(store, keep_days=None, keep_count=None):
+    """ delete the dumps in a dump store older than keep_days, apart from
+    the newest keep_count """
+    deleted, freed_bytes = DumpStore(store).prune(keep_days, keep_count)
+    print 'Deleted %d dumps, freeing %.1f MB' % (deleted, freed_bytes / 1048576.0)
+
+
+def restore_shadow_db(dump_filename='db_dump.sql', database='default',
+                      parallel=0, fast=False):
+    """ restore the dump into a new database next to the real one, ready for
+    swap_db """
     _create_db_objects(database=database)
-    env['db'].dump_db(dump_filename, for_rsync)
+    shadow = env['db'].create_shadow_db()
+    shadow.restore_db(dump_filename, parallel, fast=fast)
 
 
-def restore_db(dump_filename='db_dump.sql', database='default'):
+def swap_db(source_suffix='_restore', database='default'):
+    """ swap the tables restored by restore_shadow_db into the real database,
+    keeping the old tables in <name>_previous.  swap_db:_previous swaps
+    them back. """
     _create_db_objects(database=database)
-    env['db'].restore_db(dump_filename)
+    env['db'].swap_db(source_suffix, '_previous')
 
 
-def create_dbdump_cron_file(cron_file, dump_file_stub, database='default'):
+def create_dbdump_cron_file(cron_file, dump_file_stub, database='default',
+                            parallel=0, compressor=None, low_impact=False,
+                            bandwidth_limit=None, store=None, keep_days=None,
+                            keep_count=None):
     _create_db_objects(database=database)
-    env['db'].create_dbdump_cron_file(cron_file, dump_file_stub)
+    env['db'].create_dbdump_cron_file(cron_file, dump_file_stub, parallel,
+                                      compressor, low_impact, bandwidth_limit,
+                                      store, keep_days, keep_count)
 
 
-def setup_db_dumps(dump_dir, database='default'):
+def setup_db_dumps(dump_dir, database='default', parallel=0, compressor=None,
+                   low_impact=False, bandwidth_limit=None, store=None,
+                   keep_days=None, keep_count=None):
     _create_db_objects(database=database)
-    env['db'].setup_db_dumps(dump_dir)
+    env['db'].setup_db_dumps(dump_dir, parallel, compressor, low_impact,
+                             bandwidth_limit, store, keep_days, keep_count)
 
 
 def link_local_settings(environment):
@@ -0,0 +1,349 @@
+""" A store for database dumps that only keeps one copy of the parts of each
+dump that are the same as in other dumps.
+
+Each dump is cut into chunks where the content says so (so inserting a row
+only changes the chunk around it, not where every later chunk starts), and
+each chunk is saved once, zlib compressed and named by its sha1.  A dump is
+then a list of chunks - its recipe.  The layout in the store directory is:
+
+    chunks/ab/abcdef... - the chunks
+    dumps/<name>.json  - the recipes
+    pointers/<sha1>.json - where the pointer files (see below) were left
+    lock               - held shared by each writer, exclusively by prune
+
+A writer relies on chunks already in the store before its recipe is
+saved, so prune waits for the writers to finish before deleting chunks.
+
+A dump written with dump_db(store=...) leaves a small pointer file (the
+dump filename plus POINTER_EXTENSION) where the dump would have been, so
+restore_db and rollback can find it.  prune never deletes a dump that a
+pointer file still points to - so the dumps of the versions kept for
+rollback stay until the versions are deleted.
+"""
+import os
+from os import path
+import fcntl
+import hashlib
+import json
+import re
+import tempfile
+import time
+import zlib
+
+from .exceptions import InvalidArgumentError, TasksError
+
+POINTER_EXTENSION = '.store'
+# chunks are only cut at the end of a line or between two rows of an INSERT
+PIECE_END_RE = re.compile(r'\n|\),\(')
+# a chunk is cut after a piece whose crc32 is 0 modulo this, so on average
+# there are this many pieces in a chunk
+PIECES_PER_CHUNK = 256
+CHUNK_MIN_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+
+class _ChunkWriter(object):
+    """ Cuts everything written to it into chunks and adds them to the
+    store.  Has the same interface as database._CompressedFile, so
+    _dump_to_file can write to it. """
+
+    def __init__(self, store, name, lock_file):
+        self.store = store
+        self.name = name
+        # stops prune deleting the chunks this dump uses until the recipe
+        # has been saved
+        self.lock_file = lock_file
+        self.raw_bytes = 0
+        self.new_bytes = 0
+        self.new_chunks = 0
+        self.chunks = []
+        self.pieces = []
+        self.chunk_size = 0
+        self.buffer = ''
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self.buffer += data
+        start = 0
+        for match in PIECE_END_RE.finditer(self.buffer):
+            self._add_piece(self.buffer[start:match.end()])
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        # no line or row ends for a long way
+        if len(self.buffer) >= CHUNK_MAX_SIZE:
+            self._add_piece(self.buffer)
+            self.buffer = ''
+
+    def _add_piece(self, piece):
+        self.pieces.append(piece)
+        self.chunk_size += len(piece)
+        if self.chunk_size >= CHUNK_MAX_SIZE or (
+                self.chunk_size >= CHUNK_MIN_SIZE and
+                zlib.crc32(piece) % PIECES_PER_CHUNK == 0):
+            self._end_chunk()
+
+    def _end_chunk(self):
+        if not self.pieces:
+            return
+        chunk = ''.join(self.pieces)
+        self.pieces = []
+        self.chunk_size = 0
+        chunk_id, stored_bytes = self.store._add_chunk(chunk)
+        self.chunks.append([chunk_id, len(chunk)])
+        if stored_bytes:
+            self.new_chunks += 1
+            self.new_bytes += stored_bytes
+
+    def close(self):
+        """ Save the recipe.  Returns 0, like a compressor's exit code. """
+        try:
+            if self.buffer:
+                self.pieces.append(self.buffer)
+                self.buffer = ''
+            self._end_chunk()
+            self.store._write_recipe(self.name, {
+                'name': self.name,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'bytes': self.raw_bytes,
+                'chunks': self.chunks,
+            })
+        finally:
+            # closing the file releases the lock
+            self.lock_file.close()
+        return 0
+
+    def file_bytes(self):
+        """ The space this dump added to the store """
+        return self.new_bytes
+
+
+class _DumpReader(object):
+    """ Reads a dump back from its chunks, as a file object """
+
+    def __init__(self, store, recipe):
+        self.store = store
+        self.chunk_ids = [chunk_id for chunk_id, size in recipe['chunks']]
+        self.chunk_ids.reverse()
+        self.buffer = ''
+        # how far through buffer we have read
+        self.position = 0
+
+    def _fill(self):
+        if not self.chunk_ids:
+            return False
+        self.buffer = self.buffer[self.position:] + \
+            self.store._read_chunk(self.chunk_ids.pop())
+        self.position = 0
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) - self.position < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self.buffer) - self.position
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        end = self.buffer.find('\n', self.position)
+        while end < 0 and self._fill():
+            end = self.buffer.find('\n')
+        if end < 0:
+            end = len(self.buffer)
+        else:
+            end += 1
+        line = self.buffer[self.position:end]
+        self.position = end
+        return line
+
+    def close(self):
+        self.chunk_ids = []
+        self.buffer = ''
+        self.position = 0
+
+
+class DumpStore(object):
+
+    def __init__(self, store_dir):
+        self.store_dir = path.abspath(store_dir)
+        self.chunk_dir = path.join(self.store_dir, 'chunks')
+        self.recipe_dir = path.join(self.store_dir, 'dumps')
+        self.pointer_dir = path.join(self.store_dir, 'pointers')
+
+    def _lock(self, exclusive=False):
+        """ Return the open lock file of the store, once it is locked """
+        if not path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        lock_file = open(path.join(self.store_dir, 'lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except IOError:
+            lock_file.close()
+            raise
+        return lock_file
+
+    def _chunk_path(self, chunk_id):
+        return path.join(self.chunk_dir, chunk_id[:2], chunk_id)
+
+    def _recipe_path(self, name):
+        return path.join(self.recipe_dir, name + '.json')
+
+    def _write_atomically(self, filename, data):
+        """ Write to a temporary file and rename it, so a dump that is
+        interrupted never leaves half a file behind """
+        file_dir = path.dirname(filename)
+        if not path.isdir(file_dir):
+            os.makedirs(file_dir)
+        fd, tmp_filename = tempfile.mkstemp(dir=file_dir, prefix='.tmp-')
+        tmp_file = os.fdopen(fd, 'wb')
+        try:
+            tmp_file.write(data)
+        finally:
+            tmp_file.close()
+        os.rename(tmp_filename, filename)
+
+    def _add_chunk(self, chunk):
+        """ Save chunk unless it is already in the store.  Returns the chunk
+        id and the bytes used saving it (0 if it was already there). """
+        chunk_id = hashlib.sha1(chunk).hexdigest()
+        chunk_path = self._chunk_path(chunk_id)
+        if path.exists(chunk_path):
+            return chunk_id, 0
+        data = zlib.compress(chunk, 6)
+        self._write_atomically(chunk_path, data)
+        return chunk_id, len(data)
+
+    def _read_chunk(self, chunk_id):
+        try:
+            data = open(self._chunk_path(chunk_id), 'rb').read()
+        except IOError:
+            raise TasksError('Chunk %s is missing from %s' %
+                             (chunk_id, self.store_dir))
+        return zlib.decompress(data)
+
+    def _write_recipe(self, name, recipe):
+        self._write_atomically(self._recipe_path(name), json.dumps(recipe))
+
+    def _read_recipe(self, name):
+        recipe_path = self._recipe_path(name)
+        if not path.exists(recipe_path):
+            raise InvalidArgumentError('There is no dump called %s in %s' %
+                                       (name, self.store_dir))
+        return json.load(open(recipe_path))
+
+    def writer(self, dump_filename):
+        """ Return a file object to write a dump to.  The dump is named
+        after dump_filename and the time. """
+        name = '%s-%s' % (path.basename(dump_filename),
+                          time.strftime('%Y%m%d-%H%M%S'))
+        # two dumps in the same second
+        suffix = 1
+        unique_name = name
+        while path.exists(self._recipe_path(unique_name)):
+            suffix += 1
+            unique_name = '%s-%d' % (name, suffix)
+        return _ChunkWriter(self, unique_name, self._lock())
+
+    def write_pointer(self, dump_filename, name):
+        """ Leave a file at dump_filename + POINTER_EXTENSION saying where
+        the dump is, and remember where it is so prune keeps the dump """
+        pointer_filename = path.abspath(dump_filename + POINTER_EXTENSION)
+        self._write_atomically(pointer_filename,
+                               json.dumps({'store': self.store_dir, 'dump': name}))
+        self._write_atomically(
+            path.join(self.pointer_dir,
+                      hashlib.sha1(pointer_filename).hexdigest() + '.json'),
+            json.dumps({'pointer': pointer_filename}))
+
+    def _pointed_to_dumps(self):
+        """ Return the names of the dumps that pointer files still point to,
+        forgetting the pointer files that have been deleted """
+        names = set()
+        if not path.isdir(self.pointer_dir):
+            return names
+        for filename in os.listdir(self.pointer_dir):
+            if not filename.endswith('.json'):
+                continue
+            record_path = path.join(self.pointer_dir, filename)
+            pointer_filename = json.load(open(record_path))['pointer']
+            if not path.exists(pointer_filename):
+                os.remove(record_path)
+                continue
+            pointer = json.load(open(pointer_filename))
+            if path.abspath(pointer['store']) == self.store_dir:
+                names.add(pointer['dump'])
+        return names
+
+    def open_dump(self, name):
+        """ Return a file object to read the dump called name """
+        return _DumpReader(self, self._read_recipe(name))
+
+    def dump_size(self, name):
+        return self._read_recipe(name)['bytes']
+
+    def list_dumps(self):
+        """ Return the recipes of all the dumps, oldest first """
+        if not path.isdir(self.recipe_dir):
+            return []
+        recipes = [json.load(open(path.join(self.recipe_dir, filename)))
+                   for filename in os.listdir(self.recipe_dir)
+                   if filename.endswith('.json')]
+        return sorted(recipes, key=lambda recipe: (recipe['created'], recipe['name']))
+
+    def prune(self, keep_days=None, keep_count=None):
+        """ Delete the dumps older than keep_days, apart from the newest
+        keep_count and any a pointer file points to, and then the chunks no
+        dump uses any more.  Returns
+        (dumps deleted, bytes freed).  Waits for any dumps being written to
+        the store to finish first. """
+        lock_file = self._lock(exclusive=True)
+        try:
+            return self._prune(keep_days, keep_count)
+        finally:
+            lock_file.close()
+
+    def _prune(self, keep_days, keep_count):
+        recipes = self.list_dumps()
+        keep = set()
+        if keep_count is not None and int(keep_count) > 0:
+            keep.update(r['name'] for r in recipes[-int(keep_count):])
+        if keep_days is not None:
+            cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(
+                time.time() - float(keep_days) * 24 * 60 * 60))
+            keep.update(r['name'] for r in recipes if r['created'] >= cutoff)
+        elif keep_count is None:
+            keep.update(r['name'] for r in recipes)
+        keep.update(self._pointed_to_dumps())
+        deleted = 0
+        used_chunks = set()
+        for recipe in recipes:
+            if recipe['name'] in keep:
+                used_chunks.update(chunk_id for chunk_id, size in recipe['chunks'])
+            else:
+                os.remove(self._recipe_path(recipe['name']))
+                deleted += 1
+
+        freed_bytes = 0
+        if path.isdir(self.chunk_dir):
+            for chunk_subdir in os.listdir(self.chunk_dir):
+                for chunk_id in os.listdir(path.join(self.chunk_dir, chunk_subdir)):
+                    if chunk_id not in used_chunks:
+                        chunk_path = path.join(self.chunk_dir, chunk_subdir, chunk_id)
+                        freed_bytes += path.getsize(chunk_path)
+                        os.remove(chunk_path)
+        return deleted, freed_bytes
+
+    def stored_bytes(self):
+        """ The space used by all the chunks """
+        total = 0
+        if path.isdir(self.chunk_dir):
+            for dirpath, dirnames, filenames in os.walk(self.chunk_dir):
+                total += sum(path.getsize(path.join(dirpath, f)) for f in filenames)
+        return total
+
+
+def open_pointer(pointer_filename):
+    """ Return (store, dump name) for a pointer file left by dump_db """
+    pointer = json.load(open(pointer_filename))
+    return DumpStore(pointer['store']), pointer['dump']
@@ -7,7 +7,7 @@
 # The tasks it will do (eventually) include:
 #
 # * creating, updating and deleting the virtualenv
-# * creating, updating and deleting the database (sqlite or mysql)
+# * creating, updating and deleting the database (sqlite, mysql or postgres)
 # * setting up the local_settings stuff
 # * running tests
 """This script is to set up various things for our projects. It can be used by:
@@ -30,6 +30,28 @@ from .util import _check_call_wrapper, _call_wrapper, _rm_all_pyc
 from .environment import env
 from inspect import ismodule
 
+# compileall rewrites an out of date .pyc in place, which would change the
+# version being served as well if the .pyc is hard linked to it (see
+# release_copy_mode in fablib).  So compile each file to a new .pyc and
+# rename that into place.  Run by env['python_bin'] so the .pyc files are
+# for the right python.
+COMPILE_PYC_SCRIPT = r"""
+import imp, os, py_compile, struct, sys
+for root, dirs, files in os.walk(sys.argv[1]):
+    if '.ve' in dirs:
+        dirs.remove('.ve')
+    for name in files:
+        if not name.endswith('.py'):
+            continue
+        source = os.path.join(root, name)
+        compiled = source + 'c'
+        header = imp.get_magic() + struct.pack('<I', int(os.stat(source).st_mtime))
+        if os.path.exists(compiled) and open(compiled, 'rb').read(8) == header:
+            continue
+        py_compile.compile(source, compiled + '.tmp', source, doraise=True)
+        os.rename(compiled + '.tmp', compiled)
+"""
+
 
 def _setup_paths(project_settings, localtasks):
     """Set up the paths used by other tasks"""
@@ -150,8 +172,7 @@ def run_jenkins():
     _manage_py_jenkins()
 
 
-def deploy(environment=None):
-    """Do all the required steps in order"""
+def _set_environment(environment=None):
     if environment:
         env['environment'] = environment
     else:
@@ -159,12 +180,34 @@ def deploy(environment=None):
         if env['verbose']:
             print "Inferred environment as %s" % env['environment']
 
+
+def deploy(environment=None):
+    """Do all the required steps in order"""
+    _set_environment(environment)
+    prepare(env['environment'])
+    activate(env['environment'])
+
+
+def prepare(environment=None):
+    """Do the steps of deploy that don't touch the database.
+
+    fabric runs this in the new copy of the project while the old copy is
+    still being served, so none of this counts as downtime.  activate does
+    the rest."""
+    _set_environment(environment)
+
     create_private_settings()
     link_local_settings(env['environment'])
     update_git_submodules()
-    update_db()
-
     collect_static()
+    compile_pyc()
+
+
+def activate(environment=None):
+    """Do the steps of deploy that need the database - run after prepare"""
+    _set_environment(environment)
+
+    update_db()
 
     if hasattr(env['localtasks'], 'post_deploy'):
         env['localtasks'].post_deploy(env['environment'])
@@ -173,6 +216,17 @@ def deploy(environment=None):
             env['project_name'], env['environment'])
 
 
+def compile_pyc():
+    """Compile the python files, so it isn't done by the first requests after
+    the deploy.  The virtualenv is skipped as pip has already done that.
+    New .pyc files are written rather than rewriting the old ones - see
+    COMPILE_PYC_SCRIPT."""
+    if not env['quiet']:
+        print "### compiling python files"
+    _check_call_wrapper([env['python_bin'], '-c', COMPILE_PYC_SCRIPT,
+                         env['django_dir']])
+
+
 def patch_south():
     """ patch south to fix pydev errors """
     python = 'python2.6'
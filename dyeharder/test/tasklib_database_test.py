@@ -1,9 +1,16 @@
 import os
 from os import path
+import datetime
+import gzip
+import json
+import shutil
 import sys
 import StringIO
+import tempfile
+import time
 import unittest
 import sqlite3
+import zlib
 import MySQLdb
 
 dye_dir = path.join(path.dirname(__file__), os.pardir)
@@ -11,6 +18,7 @@ sys.path.append(dye_dir)
 import tasklib
 
 from tasklib import database
+from tasklib.exceptions import InvalidArgumentError, TasksError
 
 tasklib.env['verbose'] = False
 tasklib.env['quiet'] = True
@@ -68,6 +76,37 @@ class TestSqliteManager(unittest.TestCase):
         self.create_table()
         self.assertTrue(self.db.test_db_table_exists(self.TEST_TABLE))
 
+    def dump_and_change_db(self, compressor=None):
+        self.create_db()
+        self.create_table()
+        self.dump_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dump_dir)
+        dump_filename = path.join(self.dump_dir, 'db_dump.sql')
+        self.db.dump_db(dump_filename, compressor=compressor)
+        conn = sqlite3.connect(self.db.file_path)
+        conn.execute('DROP TABLE %s' % self.TEST_TABLE)
+        conn.close()
+        return dump_filename
+
+    def test_restore_db_puts_back_dump(self):
+        dump_filename = self.dump_and_change_db()
+        self.db.restore_db(dump_filename)
+        self.assertTrue(self.db.test_db_table_exists(self.TEST_TABLE))
+
+    def test_restore_db_puts_back_compressed_dump(self):
+        dump_filename = self.dump_and_change_db(compressor='gzip')
+        self.assertEqual(['db_dump.sql.gz'], os.listdir(self.dump_dir))
+        self.db.restore_db(dump_filename + '.gz')
+        self.assertTrue(self.db.test_db_table_exists(self.TEST_TABLE))
+
+    def test_restore_db_raises_error_for_file_that_is_not_sqlite(self):
+        self.create_db()
+        dump_filename = path.join(tempfile.mkdtemp(), 'db_dump.sql')
+        self.addCleanup(shutil.rmtree, path.dirname(dump_filename))
+        open(dump_filename, 'w').write('CREATE TABLE dyetable (id int);\n')
+        with self.assertRaises(InvalidArgumentError):
+            self.db.restore_db(dump_filename)
+
 
 class MysqlMixin(object):
 
@@ -338,6 +377,211 @@ class TestDatabaseCreateFunctions(MysqlMixin, unittest.TestCase):
     # check db and table exist
 
 
+class TestMysqlShadowDb(MysqlMixin, unittest.TestCase):
+
+    def tearDown(self):
+        for suffix in ('_restore', '_previous', '_swap'):
+            self.db.drop_shadow_db(suffix)
+        self.drop_database()
+
+    def test_swap_db_moves_shadow_tables_in_and_keeps_old_tables(self):
+        self.create_database()
+        self.create_table()
+        shadow = self.db.create_shadow_db()
+        shadow.exec_as_root('CREATE TABLE %s.newtable(mycolumn CHAR(30))' %
+                            shadow.name)
+        self.db.swap_db()
+        self.assertEqual(['newtable'], self.db._get_base_tables(self.TEST_DB))
+        self.assertEqual([self.TEST_TABLE],
+                         self.db._get_base_tables(self.TEST_DB + '_previous'))
+        self.assertFalse(shadow.db_exists())
+
+    def get_trigger_tables(self, db_name):
+        cursor = self.db.get_root_db_cursor()
+        try:
+            cursor.execute("SELECT trigger_name, event_object_table "
+                           "FROM information_schema.triggers "
+                           "WHERE trigger_schema = %s", (db_name,))
+            return list(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def test_swap_db_moves_triggers_with_their_tables(self):
+        self.create_database()
+        self.create_table()
+        self.db.exec_as_root(
+            'CREATE TRIGGER %s.oldtrigger BEFORE INSERT ON %s.%s FOR EACH ROW '
+            'SET NEW.mycolumn = LOWER(NEW.mycolumn)' %
+            (self.TEST_DB, self.TEST_DB, self.TEST_TABLE))
+        shadow = self.db.create_shadow_db()
+        shadow.exec_as_root('CREATE TABLE %s.newtable(mycolumn CHAR(30))' %
+                            shadow.name)
+        shadow.exec_as_root(
+            'CREATE TRIGGER %s.newtrigger BEFORE INSERT ON %s.newtable '
+            'FOR EACH ROW SET NEW.mycolumn = UPPER(NEW.mycolumn)' %
+            (shadow.name, shadow.name))
+        self.db.swap_db()
+        self.assertEqual([('newtrigger', 'newtable')],
+                         self.get_trigger_tables(self.TEST_DB))
+        self.assertEqual([('oldtrigger', self.TEST_TABLE)],
+                         self.get_trigger_tables(self.TEST_DB + '_previous'))
+
+    def test_swap_db_with_previous_swaps_back(self):
+        self.create_database()
+        self.create_table()
+        shadow = self.db.create_shadow_db()
+        shadow.exec_as_root('CREATE TABLE %s.newtable(mycolumn CHAR(30))' %
+                            shadow.name)
+        self.db.swap_db()
+        self.db.swap_db('_previous', '_previous')
+        self.assertEqual([self.TEST_TABLE], self.db._get_base_tables(self.TEST_DB))
+        self.assertEqual(['newtable'],
+                         self.db._get_base_tables(self.TEST_DB + '_previous'))
+
+
+class TestMysqlPointInTime(MysqlMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestMysqlPointInTime, self).setUp()
+        self.get_mysql_root_password()
+        cursor = self.db.get_root_db_cursor()
+        try:
+            cursor.execute("SHOW VARIABLES LIKE 'log_bin'")
+            log_bin = cursor.fetchone()
+        finally:
+            cursor.close()
+        if log_bin is None or log_bin[1] != 'ON':
+            self.skipTest('binary logging is not on in the test mysqld')
+        self.backup_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.backup_dir)
+        self.drop_database()
+
+    def insert_row(self, value):
+        self.db.exec_as_root("INSERT INTO %s.%s VALUES ('%s')" %
+                             (self.TEST_DB, self.TEST_TABLE, value))
+
+    def get_rows(self):
+        cursor = self.db.get_root_db_cursor()
+        try:
+            cursor.execute('SELECT mycolumn FROM %s.%s ORDER BY mycolumn' %
+                           (self.TEST_DB, self.TEST_TABLE))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def test_restore_db_replays_binlogs_up_to_stop_datetime(self):
+        self.create_database()
+        self.create_table()
+        self.insert_row('in base')
+        self.db.backup_db_base(self.backup_dir)
+        self.insert_row('before stop')
+        time.sleep(1.1)
+        stop_datetime = time.strftime('%Y-%m-%d %H:%M:%S')
+        time.sleep(1.1)
+        self.insert_row('after stop')
+        self.db.backup_binlogs(self.backup_dir)
+
+        self.db.restore_db(self.backup_dir, stop_datetime=stop_datetime)
+        self.assertEqual(['before stop', 'in base'], self.get_rows())
+
+    def test_backup_binlogs_does_not_copy_binlogs_from_before_the_bases(self):
+        self.create_database()
+        self.create_table()
+        self.insert_row('first base')
+        self.db.backup_db_base(self.backup_dir, keep_bases=1)
+        self.insert_row('second base')
+        self.db.backup_db_base(self.backup_dir, keep_bases=1)
+        binlog_dir = path.join(self.backup_dir, 'binlogs')
+        oldest_binlog = self.db._read_backup_manifest(
+            self.backup_dir)['bases'][0]['binlog_file']
+
+        self.db.backup_binlogs(self.backup_dir)
+        first_copies = dict((filename, path.getmtime(path.join(binlog_dir, filename)))
+                            for filename in os.listdir(binlog_dir))
+        time.sleep(1.1)
+        self.db.backup_binlogs(self.backup_dir)
+
+        for filename in os.listdir(binlog_dir):
+            self.assertTrue(database._strip_compressor_extension(filename) >= oldest_binlog,
+                            '%s is from before the base backup' % filename)
+            if filename in first_copies:
+                # not copied again
+                self.assertEqual(first_copies[filename],
+                                 path.getmtime(path.join(binlog_dir, filename)))
+        # only the binary log the first run started is new
+        self.assertEqual(len(first_copies) + 1, len(os.listdir(binlog_dir)))
+
+
+class TestMysqlVerifyDb(MysqlMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestMysqlVerifyDb, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.dump_dir = path.join(self.temp_dir, 'dump')
+        self.create_database()
+        self.create_table()
+        self.db.exec_as_root("INSERT INTO %s.%s VALUES ('one'), ('two')" %
+                             (self.TEST_DB, self.TEST_TABLE))
+        self.db.dump_db(self.dump_dir, checksums=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        self.drop_database()
+
+    def test_verify_db_passes_when_tables_match_dump(self):
+        self.db.verify_db(self.dump_dir)
+
+    def test_tab_dump_is_restored_with_load_data(self):
+        tab_dir = path.join(self.temp_dir, 'tab')
+        self.db.dump_db(tab_dir, data_format='tab', checksums=True)
+        self.assertTrue(path.exists(
+            path.join(tab_dir, self.TEST_TABLE + '.txt.gz')))
+        self.drop_database()
+        self.create_database()
+        self.db.restore_db(tab_dir, fast=True)
+        self.db.verify_db(tab_dir)
+
+    def test_low_impact_parallel_dump_matches_the_tables(self):
+        low_impact_dir = path.join(self.temp_dir, 'low_impact')
+        self.db.dump_db(low_impact_dir, parallel=2, checksums=True,
+                        low_impact=True)
+        self.db.verify_db(low_impact_dir)
+
+    def test_verify_db_raises_error_when_table_has_changed(self):
+        self.db.exec_as_root("UPDATE %s.%s SET mycolumn = 'three'" %
+                             (self.TEST_DB, self.TEST_TABLE))
+        with self.assertRaises(TasksError):
+            self.db.verify_db(self.dump_dir)
+
+
+class TestMysqlDumpToStdout(MysqlMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestMysqlDumpToStdout, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.create_database()
+        self.create_table()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        self.drop_database()
+
+    def test_dump_db_to_stdout_uses_compressor(self):
+        stdout_filename = path.join(self.temp_dir, 'stdout')
+        saved_stdout = sys.stdout
+        sys.stdout = open(stdout_filename, 'wb')
+        try:
+            self.db.dump_db('-', compressor='gzip')
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved_stdout
+        dump = zlib.decompress(open(stdout_filename, 'rb').read(),
+                               16 + zlib.MAX_WBITS)
+        self.assertTrue('CREATE TABLE `%s`' % self.TEST_TABLE in dump)
+
+
 class TestMysqlDumpCron(MysqlMixin, unittest.TestCase):
 
     def test_create_dbdump_cron_file_writes_correct_output(self):
@@ -348,9 +592,408 @@ class TestMysqlDumpCron(MysqlMixin, unittest.TestCase):
         expected_output = \
             "#!/bin/sh\n" \
             "/usr/bin/mysqldump -u dye_user -pdye_password " \
-            "--host=localhost dyedb > /var/dumps/dye-`/bin/date +\%d`.sql\n"
+            "--host=localhost dyedb > /var/dumps/dye-`/bin/date +\\%d`.sql\n"
+        self.assertEqual(expected_output, actual_output)
+
+    def test_create_dbdump_cron_file_uses_tasks_for_parallel_dumps(self):
+        tasklib.env['deploy_dir'] = '/var/django/dye/current/deploy'
+        dump_file_stub = '/var/dumps/dye-'
+        output_file = StringIO.StringIO()
+        self.db.create_dbdump_cron_file(output_file, dump_file_stub, parallel=4)
+        actual_output = output_file.getvalue()
+        expected_output = \
+            "#!/bin/sh\n" \
+            "/var/django/dye/current/deploy/tasks.py " \
+            "dump_db:/var/dumps/dye-`/bin/date +\\%d`,parallel=4\n"
+        self.assertEqual(expected_output, actual_output)
+
+    def test_create_dbdump_cron_file_uses_tasks_for_compressed_dumps(self):
+        tasklib.env['deploy_dir'] = '/var/django/dye/current/deploy'
+        dump_file_stub = '/var/dumps/dye-'
+        output_file = StringIO.StringIO()
+        self.db.create_dbdump_cron_file(output_file, dump_file_stub,
+                                        compressor='gzip')
+        actual_output = output_file.getvalue()
+        expected_output = \
+            "#!/bin/sh\n" \
+            "/var/django/dye/current/deploy/tasks.py " \
+            "dump_db:/var/dumps/dye-`/bin/date +\\%d`.sql,compressor=gzip\n"
+        self.assertEqual(expected_output, actual_output)
+
+    def test_create_dbdump_cron_file_uses_tasks_for_low_impact_dumps(self):
+        tasklib.env['deploy_dir'] = '/var/django/dye/current/deploy'
+        dump_file_stub = '/var/dumps/dye-'
+        output_file = StringIO.StringIO()
+        self.db.create_dbdump_cron_file(output_file, dump_file_stub,
+                                        low_impact=True, bandwidth_limit=5)
+        actual_output = output_file.getvalue()
+        expected_output = \
+            "#!/bin/sh\n" \
+            "/var/django/dye/current/deploy/tasks.py " \
+            "dump_db:/var/dumps/dye-`/bin/date +\\%d`.sql," \
+            "low_impact=true,bandwidth_limit=5\n"
         self.assertEqual(expected_output, actual_output)
 
 
+class TestPostgresManager(unittest.TestCase):
+
+    def setUp(self):
+        self.db = database.get_db_manager(
+            engine='postgresql_psycopg2',
+            name='dyedb',
+            user='dye_user',
+            password='dye_password',
+            port='5433',
+            host='127.0.0.1',
+        )
+
+    def test_create_cmdline_args_has_no_password(self):
+        self.assertEqual(
+            ['-U', 'dye_user', '-h', '127.0.0.1', '-p', '5433', '-d', 'dyedb'],
+            self.db.create_cmdline_args())
+        self.assertEqual('dye_password', self.db._pg_environ()['PGPASSWORD'])
+
+    def test_create_dbdump_cron_file_uses_tasks_for_parallel_dumps(self):
+        tasklib.env['deploy_dir'] = '/var/django/dye/current/deploy'
+        output_file = StringIO.StringIO()
+        self.db.create_dbdump_cron_file(output_file, '/var/dumps/dye-',
+                                        parallel=4)
+        expected_output = \
+            "#!/bin/sh\n" \
+            "/var/django/dye/current/deploy/tasks.py " \
+            "dump_db:/var/dumps/dye-`/bin/date +\\%d`,parallel=4\n"
+        self.assertEqual(expected_output, output_file.getvalue())
+
+    def test_is_pg_archive_only_for_pg_dump_formats(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        sql_filename = path.join(temp_dir, 'db_dump.sql')
+        open(sql_filename, 'w').write('CREATE TABLE dyetable (id int);\n')
+        custom_filename = path.join(temp_dir, 'db_dump.custom')
+        open(custom_filename, 'w').write('PGDMP\x01\x0e')
+        open(path.join(temp_dir, 'toc.dat'), 'w').close()
+        self.assertFalse(database._is_pg_archive(sql_filename))
+        self.assertTrue(database._is_pg_archive(custom_filename))
+        self.assertTrue(database._is_pg_archive(temp_dir))
+
+
+class TestUpdateCronFile(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cron_file = path.join(self.temp_dir, 'dump_dye')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_update_cron_file_only_writes_changed_contents(self):
+        self.assertTrue(database._update_cron_file(self.cron_file, 'old job\n'))
+        self.assertFalse(database._update_cron_file(self.cron_file, 'old job\n'))
+        self.assertTrue(database._update_cron_file(self.cron_file, 'new job\n'))
+        self.assertEqual('new job\n', open(self.cron_file).read())
+        self.assertTrue(os.access(self.cron_file, os.X_OK))
+
+
+class TestDumpCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_compressor_for_filename_uses_extension(self):
+        self.assertEqual('gzip', database._compressor_for_filename('dump.sql.gz'))
+        self.assertEqual('zstd', database._compressor_for_filename('dump.sql.zst'))
+        self.assertEqual('lz4', database._compressor_for_filename('dump.sql.lz4'))
+        self.assertEqual(None, database._compressor_for_filename('dump.sql'))
+
+    def test_dump_compressor_compresses_stdout_but_not_store(self):
+        self.assertEqual(('-', 'gzip'), database._dump_compressor('-', 'gzip'))
+        self.assertEqual(('dump.sql.gz', 'gzip'),
+                         database._dump_compressor('dump.sql', 'gzip'))
+        self.assertEqual(('dump.sql.zst', 'zstd'),
+                         database._dump_compressor('dump.sql.zst', None))
+        self.assertEqual(('dump.sql', None),
+                         database._dump_compressor('dump.sql', 'gzip', '/store'))
+
+    def test_dump_to_stdout_is_compressed(self):
+        stdout_filename = path.join(self.temp_dir, 'stdout')
+        saved_stdout = sys.stdout
+        sys.stdout = open(stdout_filename, 'wb')
+        try:
+            returncode = database._dump_to_file(
+                ['echo', 'CREATE TABLE dyetable;'], '-', 'gzip', report=False)
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved_stdout
+        self.assertEqual(0, returncode)
+        self.assertEqual('CREATE TABLE dyetable;\n',
+                         zlib.decompress(open(stdout_filename, 'rb').read(),
+                                         16 + zlib.MAX_WBITS))
+
+    def test_get_compressor_raises_error_for_unknown_compressor(self):
+        with self.assertRaises(InvalidArgumentError):
+            database._get_compressor('rar')
+
+    def test_dump_stats_includes_compression_ratio(self):
+        stats = database._dump_stats(4 * 1024 * 1024, 1024 * 1024, 2.0)
+        self.assertEqual('4.0 MB in 2.0 seconds (2.0 MB/s), '
+                         'compressed to 1.0 MB (ratio 4.0:1)', stats)
+
+    def test_dump_to_file_compresses_output(self):
+        dump_filename = path.join(self.temp_dir, 'dump.sql.gz')
+        returncode = database._dump_to_file(
+            ['echo', 'CREATE TABLE dyetable;'], dump_filename, 'gzip')
+        self.assertEqual(0, returncode)
+        dump_file = gzip.open(dump_filename)
+        try:
+            self.assertEqual('CREATE TABLE dyetable;\n', dump_file.read())
+        finally:
+            dump_file.close()
+
+    def test_throttle_waits_for_the_bandwidth_limit(self):
+        throttle = database._Throttle(1)
+        start = time.time()
+        throttle.wait(256 * 1024)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_dump_to_file_returns_dump_command_exit_code(self):
+        dump_filename = path.join(self.temp_dir, 'dump.sql.gz')
+        returncode = database._dump_to_file(['false'], dump_filename, 'gzip')
+        self.assertNotEqual(0, returncode)
+
+
+class TestRestoreProgress(unittest.TestCase):
+
+    def test_progress_line_shows_percentage_rate_and_eta(self):
+        line = database._progress_line('dump.sql', 5 * 1024 * 1024,
+                                       20 * 1024 * 1024, 5.0, width=10)
+        self.assertEqual('dump.sql [##        ]  25% 1.0 MB/s ETA 0:15', line)
+
+    def test_progress_line_does_not_go_past_100_percent(self):
+        line = database._progress_line('dump.sql', 200, 100, 1.0, width=10)
+        self.assertIn('[##########] 100%', line)
+
+    def test_copy_stream_copies_everything(self):
+        source = StringIO.StringIO('x' * (database.DUMP_CHUNK_SIZE + 10))
+        dest = StringIO.StringIO()
+        database._copy_stream(source, dest)
+        self.assertEqual(database.DUMP_CHUNK_SIZE + 10, len(dest.getvalue()))
+
+
+class TestPointInTimeReplay(unittest.TestCase):
+
+    BASES = [
+        {'file': 'base-1.sql.gz', 'created': '2014-03-01 02:00:00',
+         'binlog_file': 'mysql-bin.000009', 'binlog_position': 4},
+        {'file': 'base-2.sql.gz', 'created': '2014-03-08 02:00:00',
+         'binlog_file': 'mysql-bin.000099', 'binlog_position': 4},
+    ]
+
+    def test_choose_base_backup_picks_newest_before_stop(self):
+        self.assertEqual('base-1.sql.gz', database._choose_base_backup(
+            self.BASES, '2014-03-05 12:00:00')['file'])
+        self.assertEqual('base-2.sql.gz',
+                         database._choose_base_backup(self.BASES)['file'])
+        self.assertEqual(None, database._choose_base_backup(
+            self.BASES, '2014-02-01 00:00:00'))
+
+    def test_binlogs_to_replay_starts_at_base_binlog(self):
+        binlogs = database._binlogs_to_replay('mysql-bin.000099', [
+            'mysql-bin.000100.gz', 'mysql-bin.000098.gz', 'mysql-bin.000099.gz'])
+        self.assertEqual(['mysql-bin.000099.gz', 'mysql-bin.000100.gz'], binlogs)
+
+    def test_binlogs_to_replay_raises_error_for_missing_binlog(self):
+        with self.assertRaises(TasksError):
+            database._binlogs_to_replay('mysql-bin.000099', [
+                'mysql-bin.000099.gz', 'mysql-bin.000101.gz'])
+
+    def test_binlog_position_re_reads_mysqldump_header(self):
+        match = database.BINLOG_POSITION_RE.match(
+            "-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.000012', "
+            "MASTER_LOG_POS=154;\n")
+        self.assertEqual('mysql-bin.000012', match.group('file'))
+        self.assertEqual('154', match.group('position'))
+
+
+class TestCompareChecksums(unittest.TestCase):
+
+    def test_compare_checksums_reports_changed_and_missing_tables(self):
+        mismatches = database._compare_checksums(
+            {'same': 1, 'changed': 2, 'dropped': 3},
+            {'same': 1, 'changed': 4, 'added': 5},
+            'the dump', 'dyedb')
+        self.assertEqual([
+            'added: not in the dump',
+            'changed: checksum 2 in the dump, 4 in dyedb',
+            'dropped: not in dyedb',
+        ], mismatches)
+
+
+class TestSubsetWhereClauses(unittest.TestCase):
+
+    TABLES = ['django_session', 'auth_user', 'shop_order', 'shop_line']
+    FOREIGN_KEYS = {
+        'shop_order': [(['user_id'], 'auth_user', ['id'])],
+        'shop_line': [(['order_id'], 'shop_order', ['id'])],
+    }
+    PRIMARY_KEYS = {'auth_user': ['id'], 'shop_order': ['id']}
+
+    def test_structure_only_tables_have_no_data(self):
+        where_clauses = database._subset_where_clauses(
+            self.TABLES, {'structure_only': ['django_session']},
+            self.FOREIGN_KEYS, self.PRIMARY_KEYS)
+        self.assertEqual(
+            {'auth_user': None, 'shop_order': None, 'shop_line': None},
+            where_clauses)
+
+    def test_limit_is_ordered_by_primary_key(self):
+        where_clauses = database._subset_where_clauses(
+            self.TABLES, {'limit': {'shop_order': 10}},
+            self.FOREIGN_KEYS, self.PRIMARY_KEYS)
+        self.assertEqual('1 ORDER BY `id` LIMIT 10', where_clauses['shop_order'])
+
+    def test_foreign_keys_follow_referenced_rows(self):
+        where_clauses = database._subset_where_clauses(
+            self.TABLES, {'where': {'auth_user': 'is_staff = 1'}},
+            self.FOREIGN_KEYS, self.PRIMARY_KEYS)
+        self.assertEqual('(is_staff = 1)', where_clauses['auth_user'])
+        self.assertEqual(
+            '(`user_id` IS NULL OR `user_id` IN '
+            '(SELECT `id` FROM `auth_user` WHERE (is_staff = 1)))',
+            where_clauses['shop_order'])
+        self.assertEqual(
+            '(`order_id` IS NULL OR `order_id` IN (SELECT `id` FROM `shop_order` '
+            'WHERE (`user_id` IS NULL OR `user_id` IN '
+            '(SELECT `id` FROM `auth_user` WHERE (is_staff = 1)))))',
+            where_clauses['shop_line'])
+
+    def test_foreign_keys_not_followed_when_turned_off(self):
+        where_clauses = database._subset_where_clauses(
+            self.TABLES, {'limit': {'auth_user': 5}, 'follow_foreign_keys': False},
+            self.FOREIGN_KEYS, self.PRIMARY_KEYS)
+        self.assertEqual(None, where_clauses['shop_order'])
+
+
+MYSQLDUMP_OUTPUT = """-- MySQL dump 10.13
+/*!40101 SET NAMES utf8 */;
+
+--
+-- Table structure for table `dyetable`
+--
+
+DROP TABLE IF EXISTS `dyetable`;
+CREATE TABLE `dyetable` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(30) NOT NULL,
+  `other_id` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name` (`name`),
+  KEY `other_id` (`other_id`),
+  CONSTRAINT `other_fk` FOREIGN KEY (`other_id`) REFERENCES `other` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+--
+-- Dumping data for table `dyetable`
+--
+
+LOCK TABLES `dyetable` WRITE;
+INSERT INTO `dyetable` VALUES (1,'a),(b',2),(2,'c',2);
+UNLOCK TABLES;
+
+--
+-- Final view structure for view `dyeview`
+--
+
+CREATE VIEW `dyeview` AS SELECT 1;
+"""
+
+
+class TestParallelRestoreParsing(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_count_insert_rows_ignores_separators_in_strings(self):
+        self.assertEqual(2, database._count_insert_rows(
+            "INSERT INTO `t` VALUES (1,'a),(b'),(2,'it\\'s),(');"))
+
+    def test_split_mysqldump_puts_data_in_file_per_table(self):
+        schema, tables = database._split_mysqldump(
+            StringIO.StringIO(MYSQLDUMP_OUTPUT), self.temp_dir)
+        self.assertEqual(['dyetable'], tables.keys())
+        data_filename, rows = tables['dyetable']
+        self.assertEqual(2, rows)
+        data = open(data_filename).read()
+        self.assertTrue(data.startswith('-- MySQL dump 10.13\n/*!40101 SET NAMES'))
+        self.assertTrue('INSERT INTO `dyetable`' in data)
+        self.assertFalse('CREATE' in data)
+        self.assertFalse('INSERT' in schema)
+        self.assertTrue('CREATE TABLE `dyetable`' in schema)
+        self.assertTrue('CREATE VIEW `dyeview`' in schema)
+
+    def test_tab_field_escapes_values_for_load_data(self):
+        self.assertEqual('\\N', database._tab_field(None))
+        self.assertEqual('a\\tb\\nc\\\\N', database._tab_field('a\tb\nc\\N'))
+        self.assertEqual('caf\xc3\xa9', database._tab_field(u'caf\xe9'))
+        self.assertEqual('26:00:03', database._tab_field(
+            datetime.timedelta(days=1, hours=2, seconds=3)))
+        self.assertEqual('-0:00:01', database._tab_field(datetime.timedelta(seconds=-1)))
+
+    def test_filter_schema_tables_leaves_out_other_sections(self):
+        schema = database._filter_schema_tables(MYSQLDUMP_OUTPUT, ['dyetable'])
+        self.assertTrue(schema.startswith('-- MySQL dump 10.13\n'))
+        self.assertTrue('CREATE TABLE `dyetable`' in schema)
+        self.assertFalse('dyeview' in schema)
+        schema = database._filter_schema_tables(MYSQLDUMP_OUTPUT, ['other'])
+        self.assertFalse('dyetable' in schema)
+
+    def test_indexed_dump_has_member_per_table(self):
+        dump_filename = path.join(self.temp_dir, 'dump.sql.gz')
+        output = database._IndexedCompressedFile(dump_filename, 'gzip')
+        database._write_indexed_dump(
+            StringIO.StringIO(MYSQLDUMP_OUTPUT), output)
+        self.assertEqual(0, output.close())
+        # still a normal gzip file
+        dump_file = gzip.open(dump_filename)
+        try:
+            self.assertEqual(MYSQLDUMP_OUTPUT, dump_file.read())
+        finally:
+            dump_file.close()
+        index = json.load(open(dump_filename + database.DUMP_INDEX_EXTENSION))
+        self.assertEqual([None, 'dyetable', None],
+                         [m['table'] for m in index['members']])
+        member = index['members'][1]
+        dump_file = open(dump_filename, 'rb')
+        dump_file.seek(member['offset'])
+        table_sql = zlib.decompress(dump_file.read(member['length']),
+                                    16 + zlib.MAX_WBITS)
+        dump_file.close()
+        self.assertTrue(table_sql.startswith('--\n-- Table structure for table `dyetable`'))
+        self.assertTrue('INSERT INTO `dyetable`' in table_sql)
+        self.assertFalse('dyeview' in table_sql)
+
+    def test_strip_secondary_keys_leaves_primary_key(self):
+        schema, stripped = database._strip_secondary_keys(MYSQLDUMP_OUTPUT)
+        self.assertTrue(
+            "  `other_id` int(11) NOT NULL,\n"
+            "  PRIMARY KEY (`id`)\n"
+            ") ENGINE=InnoDB" in schema)
+        self.assertEqual(
+            (['UNIQUE KEY `name` (`name`)', 'KEY `other_id` (`other_id`)'],
+             ['CONSTRAINT `other_fk` FOREIGN KEY (`other_id`) REFERENCES `other` (`id`)']),
+            stripped['dyetable'])
+
+    def test_strip_secondary_keys_keeps_keys_needed_for_auto_increment(self):
+        schema, stripped = database._strip_secondary_keys(
+            MYSQLDUMP_OUTPUT.replace('  PRIMARY KEY (`id`),\n', ''))
+        self.assertTrue('  KEY `other_id` (`other_id`)\n) ENGINE' in schema)
+        self.assertEqual([], stripped['dyetable'][0])
+
+
 if __name__ == '__main__':
     unittest.main()
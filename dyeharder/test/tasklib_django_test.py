@@ -159,5 +159,17 @@ class TestLinkLocalSettings(unittest.TestCase):
     # patch south
 
 
+
+class TestSqlCreateTableRe(unittest.TestCase):
+
+    def test_finds_mysql_and_postgres_table_names(self):
+        match = tasklib.django.SQL_CREATE_TABLE_RE.match
+        self.assertEqual('app_thing',
+            match('CREATE TABLE `app_thing` (').group('table'))
+        self.assertEqual('app_thing',
+            match('CREATE TABLE "app_thing" (').group('table'))
+        self.assertIsNone(match('CREATE INDEX `app_thing_1` ON `app_thing`'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,125 @@
+import os
+from os import path
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+dye_dir = path.join(path.dirname(__file__), os.pardir)
+sys.path.append(dye_dir)
+
+from tasklib import dumpstore
+from tasklib.exceptions import InvalidArgumentError
+
+
+def make_dump(rows, changed_row=None):
+    lines = ['-- MySQL dump\n', 'CREATE TABLE `dyetable` (`id` int);\n']
+    values = []
+    for row in range(rows):
+        if row == changed_row:
+            values.append("(%d,'changed')" % row)
+        else:
+            values.append("(%d,'row number %d of the table')" % (row, row))
+        if len(values) == 1000:
+            lines.append('INSERT INTO `dyetable` VALUES %s;\n' % ','.join(values))
+            values = []
+    if values:
+        lines.append('INSERT INTO `dyetable` VALUES %s;\n' % ','.join(values))
+    lines.append('-- Dump completed\n')
+    return ''.join(lines)
+
+
+class TestDumpStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = dumpstore.DumpStore(path.join(self.temp_dir, 'store'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def add_dump(self, data, dump_filename='db_dump.sql'):
+        writer = self.store.writer(dump_filename)
+        # in pieces that don't line up with the lines
+        for start in range(0, len(data), 10000):
+            writer.write(data[start:start + 10000])
+        writer.close()
+        return writer
+
+    def test_dump_is_read_back_the_same(self):
+        data = make_dump(50000)
+        writer = self.add_dump(data)
+        self.assertEqual(data, self.store.open_dump(writer.name).read())
+
+    def test_readline_reads_lines(self):
+        data = make_dump(50000)
+        writer = self.add_dump(data)
+        lines = list(iter(self.store.open_dump(writer.name).readline, ''))
+        self.assertEqual(data.splitlines(True), lines)
+
+    def test_changed_dump_only_stores_changed_chunks(self):
+        first = self.add_dump(make_dump(50000))
+        second = self.add_dump(make_dump(50000, changed_row=25000))
+        self.assertTrue(len(first.chunks) > 10)
+        self.assertTrue(second.new_chunks <= 2)
+
+    def test_pointer_file_finds_the_dump(self):
+        data = make_dump(100)
+        dump_filename = path.join(self.temp_dir, 'db_dump.sql')
+        writer = self.add_dump(data, dump_filename)
+        self.store.write_pointer(dump_filename, writer.name)
+        store, name = dumpstore.open_pointer(
+            dump_filename + dumpstore.POINTER_EXTENSION)
+        self.assertEqual(data, store.open_dump(name).read())
+
+    def test_prune_keeps_newest_and_deletes_unused_chunks(self):
+        self.add_dump(make_dump(50000))
+        newest = self.add_dump(make_dump(50000, changed_row=25000))
+        deleted, freed_bytes = self.store.prune(keep_count=1)
+        self.assertEqual(1, deleted)
+        self.assertTrue(freed_bytes > 0)
+        self.assertEqual([newest.name],
+                         [recipe['name'] for recipe in self.store.list_dumps()])
+        self.assertEqual(make_dump(50000, changed_row=25000),
+                         self.store.open_dump(newest.name).read())
+
+    def test_prune_keeps_dumps_pointer_files_point_to(self):
+        old_dump_filename = path.join(self.temp_dir, 'old', 'db_dump.sql')
+        os.makedirs(path.dirname(old_dump_filename))
+        old = self.add_dump(make_dump(50000), old_dump_filename)
+        self.store.write_pointer(old_dump_filename, old.name)
+        self.add_dump(make_dump(50000, changed_row=25000))
+        self.add_dump(make_dump(50000, changed_row=100))
+
+        deleted, freed_bytes = self.store.prune(keep_count=1)
+        self.assertEqual(1, deleted)
+        store, name = dumpstore.open_pointer(
+            old_dump_filename + dumpstore.POINTER_EXTENSION)
+        self.assertEqual(make_dump(50000), store.open_dump(name).read())
+
+        # once the version with the pointer is deleted, so can the dump be
+        shutil.rmtree(path.dirname(old_dump_filename))
+        deleted, freed_bytes = self.store.prune(keep_count=1)
+        self.assertEqual(1, deleted)
+        self.assertEqual(1, len(self.store.list_dumps()))
+
+    def test_prune_waits_for_dump_being_written(self):
+        data = make_dump(50000)
+        self.add_dump(data)
+        writer = self.store.writer('db_dump.sql')
+        # only uses chunks that are already in the store
+        writer.write(data)
+        prune = threading.Thread(target=self.store.prune, kwargs={'keep_count': 1})
+        prune.start()
+        prune.join(0.5)
+        self.assertTrue(prune.is_alive())
+        writer.close()
+        prune.join()
+        self.assertEqual([writer.name],
+                         [recipe['name'] for recipe in self.store.list_dumps()])
+        self.assertEqual(data, self.store.open_dump(writer.name).read())
+
+    def test_open_dump_raises_error_for_unknown_dump(self):
+        with self.assertRaises(InvalidArgumentError):
+            self.store.open_dump('not-a-dump')
@@ -6,12 +6,16 @@ Usage:
     bootstrap.py               # update virtualenv
     bootstrap.py fake          # just update the virtualenv timestamps
     bootstrap.py clean         # delete the virtualenv
+    bootstrap.py wheels -w DIR # build wheels for the requirements into DIR
+    bootstrap.py hash          # print the name of the wheelhouse to use
     bootstrap.py -h | --help   # print this message and exit
 
 Options for the plain command:
     -f, --force            # do the virtualenv update even if it is up to date
     -r, --full-rebuild     # delete the virtualenv before rebuilding
     -q, --quiet            # don't ask for user input
+    -w, --wheelhouse DIR   # install from the wheels in DIR, without using
+                           # the network
 """
 # a script to set up the virtualenv so we can use fabric and tasks
 import sys
@@ -37,11 +41,14 @@ def main(argv):
     full_rebuild = False
     fake_update = False
     clean_ve = False
+    build_wheels = False
+    print_hash = False
+    wheelhouse = None
 
     if argv:
         try:
-            opts, args = getopt.getopt(argv[1:], 'hfqr',
-                ['help', 'force', 'quiet', 'full-rebuild'])
+            opts, args = getopt.gnu_getopt(argv[1:], 'hfqrw:',
+                ['help', 'force', 'quiet', 'full-rebuild', 'wheelhouse='])
         except getopt.error, msg:
             return print_error_msg('Bad options: %s' % msg)
         # process options
@@ -53,6 +60,8 @@ def main(argv):
                 force_update = True
             if o in ("-r", "--full-rebuild"):
                 full_rebuild = True
+            if o in ("-w", "--wheelhouse"):
+                wheelhouse = a
         if len(args) > 1:
             return print_error_msg(
                     "Can only have one argument - you had %s" % (' '.join(args)))
@@ -61,6 +70,10 @@ def main(argv):
                 fake_update = True
             elif args[0] == 'clean':
                 clean_ve = True
+            elif args[0] == 'wheels':
+                build_wheels = True
+            elif args[0] == 'hash':
+                print_hash = True
 
         # check for incompatible flags
         if force_update and fake_update:
@@ -69,9 +82,16 @@ def main(argv):
             return print_error_msg("Cannot use --full-rebuild with fake")
         if full_rebuild and clean_ve:
             return print_error_msg("Cannot use --full-rebuild with clean")
+        if build_wheels and not wheelhouse:
+            return print_error_msg("wheels requires --wheelhouse")
 
-    updater = ve_mgr.UpdateVE()
-    if fake_update:
+    updater = ve_mgr.UpdateVE(wheelhouse=wheelhouse)
+    if print_hash:
+        print ve_mgr.wheelhouse_name(updater.requirements)
+        return 0
+    elif build_wheels:
+        return updater.build_wheelhouse(wheelhouse)
+    elif fake_update:
         return updater.update_ve_timestamp()
     elif clean_ve:
         return updater.delete_virtualenv()
@@ -43,6 +43,9 @@ local_deploy_dir = path.dirname(__file__)
 
 local_vcs_root = path.abspath(path.join(local_deploy_dir, os.pardir))
 
+# the path from the VCS root to this directory, on the server
+#relative_deploy_dir = 'deploy'
+
 # the path from the VCS root to the django root dir
 relative_django_dir = path.join('django', project_name)
 #relative_django_dir = path.join('django', 'website')
@@ -64,6 +67,17 @@ local_requirements_file = path.join(local_deploy_dir, 'pip_packages.txt')
 #local_requirements_dir = path.join(local_deploy_dir, 'requirements')
 # and the files should be path.join(requirements_dir, '%s.txt' % environment)
 
+# build virtualenvs in a cache shared by all the versions, so a version with
+# the same requirements can use the existing virtualenv.  Note that if you use
+# unpinned requirements (like -e git+...) you will need to use
+# "bootstrap.py --force" to pick up changes to them.
+#ve_cache_dir = path.join('/var', 'cache', project_name, 've')
+# the number of virtualenvs to keep in the cache - this is a count, not a
+# size, and virtualenvs still used by a version kept for rollback are never
+# deleted.  A change to the requirements file, or to a file it includes with
+# -r or -c, means a new virtualenv.
+#ve_cache_max_entries = 5
+
 test_cmd = ' manage.py test -v0 ' + ' '.join(django_apps)
 
 # servers, for use by fabric
@@ -103,3 +117,87 @@ webserver = 'apache'
 # then uncomment the next 2 lines
 #user = "root"
 #key_filename = ["/home/shared/keypair.rsa"]
+
+# parallel_deploy works on all the hosts in host_list at once - uncomment to
+# limit how many hosts it works on at the same time
+#deploy_pool_size = 4
+
+# how the current version is copied before the new version is checked out
+# 'copy' (the default) copies everything, 'reflink' uses copy on write where
+# the filesystem supports it and 'hardlink' hard links unchanged files, so
+# uses almost no disk space
+#release_copy_mode = 'hardlink'
+# with 'hardlink', files matching these patterns are given their own copy as
+# they are written to in place (pip and setuptools rewrite easy-install.pth
+# and the .egg-link files in the virtualenv)
+#release_copy_unshare = ['*.db', '*.sqlite', '*.sqlite3', '*.log', 'timestamp',
+#                        '*.pth', '*.egg-link']
+
+# install the virtualenv from wheels kept in this directory on the server.
+# The wheels are built once (by the first host, or locally if
+# wheelhouse_build is 'local') and sent to each server, so the servers don't
+# need to build C extensions or have access to the internet.  ('local' needs
+# the same python and platform as the servers.)
+#wheelhouse_dir = path.join(server_project_home, 'wheelhouse')
+#wheelhouse_build = 'first_host'
+
+# take the database dump for rollback from a consistent snapshot started
+# before the site goes offline, while the new version is being built.  (Note
+# that the dump will not include changes made after the snapshot was taken.)
+# The deploy only waits for the dump during the downtime if there are
+# migrations to run - otherwise it finishes after the site is back up.
+#background_db_dump = True
+
+# how the database dumps are compressed: 'gzip' (the default), 'pigz'
+# (multi-threaded gzip), 'zstd' or 'lz4'
+#db_dump_compressor = 'zstd'
+
+# the daily database dumps can dump this many tables at once, each into its
+# own file, from a consistent snapshot
+#db_dump_parallel = 4
+# and how many tables are loaded at once when restoring a dump - by default
+# a single file dump is loaded on one connection, as it always has been
+#db_restore_parallel = 4
+
+# dump a snapshot of the database at a low CPU and I/O priority, for busy
+# servers - used for the daily dumps and the dump before each deploy
+#db_dump_low_impact = True
+# and the most MB/s of dump to write (before compression)
+#db_dump_bandwidth_limit = 5
+
+# keep the daily and deploy dumps in a store that only keeps one copy of the
+# parts that are the same in each dump, so the dumps only take up as much
+# space as the data that changed.  The daily dumps delete the dumps older
+# than db_dump_store_keep_days, apart from the newest db_dump_store_keep_count.
+#db_dump_store = True
+#db_dump_store_dir = '/var/django/' + project_name + '/dbdumps/store'
+#db_dump_store_keep_days = 31
+#db_dump_store_keep_count = 10
+
+# setup_binlog_backups takes a weekly base backup and copies the mysql binary
+# logs every hour into this directory, so restore_db_to_time can restore the
+# database as it was at any time since.  Needs log_bin and server_id set in
+# my.cnf.
+#db_binlog_backup_dir = '/var/django/' + project_name + '/dbdumps/binlog_backups'
+# restores can turn off foreign key/unique checks and autocommit while
+# loading, and then check the row counts - much faster for big dumps, but a
+# dump with broken foreign keys would load without complaint.  By default
+# dumps are loaded as they are.
+#db_restore_fast = True
+# rollback(restore_db=True) restores the dump into another database while the
+# site is still up, and only stops the site to swap the tables over
+#db_restore_shadow = True
+# deploys only dump the database when the new version has migrations to run,
+# and otherwise record a restore point (the binary log position and latest
+# daily dump) - set this to False to dump the database on every deploy
+#db_dump_only_for_migrations = False
+
+# get_remote_dump (and get_remote_dump_and_load) only copy this part of the
+# database, to give developers a smaller copy.  'follow_foreign_keys' (the
+# default) leaves out rows that refer to rows that have been left out.
+#db_dump_subset = {
+#    'structure_only': ['django_session', 'django_admin_log'],
+#    'where': {'auth_user': 'is_staff = 1'},
+#    'limit': {'shop_order': 1000},
+#    'follow_foreign_keys': True,
+#}
@@ -1,9 +1,17 @@
 import os
+import re
 import sys
 import shutil
+import hashlib
 import subprocess
+from distutils.util import get_platform
 from os import path
 
+# the start of a requirement line is the name of the package
+REQUIREMENT_NAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*')
+# a -e or URL requirement names its package with #egg=
+EGG_NAME_RE = re.compile(r'#egg=([A-Za-z0-9][A-Za-z0-9._-]*)')
+
 
 def find_package_dir_in_ve(ve_dir, package):
     python = os.listdir(path.join(ve_dir, 'lib'))[0]
@@ -68,6 +76,114 @@ def check_python_version(min_python_major_version, min_python_minor_version, py_
             sys.exit(1)
 
 
+def _included_requirements(line):
+    """ The file a requirements file line includes with -r or -c (or their
+    long forms), or None """
+    line = line.split(' #')[0].strip()
+    for option in ('--requirement', '--constraint', '-r', '-c'):
+        if line.startswith(option):
+            included = line[len(option):].lstrip('=').strip()
+            # an include of a URL can't be followed
+            if included and '://' not in included:
+                return included
+    return None
+
+
+def _hash_requirements_file(ve_hash, requirements, seen):
+    """ Add the contents of the requirements file, and of the files it
+    includes, to ve_hash """
+    requirements = path.abspath(requirements)
+    if requirements in seen:
+        return
+    seen.add(requirements)
+    requirements_file = open(requirements, 'r')
+    try:
+        contents = requirements_file.read()
+    finally:
+        requirements_file.close()
+    ve_hash.update(contents)
+    for line in contents.splitlines():
+        included = _included_requirements(line)
+        if included:
+            # relative to the file that includes it, as pip does
+            _hash_requirements_file(
+                ve_hash, path.join(path.dirname(requirements), included), seen)
+
+
+def requirements_hash(requirements, include_python=True):
+    """ A hash of the requirements file (and the files it includes with -r or
+    -c) and the python we build the virtualenv with - if none of them have
+    changed then neither has the virtualenv. """
+    ve_hash = hashlib.sha1()
+    _hash_requirements_file(ve_hash, requirements, set())
+    if include_python:
+        ve_hash.update(sys.executable)
+        ve_hash.update(sys.version)
+    return ve_hash.hexdigest()
+
+
+def python_tag():
+    """ The python version, unicode width and platform that wheels with C
+    extensions are built for, eg cp27mu-linux_x86_64 """
+    abi = 'mu'
+    if sys.maxunicode == 0xffff:
+        abi = 'm'
+    return 'cp%d%d%s-%s' % (sys.version_info[0], sys.version_info[1], abi,
+                            re.sub(r'[-.]', '_', get_platform()))
+
+
+def wheelhouse_name(requirements):
+    """ The name of the wheelhouse for the requirements - wheels built by
+    another python, or on another platform, may not install here, so those
+    are part of the name as well as the requirements_hash() """
+    return '%s-%s' % (python_tag(),
+                      requirements_hash(requirements, include_python=False))
+
+
+def normalise_name(name):
+    """ A package name as pip compares them - and as it is in a wheel's
+    filename """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def requirement_names(requirements, seen=None):
+    """ The normalised names of the packages the requirements file (and the
+    files it includes with -r) asks for - or None if there is one whose name
+    can't be worked out, like a local directory """
+    if seen is None:
+        seen = set()
+    requirements = path.abspath(requirements)
+    names = set()
+    if requirements in seen:
+        return names
+    seen.add(requirements)
+    for line in open(requirements).read().splitlines():
+        line = line.split(' #')[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith(('-r', '--requirement')):
+            included = requirement_names(
+                path.join(path.dirname(requirements),
+                          _included_requirements(line)), seen)
+            if included is None:
+                return None
+            names.update(included)
+            continue
+        if line.startswith('-') and not line.startswith(('-e', '--editable')):
+            # other options, including -c, don't ask for a package
+            continue
+        if line.startswith(('-e', '--editable')) or '://' in line:
+            match = EGG_NAME_RE.search(line)
+        elif line.startswith(('.', '/')):
+            match = None
+        else:
+            match = REQUIREMENT_NAME_RE.match(line)
+        if match is None:
+            return None
+        names.add(normalise_name(match.group(match.lastindex or 0)))
+    return names
+
+
 def in_virtualenv():
     """ Are we already in a virtualenv """
     return 'VIRTUAL_ENV' in os.environ or 'IN_VIRTUALENV' in os.environ
@@ -75,7 +191,13 @@ def in_virtualenv():
 
 class UpdateVE(object):
 
-    def __init__(self, ve_dir=None, requirements=None):
+    # created in a cached virtualenv once it has been built successfully
+    cache_complete_file = '.cache_complete'
+    # created in a wheelhouse once all the wheels have been built
+    wheelhouse_complete_file = '.complete'
+
+    def __init__(self, ve_dir=None, requirements=None, ve_cache_dir=None,
+                 ve_cache_max_entries=None, wheelhouse=None):
 
         if requirements:
             self.requirements = requirements
@@ -100,8 +222,33 @@ class UpdateVE(object):
 
         self.ve_timestamp = path.join(self.ve_dir, 'timestamp')
 
+        # if ve_cache_dir is set, virtualenvs are built in the cache, in a
+        # directory named after the requirements_hash(), and ve_dir is a link
+        # to the cached virtualenv
+        try:
+            import project_settings
+        except ImportError:
+            project_settings = None
+        if ve_cache_dir is None:
+            ve_cache_dir = getattr(project_settings, 've_cache_dir', None)
+        if ve_cache_max_entries is None:
+            ve_cache_max_entries = getattr(project_settings,
+                                           've_cache_max_entries', 5)
+        self.ve_cache_dir = ve_cache_dir
+        self.ve_cache_max_entries = ve_cache_max_entries
+        # used to find the other versions that might be using the cache
+        self.vcs_root = getattr(project_settings, 'local_vcs_root', None)
+        # if set, install from the wheels in this directory rather than
+        # downloading and building the packages
+        self.wheelhouse = wheelhouse
+
     def update_ve_timestamp(self):
         os.utime(self.ve_dir, None)
+        # the timestamp file may be hard linked to the copy in the previous
+        # version, so replace it rather than writing to it - otherwise we
+        # would update the timestamp of the previous version as well
+        if path.exists(self.ve_timestamp):
+            os.remove(self.ve_timestamp)
         file(self.ve_timestamp, 'w').close()
 
     def virtualenv_needs_update(self):
@@ -140,7 +287,10 @@ class UpdateVE(object):
 
     def delete_virtualenv(self):
         """ delete the virtualenv """
-        if path.exists(self.ve_dir):
+        if path.islink(self.ve_dir):
+            # leave the cached virtualenv for the cache to deal with
+            os.remove(self.ve_dir)
+        elif path.exists(self.ve_dir):
             shutil.rmtree(self.ve_dir)
 
     def update_ve(self, full_rebuild, force_update):
@@ -157,25 +307,165 @@ class UpdateVE(object):
             print "use --force to force an update"
             return 0
 
+        if self.ve_cache_dir:
+            return self.update_ve_from_cache(force_update)
+
         # if we need to create the virtualenv, then we must do that from
         # outside the virtualenv. The code inside this if statement will only
         # be run outside the virtualenv.
         if full_rebuild and path.exists(self.ve_dir):
-            shutil.rmtree(self.ve_dir)
-        if not path.exists(self.ve_dir):
+            self.delete_virtualenv()
+        pip_retcode = self.create_ve_and_install(self.ve_dir)
+        if pip_retcode == 0:
+            self.update_ve_timestamp()
+        return pip_retcode
+
+    def create_ve_and_install(self, ve_dir):
+        """ create the virtualenv if required, and install the requirements
+        into it """
+        self.create_ve(ve_dir)
+
+        # install the pip requirements and exit
+        pip_path = path.join(ve_dir, 'bin', 'pip')
+        if self.wheelhouse:
+            return self.install_from_wheelhouse(pip_path)
+        # use cwd to allow relative path specs in requirements file, e.g. ../tika
+        return subprocess.call(
+                [pip_path, 'install', '--requirement=%s' % self.requirements],
+                cwd=os.path.dirname(self.requirements))
+
+    def create_ve(self, ve_dir):
+        if path.islink(ve_dir) and not path.exists(ve_dir):
+            # a link to a cached virtualenv that has since been removed
+            os.remove(ve_dir)
+        if not path.exists(ve_dir):
             import virtualenv
             virtualenv.logger = virtualenv.Logger(consumers=[])
-            virtualenv.create_environment(self.ve_dir, site_packages=False)
+            virtualenv.create_environment(ve_dir, site_packages=False)
 
-        # install the pip requirements and exit
+    def install_from_wheelhouse(self, pip_path):
+        """ Install the wheels of the packages the requirements name from
+        the wheelhouse, without going to the network - pip finds the
+        packages they depend on in the wheelhouse too.  We install the
+        wheels rather than the requirements file as pip would still try to
+        check out any -e requirements.  If a requirement's name can't be
+        worked out (a local directory), every wheel is installed. """
+        if not path.exists(path.join(self.wheelhouse,
+                                     self.wheelhouse_complete_file)):
+            print >> sys.stderr, "Wheelhouse %s is missing or incomplete" % \
+                self.wheelhouse
+            return 1
+        names = requirement_names(self.requirements)
+        wheels = [path.join(self.wheelhouse, f)
+                  for f in sorted(os.listdir(self.wheelhouse))
+                  if f.endswith('.whl') and
+                  (names is None or normalise_name(f.split('-')[0]) in names)]
+        return subprocess.call(
+                [pip_path, 'install', '--no-index',
+                 '--find-links=%s' % self.wheelhouse] + wheels)
+
+    def build_wheelhouse(self, wheelhouse):
+        """ Build wheels for all the requirements (and the packages they
+        depend on) into the wheelhouse directory, so they can be installed
+        on machines that can't, or shouldn't have to, build them. """
+        if path.exists(path.join(wheelhouse, self.wheelhouse_complete_file)):
+            print "Wheelhouse %s is already built" % wheelhouse
+            return 0
+        # we need pip and wheel from a virtualenv to build the wheels
+        self.create_ve(self.ve_dir)
         pip_path = path.join(self.ve_dir, 'bin', 'pip')
+        retcode = subprocess.call([pip_path, 'install', 'wheel'])
+        if retcode != 0:
+            return retcode
+        if not path.exists(wheelhouse):
+            os.makedirs(wheelhouse)
         # use cwd to allow relative path specs in requirements file, e.g. ../tika
-        pip_retcode = subprocess.call(
-                [pip_path, 'install', '--requirement=%s' % self.requirements],
+        retcode = subprocess.call(
+                [pip_path, 'wheel', '--wheel-dir=%s' % wheelhouse,
+                 '--requirement=%s' % self.requirements],
                 cwd=os.path.dirname(self.requirements))
-        if pip_retcode == 0:
-            self.update_ve_timestamp()
-        return pip_retcode
+        if retcode == 0:
+            file(path.join(wheelhouse, self.wheelhouse_complete_file), 'w').close()
+        return retcode
+
+    def update_ve_from_cache(self, force_update):
+        """ Link ve_dir to the cached virtualenv for these requirements,
+        building it first if it is not in the cache.  A virtualenv in the
+        cache was built from scratch, so a full rebuild never needs to do
+        more than this.  force_update rebuilds the cached virtualenv - use it
+        if a requirement (such as an unpinned git checkout) has changed
+        without the requirements file changing. """
+        cached_ve = path.join(self.ve_cache_dir,
+                              requirements_hash(self.requirements))
+        complete_file = path.join(cached_ve, self.cache_complete_file)
+        if force_update or not path.exists(complete_file):
+            if path.exists(cached_ve):
+                shutil.rmtree(cached_ve)
+            if not path.exists(self.ve_cache_dir):
+                os.makedirs(self.ve_cache_dir)
+            pip_retcode = self.create_ve_and_install(cached_ve)
+            if pip_retcode != 0:
+                return pip_retcode
+            file(complete_file, 'w').close()
+
+        self.link_to_cached_ve(cached_ve)
+        # this also marks the cached virtualenv as recently used
+        self.update_ve_timestamp()
+        self.evict_cached_ves()
+        return 0
+
+    def link_to_cached_ve(self, cached_ve):
+        if path.islink(self.ve_dir) and \
+                path.realpath(self.ve_dir) == path.realpath(cached_ve):
+            return
+        if path.exists(self.ve_dir) and not path.islink(self.ve_dir):
+            shutil.rmtree(self.ve_dir)
+        # create the new link alongside and rename it into place, so ve_dir is
+        # never missing
+        new_link = self.ve_dir + '.new'
+        if path.islink(new_link):
+            os.remove(new_link)
+        os.symlink(cached_ve, new_link)
+        os.rename(new_link, self.ve_dir)
+
+    def cached_ves_in_use(self):
+        """ The cached virtualenvs linked to by this version and the other
+        versions alongside it (the old versions kept for rollback) """
+        in_use = set()
+        if path.islink(self.ve_dir):
+            in_use.add(path.realpath(self.ve_dir))
+        if self.vcs_root is None:
+            return in_use
+        vcs_root = path.abspath(self.vcs_root)
+        relative_ve_dir = path.relpath(path.abspath(self.ve_dir), vcs_root)
+        if relative_ve_dir.startswith(os.pardir):
+            return in_use
+        versions_dir = path.dirname(vcs_root)
+        for version in os.listdir(versions_dir):
+            version_ve_dir = path.join(versions_dir, version, relative_ve_dir)
+            if path.islink(version_ve_dir):
+                in_use.add(path.realpath(version_ve_dir))
+        return in_use
+
+    def evict_cached_ves(self):
+        """ Delete the least recently used virtualenvs from the cache until
+        there are only ve_cache_max_entries left, but never delete one that
+        is still linked to by a version we might roll back to.  The limit is
+        a count of virtualenvs, not their size on disk - and the ones in use
+        can take the cache over it. """
+        cached_ves = [path.join(self.ve_cache_dir, d)
+                      for d in os.listdir(self.ve_cache_dir)]
+        cached_ves = [d for d in cached_ves
+                      if path.isdir(d) and not path.islink(d)]
+        excess = len(cached_ves) - self.ve_cache_max_entries
+        if excess <= 0:
+            return
+        in_use = self.cached_ves_in_use()
+        unused = [d for d in cached_ves if path.realpath(d) not in in_use]
+        # the mtime is updated by update_ve_timestamp() each time it is used
+        unused.sort(key=path.getmtime)
+        for cached_ve in unused[:excess]:
+            shutil.rmtree(cached_ve)
 
     def go_to_ve(self, file_path, args):
         """